@@ -1,12 +1,14 @@
 import os
 import logging
+import tempfile
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy.orm import DeclarativeBase
 
-logging.basicConfig(level=logging.DEBUG)
+# LOG_LEVEL=DEBUG shows every library's debug output; INFO is enough in production
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 # Create a custom base class for SQLAlchemy models
 class Base(DeclarativeBase):
@@ -20,7 +22,7 @@ login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -32,19 +34,166 @@ def create_app():
         "pool_pre_ping": True,
     }
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # Configure file storage (local filesystem or S3-compatible object store)
+    app.config["STORAGE_BACKEND"] = os.environ.get("STORAGE_BACKEND", "local")
+    app.config["UPLOAD_ROOT"] = os.environ.get("UPLOAD_ROOT", os.path.join(app.root_path, "static"))
+    app.config["S3_BUCKET"] = os.environ.get("S3_BUCKET")
+    app.config["S3_ENDPOINT_URL"] = os.environ.get("S3_ENDPOINT_URL")
+    app.config["S3_REGION"] = os.environ.get("S3_REGION")
+    app.config["S3_PREFIX"] = os.environ.get("S3_PREFIX", "")
+    app.config["S3_ACCESS_KEY"] = os.environ.get("S3_ACCESS_KEY")
+    app.config["S3_SECRET_KEY"] = os.environ.get("S3_SECRET_KEY")
+    app.config["S3_PRESIGNED_DOWNLOADS"] = os.environ.get("S3_PRESIGNED_DOWNLOADS", "1") == "1"
     
+    # Background worker pool (metadata extraction and other post-upload jobs)
+    app.config["TASK_WORKERS"] = int(os.environ.get("TASK_WORKERS", 4))
+    # Parallel storage writes for batch radiograph uploads
+    app.config["UPLOAD_WORKERS"] = int(os.environ.get("UPLOAD_WORKERS", 8))
+
+    # Working hours used by the free-slot finder (see app/agenda.py for the format)
+    app.config["AGENDA_EXPEDIENTE"] = os.environ.get("AGENDA_EXPEDIENTE",
+                                                     "seg-sex=08:00-12:00,13:00-18:00;sab=08:00-12:00")
+    # Granularity of the start times offered, in minutes
+    app.config["AGENDA_PASSO_MINUTOS"] = int(os.environ.get("AGENDA_PASSO_MINUTOS", 15))
+    # How far ahead a new recurring series is checked for conflicts
+    app.config["AGENDA_HORIZONTE_RECORRENCIA_DIAS"] = int(os.environ.get("AGENDA_HORIZONTE_RECORRENCIA_DIAS", 365))
+    # Recurring occurrences listed on the patient page
+    app.config["AGENDA_JANELA_PACIENTE_DIAS"] = int(os.environ.get("AGENDA_JANELA_PACIENTE_DIAS", 90))
+
+    # Status given to past appointments still scheduled by the nightly rollover
+    app.config["AGENDA_STATUS_VENCIDOS"] = os.environ.get("AGENDA_STATUS_VENCIDOS", "faltou")
+
+    # Seconds between checks for appointment changes pushed to open agenda pages
+    app.config["AGENDA_SSE_INTERVALO"] = float(os.environ.get("AGENDA_SSE_INTERVALO", 2))
+    # Open agenda pages per worker: each holds a server thread while open, so
+    # keep it below the gunicorn --threads count to leave room for requests
+    app.config["AGENDA_SSE_MAXIMO"] = int(os.environ.get("AGENDA_SSE_MAXIMO", 8))
+
+    # Seconds between checks of the change log that keeps worker caches in sync
+    # (only used when the database has no LISTEN/NOTIFY, i.e. not PostgreSQL)
+    app.config["INVALIDACAO_INTERVALO"] = float(os.environ.get("INVALIDACAO_INTERVALO", 1))
+
+    # Cache of expensive aggregates: "memory" (per worker), "redis" or "file"
+    # (SQLite file shared by the workers of a node)
+    app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")
+    app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+    app.config["CACHE_ARQUIVO"] = os.environ.get("CACHE_ARQUIVO", os.path.join(tempfile.gettempdir(), "clinica-cache.sqlite3"))
+    app.config["CACHE_PREFIXO"] = os.environ.get("CACHE_PREFIXO", "clinica:")
+    app.config["CACHE_MAX_ITENS"] = int(os.environ.get("CACHE_MAX_ITENS", 1000))
+    app.config["CACHE_TTL"] = int(os.environ.get("CACHE_TTL", 300))
+
+    # iCalendar feed of the agenda (calendar apps on the dentists' phones)
+    app.config["ICAL_DIAS_PASSADOS"] = int(os.environ.get("ICAL_DIAS_PASSADOS", 30))
+    app.config["ICAL_DIAS_FUTUROS"] = int(os.environ.get("ICAL_DIAS_FUTUROS", 180))
+    app.config["ICAL_FUSO_HORARIO"] = os.environ.get("ICAL_FUSO_HORARIO", "America/Sao_Paulo")
+    app.config["ICAL_DOMINIO"] = os.environ.get("ICAL_DOMINIO", "clinicaodontologica.com")
+    app.config["ICAL_NOME"] = os.environ.get("ICAL_NOME", "Agenda da Clínica")
+
+    # Response compression: smallest body compressed (bytes) and compression levels
+    app.config["COMPRESSAO_MINIMO"] = int(os.environ.get("COMPRESSAO_MINIMO", 1024))
+    app.config["COMPRESSAO_NIVEL_GZIP"] = int(os.environ.get("COMPRESSAO_NIVEL_GZIP", 6))
+    app.config["COMPRESSAO_NIVEL_BROTLI"] = int(os.environ.get("COMPRESSAO_NIVEL_BROTLI", 4))
+
+    # Request instrumentation: requests slower than this (ms), with more SQL
+    # statements than this, or repeating one statement this many times (N+1)
+    # are logged as a JSON line
+    app.config["INSTRUMENTACAO_LENTA_MS"] = float(os.environ.get("INSTRUMENTACAO_LENTA_MS", 500))
+    app.config["INSTRUMENTACAO_MAX_CONSULTAS"] = int(os.environ.get("INSTRUMENTACAO_MAX_CONSULTAS", 30))
+    app.config["INSTRUMENTACAO_REPETICOES"] = int(os.environ.get("INSTRUMENTACAO_REPETICOES", 5))
+
+    # On-demand profiling of admin requests (?perfil=1): where the folded
+    # stacks go, sampling interval and how many files are kept
+    app.config["PERFIL_DIR"] = os.environ.get("PERFIL_DIR", os.path.join(tempfile.gettempdir(), "clinica-perfis"))
+    app.config["PERFIL_INTERVALO_MS"] = float(os.environ.get("PERFIL_INTERVALO_MS", 5))
+    app.config["PERFIL_MAX_ARQUIVOS"] = int(os.environ.get("PERFIL_MAX_ARQUIVOS", 50))
+
+    # Distributed tracing: OTLP/HTTP collector URL (.../v1/traces) or file that
+    # receives OTLP/JSON lines (disabled when empty), and share of requests traced
+    app.config["TRACING_DESTINO"] = os.environ.get("TRACING_DESTINO", "")
+    app.config["TRACING_AMOSTRAGEM"] = float(os.environ.get("TRACING_AMOSTRAGEM", 0.1))
+    app.config["TRACING_SERVICO"] = os.environ.get("TRACING_SERVICO", "clinica-odontologica")
+
+    # Memory diagnostics: frames kept by tracemalloc, started with each worker
+    # when > 0 (it can also be started later with SIGUSR2 or /admin/memoria)
+    app.config["MEMORIA_TRACEMALLOC"] = int(os.environ.get("MEMORIA_TRACEMALLOC", 0))
+
+    # Bearer token required to scrape /metrics (not served when empty)
+    app.config["METRICAS_TOKEN"] = os.environ.get("METRICAS_TOKEN", "")
+
+    # Settings given by the caller win over the environment (e.g. the scratch
+    # database of the query budget check)
+    app.config.update(config or {})
+
+    # Compress HTML/JSON responses (see app/compression.py for what is skipped)
+    from app.compression import CompressionMiddleware
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                         minimo=app.config["COMPRESSAO_MINIMO"],
+                                         nivel_gzip=app.config["COMPRESSAO_NIVEL_GZIP"],
+                                         nivel_brotli=app.config["COMPRESSAO_NIVEL_BROTLI"])
+
     # Initialize extensions with app
     db.init_app(app)
     login_manager.init_app(app)
+
+    from app.instrumentation import init_instrumentation
+    init_instrumentation(app)
+
+    from app.tracing import init_tracing
+    init_tracing(app)
+
+    from app.metrics import init_metrics
+    init_metrics(app)
+
+    from app.profiling import init_profiling
+    init_profiling(app)
+
+    from app.memory import init_memory
+    init_memory(app)
+
+    from app.storage import init_storage
+    init_storage(app)
+    
+    from app.tasks import init_tasks
+    init_tasks(app)
+    
+    from app.invalidation import init_invalidation
+    init_invalidation(app)
+    
+    from app.cache import init_cache
+    init_cache(app)
+    
+    from app.fragments import init_fragments
+    init_fragments(app)
+    
+    from app.assets import init_assets
+    init_assets(app)
     
     with app.app_context():
         # Import models here to ensure they're properly registered with SQLAlchemy
         from app.models import (Usuario, Paciente, Evolucao, Radiografia, 
-                               Agendamento, FormularioPreConsulta)
+                               Agendamento, FormularioPreConsulta, UsoArmazenamento,
+                               RadiografiaMetadados, RecorrenciaAgendamento,
+                               RegistroAlteracao)
         
         # Create all database tables
         db.create_all()
         
+        # Add columns/indexes introduced after the tables were first created
+        from app.schema import upgrade_schema
+        upgrade_schema()
+        
+        # Storage accounting and deferred file cleanup for radiographs
+        from app import upload_gc
+        
+        # Patient record versions for conditional GETs
+        from app import versioning
+        
+        # Appointment intervals and double-booking protection
+        from app.agenda import preencher_intervalos, instalar_restricao_sobreposicao
+        preencher_intervalos()
+        instalar_restricao_sobreposicao()
+        
         # Ensure admin user exists
         from werkzeug.security import generate_password_hash
         
@@ -79,6 +228,10 @@ def create_app():
     from app.routes import register_routes
     register_routes(app)
     
+    # Register CLI commands (maintenance jobs)
+    from app.commands import register_commands
+    register_commands(app)
+    
     return app
 
 # User loader for Flask-Login
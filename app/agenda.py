@@ -0,0 +1,622 @@
+import logging
+import calendar
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from flask import current_app
+from sqlalchemy import event, text, or_, select, update, insert
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Agendamento, Paciente, RecorrenciaAgendamento
+from app.invalidation import publicar
+from app.versioning import marcar_pacientes
+
+logger = logging.getLogger(__name__)
+
+DURACAO_PADRAO = 30
+# Limite da duração: permite limitar a busca por sobreposição a uma faixa do índice
+DURACAO_MAXIMA = 8 * 60
+
+# Status em que o agendamento ocupa o horário
+STATUS_OCUPAM_HORARIO = ('agendada', 'concluida')
+# Status aceitos na atualização em lote (fechamento do dia)
+STATUS_EM_LOTE = ('concluida', 'faltou', 'cancelada')
+
+RESTRICAO_SOBREPOSICAO = 'ex_agendamentos_sobreposicao'
+
+DIAS_SEMANA = ['seg', 'ter', 'qua', 'qui', 'sex', 'sab', 'dom']
+
+
+class ConflitoAgendamento(Exception):
+    """Raised when an appointment overlaps another active appointment"""
+
+    def __init__(self, conflitos):
+        self.conflitos = conflitos
+        super().__init__(mensagem_conflito(conflitos))
+
+
+def hora_em_minutos(hora):
+    """Convert 'HH:MM' to minutes since midnight"""
+    horas, minutos = hora.split(':')
+    return int(horas) * 60 + int(minutos)
+
+
+def minutos_em_hora(minutos):
+    return f'{minutos // 60:02d}:{minutos % 60:02d}'
+
+
+def calcular_intervalo(agendamento):
+    """Fill the derived inicio_minutos/fim_minutos columns"""
+    if agendamento.duracao_minutos is None:
+        agendamento.duracao_minutos = DURACAO_PADRAO
+    agendamento.inicio_minutos = hora_em_minutos(agendamento.hora_consulta)
+    agendamento.fim_minutos = agendamento.inicio_minutos + agendamento.duracao_minutos
+
+
+@event.listens_for(Agendamento, 'before_insert')
+@event.listens_for(Agendamento, 'before_update')
+def _atualizar_intervalo(mapper, connection, target):
+    calcular_intervalo(target)
+
+
+def bloquear_agenda(data):
+    """
+    Serialize writes to the agenda of ``data`` until the transaction ends.
+
+    PostgreSQL takes a transaction-level advisory lock keyed by the date, so
+    two receptionists booking the same day wait for each other while other
+    days proceed. SQLite has no row or advisory locks; BEGIN IMMEDIATE takes
+    the database write lock before the overlap probe runs.
+
+    Must be called before the session flushes any change.
+    """
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+
+    if dialect == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:chave)'),
+                           {'chave': data.toordinal()})
+    elif dialect == 'sqlite':
+        dbapi_connection = connection.connection.dbapi_connection
+        # Já em transação significa que houve escrita e o lock já é nosso
+        if not dbapi_connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def buscar_conflitos(data, inicio, fim, ignorar_id=None):
+    """
+    Return ``(agendamento_id, inicio, fim, paciente_nome)`` for every active
+    appointment overlapping ``[inicio, fim)`` on ``data``.
+
+    Overlap is ``inicio_existente < fim AND fim_existente > inicio``. Bounding
+    the start to ``(inicio - DURACAO_MAXIMA, fim)`` turns it into a single
+    range scan on ix_agendamentos_data_inicio.
+    """
+    query = db.session.query(Agendamento.id, Agendamento.inicio_minutos,
+                             Agendamento.fim_minutos, Paciente.nome) \
+        .join(Paciente, Paciente.id == Agendamento.paciente_id) \
+        .filter(Agendamento.data_consulta == data,
+                Agendamento.inicio_minutos > inicio - DURACAO_MAXIMA,
+                Agendamento.inicio_minutos < fim,
+                Agendamento.fim_minutos > inicio,
+                Agendamento.status.in_(STATUS_OCUPAM_HORARIO))
+    if ignorar_id:
+        query = query.filter(Agendamento.id != ignorar_id)
+
+    with db.session.no_autoflush:
+        conflitos = query.order_by(Agendamento.inicio_minutos).all()
+        conflitos += [(None, o.inicio_minutos, o.fim_minutos, o.paciente.nome)
+                      for o in expandir_recorrencias(data, data)
+                      if o.inicio_minutos < fim and o.fim_minutos > inicio]
+    return sorted(conflitos, key=lambda c: c[1])
+
+
+def mensagem_conflito(conflitos):
+    if not conflitos:
+        return 'Horário em conflito com outro agendamento.'
+    horarios = ', '.join(f'{minutos_em_hora(inicio)}–{minutos_em_hora(fim)} ({nome})'
+                         for _, inicio, fim, nome in conflitos)
+    return f'Horário em conflito com: {horarios}'
+
+
+def salvar_agendamento(agendamento):
+    """
+    Commit ``agendamento`` unless it overlaps an active appointment.
+
+    The caller must have called bloquear_agenda() for the appointment's date
+    before changing it. Raises ConflitoAgendamento after rolling back.
+    """
+    calcular_intervalo(agendamento)
+
+    if agendamento.status in STATUS_OCUPAM_HORARIO:
+        conflitos = buscar_conflitos(agendamento.data_consulta,
+                                     agendamento.inicio_minutos,
+                                     agendamento.fim_minutos,
+                                     ignorar_id=agendamento.id)
+        if conflitos:
+            db.session.rollback()
+            raise ConflitoAgendamento(conflitos)
+
+    db.session.add(agendamento)
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        # Última linha de defesa no PostgreSQL: a exclusion constraint
+        if RESTRICAO_SOBREPOSICAO in str(e.orig):
+            raise ConflitoAgendamento([])
+        raise
+
+
+@lru_cache(maxsize=8)
+def carregar_expediente(texto):
+    """
+    Parse a working-hours template into ``{weekday: ((inicio, fim), ...)}``
+    with minutes since midnight and Monday as 0.
+
+    Format: ``seg-sex=08:00-12:00,13:00-18:00;sab=08:00-12:00``. Days are
+    ``seg ter qua qui sex sab dom``, alone or as a range.
+    """
+    expediente = {}
+    for bloco in filter(None, (b.strip() for b in texto.split(';'))):
+        try:
+            dias, janelas = bloco.split('=')
+            primeiro, _, ultimo = dias.strip().lower().partition('-')
+            indices = range(DIAS_SEMANA.index(primeiro), DIAS_SEMANA.index(ultimo or primeiro) + 1)
+            intervalos = []
+            for janela in janelas.split(','):
+                inicio, fim = janela.strip().split('-')
+                intervalos.append((hora_em_minutos(inicio), hora_em_minutos(fim)))
+        except ValueError:
+            raise ValueError(f'Invalid working hours block: {bloco!r}')
+        for dia in indices:
+            expediente[dia] = tuple(sorted(intervalos))
+    return expediente
+
+
+def carregar_ocupacao(inicio, fim):
+    """
+    Load the busy intervals of active appointments between two dates.
+
+    Returns ``{date: [(inicio, fim), ...]}`` sorted by start, with
+    overlapping intervals already merged, from a single indexed query that
+    reads only the date and minute columns.
+    """
+    linhas = db.session.query(Agendamento.data_consulta, Agendamento.inicio_minutos,
+                              Agendamento.fim_minutos) \
+        .filter(Agendamento.data_consulta.between(inicio, fim),
+                Agendamento.status.in_(STATUS_OCUPAM_HORARIO)) \
+        .order_by(Agendamento.data_consulta, Agendamento.inicio_minutos)
+
+    brutos = {}
+    for data, comeco, termino in linhas:
+        brutos.setdefault(data, []).append((comeco, termino))
+
+    # Ocorrências de séries recorrentes ainda não materializadas
+    for ocorrencia in expandir_recorrencias(inicio, fim):
+        intervalos = brutos.setdefault(ocorrencia.data_consulta, [])
+        intervalos.append((ocorrencia.inicio_minutos, ocorrencia.fim_minutos))
+        intervalos.sort()
+
+    ocupacao = {}
+    for data, intervalos in brutos.items():
+        mesclados = ocupacao[data] = []
+        for comeco, termino in intervalos:
+            if mesclados and comeco <= mesclados[-1][1]:
+                if termino > mesclados[-1][1]:
+                    mesclados[-1] = (mesclados[-1][0], termino)
+            else:
+                mesclados.append((comeco, termino))
+    return ocupacao
+
+
+def _arredondar(minutos, passo):
+    return -(-minutos // passo) * passo
+
+
+def buscar_horarios_livres(duracao, inicio, fim, limite=10, passo=15, expediente=None, agora=None):
+    """
+    Return up to ``limite`` free slots of ``duracao`` minutes between the
+    dates ``inicio`` and ``fim`` as ``(date, inicio_minutos, fim_minutos)``.
+
+    The schedule is loaded once for the whole range and swept day by day:
+    each working window is walked against the merged busy intervals with a
+    single cursor, so the cost is linear in days plus appointments. Slots
+    start on multiples of ``passo``; consecutive slots inside one gap do not
+    overlap each other.
+    """
+    if expediente is None:
+        expediente = carregar_expediente(current_app.config['AGENDA_EXPEDIENTE'])
+    agora = agora or datetime.now()
+
+    # Não oferece horários que já passaram
+    inicio = max(inicio, agora.date())
+    ocupacao = carregar_ocupacao(inicio, fim)
+    livres = []
+    dia = inicio
+    while dia <= fim and len(livres) < limite:
+        ocupados = ocupacao.get(dia, ())
+        i = 0
+        minimo = agora.hour * 60 + agora.minute if dia == agora.date() else 0
+
+        for janela_inicio, janela_fim in expediente.get(dia.weekday(), ()):
+            cursor = _arredondar(max(janela_inicio, minimo), passo)
+            while cursor + duracao <= janela_fim and len(livres) < limite:
+                # Pula intervalos que terminam antes do cursor
+                while i < len(ocupados) and ocupados[i][1] <= cursor:
+                    i += 1
+                if i < len(ocupados) and ocupados[i][0] < cursor + duracao:
+                    cursor = _arredondar(ocupados[i][1], passo)
+                    continue
+                livres.append((dia, cursor, cursor + duracao))
+                cursor = _arredondar(cursor + duracao, passo)
+        dia += timedelta(days=1)
+
+    return livres
+
+
+# --- Agendamentos recorrentes ------------------------------------------------
+
+class Ocorrencia:
+    """
+    An occurrence of a recurring series that has no row yet.
+
+    Exposes the attributes templates and reports read from Agendamento, with
+    ``id`` None; it becomes a real Agendamento through materializar_ocorrencia().
+    """
+
+    id = None
+    status = 'agendada'
+
+    def __init__(self, recorrencia, data):
+        self.recorrencia = recorrencia
+        self.recorrencia_id = recorrencia.id
+        self.paciente = recorrencia.paciente
+        self.paciente_id = recorrencia.paciente_id
+        self.data_consulta = data
+        self.data_original = data
+        self.hora_consulta = recorrencia.hora_consulta
+        self.duracao_minutos = recorrencia.duracao_minutos
+        self.tipo_consulta = recorrencia.tipo_consulta
+        self.observacao = recorrencia.observacao
+        self.inicio_minutos = hora_em_minutos(recorrencia.hora_consulta)
+        self.fim_minutos = self.inicio_minutos + recorrencia.duracao_minutos
+
+    def __repr__(self):
+        return f'<Ocorrencia {self.recorrencia_id} - {self.data_consulta}>'
+
+
+def _somar_meses(data, meses):
+    """Same day ``meses`` months later, clamped to the end of shorter months"""
+    mes = data.month - 1 + meses
+    ano = data.year + mes // 12
+    mes = mes % 12 + 1
+    return date(ano, mes, min(data.day, calendar.monthrange(ano, mes)[1]))
+
+
+def datas_ocorrencias(recorrencia, inicio, fim):
+    """
+    Yield the dates of ``recorrencia`` between ``inicio`` and ``fim``.
+
+    The index of the first occurrence in the window is computed directly, so
+    a series started years ago costs nothing for the dates before the window.
+    """
+    base = recorrencia.data_inicio
+    inicio = max(inicio, base)
+    if recorrencia.data_fim:
+        fim = min(fim, recorrencia.data_fim)
+    if fim < inicio:
+        return
+
+    intervalo = max(recorrencia.intervalo or 1, 1)
+    limite = recorrencia.total_ocorrencias
+
+    if recorrencia.frequencia == 'mensal':
+        meses = (inicio.year - base.year) * 12 + inicio.month - base.month
+        indice = max(meses // intervalo, 0)
+        proxima = lambda i: _somar_meses(base, i * intervalo)
+    else:
+        passo = intervalo * (7 if recorrencia.frequencia == 'semanal' else 1)
+        indice = -(-(inicio - base).days // passo)
+        proxima = lambda i: base + timedelta(days=i * passo)
+
+    while limite is None or indice < limite:
+        data = proxima(indice)
+        if data > fim:
+            break
+        if data >= inicio:
+            yield data
+        indice += 1
+
+
+def expandir_recorrencias(inicio, fim, paciente_id=None):
+    """
+    Expand the recurring series active between two dates into Ocorrencia
+    objects, skipping the occurrences already materialized as rows (which
+    show up through the normal Agendamento queries instead).
+    """
+    query = RecorrenciaAgendamento.query.options(joinedload(RecorrenciaAgendamento.paciente)) \
+        .filter(RecorrenciaAgendamento.data_inicio <= fim,
+                or_(RecorrenciaAgendamento.data_fim.is_(None), RecorrenciaAgendamento.data_fim >= inicio))
+    if paciente_id:
+        query = query.filter(RecorrenciaAgendamento.paciente_id == paciente_id)
+    recorrencias = query.all()
+    if not recorrencias:
+        return []
+
+    materializadas = set(
+        db.session.query(Agendamento.recorrencia_id, Agendamento.data_original)
+        .filter(Agendamento.recorrencia_id.in_([r.id for r in recorrencias]),
+                Agendamento.data_original.between(inicio, fim))
+    )
+
+    ocorrencias = []
+    for recorrencia in recorrencias:
+        for data in datas_ocorrencias(recorrencia, inicio, fim):
+            if (recorrencia.id, data) not in materializadas:
+                ocorrencias.append(Ocorrencia(recorrencia, data))
+    ocorrencias.sort(key=lambda o: (o.data_consulta, o.inicio_minutos))
+    return ocorrencias
+
+
+def agenda_do_periodo(inicio, fim, paciente_id=None, status=None):
+    """Stored appointments plus pending occurrences, ordered by date and time"""
+    query = Agendamento.query.options(joinedload(Agendamento.paciente)) \
+        .filter(Agendamento.data_consulta.between(inicio, fim))
+    if paciente_id:
+        query = query.filter(Agendamento.paciente_id == paciente_id)
+    if status:
+        query = query.filter(Agendamento.status == status)
+
+    agenda = query.all()
+    if status in (None, Ocorrencia.status):
+        agenda += expandir_recorrencias(inicio, fim, paciente_id=paciente_id)
+    return sorted(agenda, key=lambda a: (a.data_consulta, a.hora_consulta))
+
+
+def conflitos_recorrencia(recorrencia, horizonte):
+    """
+    Check the occurrences of a new series up to ``horizonte`` against the
+    agenda. Returns ``(data, inicio, fim, paciente_nome)`` for each clash.
+    """
+    inicio = recorrencia.data_inicio
+    datas = list(datas_ocorrencias(recorrencia, inicio, horizonte))
+    if not datas:
+        return []
+
+    ocupados = {}
+    linhas = db.session.query(Agendamento.data_consulta, Agendamento.inicio_minutos,
+                              Agendamento.fim_minutos, Paciente.nome) \
+        .join(Paciente, Paciente.id == Agendamento.paciente_id) \
+        .filter(Agendamento.data_consulta.between(datas[0], datas[-1]),
+                Agendamento.status.in_(STATUS_OCUPAM_HORARIO))
+    for data, comeco, termino, nome in linhas:
+        ocupados.setdefault(data, []).append((comeco, termino, nome))
+    for ocorrencia in expandir_recorrencias(datas[0], datas[-1]):
+        ocupados.setdefault(ocorrencia.data_consulta, []).append(
+            (ocorrencia.inicio_minutos, ocorrencia.fim_minutos, ocorrencia.paciente.nome))
+
+    comeco_novo = hora_em_minutos(recorrencia.hora_consulta)
+    termino_novo = comeco_novo + recorrencia.duracao_minutos
+    return [(data, comeco, termino, nome)
+            for data in datas
+            for comeco, termino, nome in ocupados.get(data, ())
+            if comeco < termino_novo and termino > comeco_novo]
+
+
+def bloquear_recorrencia(recorrencia, horizonte):
+    """Lock every date the new series touches up to ``horizonte``, in order"""
+    datas = list(datas_ocorrencias(recorrencia, recorrencia.data_inicio, horizonte))
+    if db.session.connection().dialect.name == 'postgresql':
+        for data in datas:
+            bloquear_agenda(data)
+    elif datas:
+        # No SQLite o lock é do banco inteiro
+        bloquear_agenda(datas[0])
+
+
+def materializar_ocorrencia(recorrencia, data):
+    """
+    Return the Agendamento row for the occurrence of ``recorrencia`` on
+    ``data``, creating it from the series when needed. Returns None when the
+    series has no occurrence on that date.
+
+    A new row is only flushed: the caller applies its changes and commits
+    (or rolls back) everything in one transaction. Call bloquear_agenda()
+    for ``data`` first, so the insert happens under the agenda lock.
+    """
+    existente = Agendamento.query.filter_by(recorrencia_id=recorrencia.id, data_original=data).first()
+    if existente:
+        return existente
+    if data not in datas_ocorrencias(recorrencia, data, data):
+        return None
+
+    agendamento = Agendamento(
+        paciente_id=recorrencia.paciente_id,
+        recorrencia_id=recorrencia.id,
+        data_original=data,
+        data_consulta=data,
+        hora_consulta=recorrencia.hora_consulta,
+        duracao_minutos=recorrencia.duracao_minutos,
+        tipo_consulta=recorrencia.tipo_consulta,
+        observacao=recorrencia.observacao,
+        status=Ocorrencia.status
+    )
+    try:
+        # Savepoint: desfazer só o INSERT mantém o lock da agenda
+        with db.session.begin_nested():
+            db.session.add(agendamento)
+    except IntegrityError:
+        # Outra requisição materializou a mesma ocorrência
+        return Agendamento.query.filter_by(recorrencia_id=recorrencia.id, data_original=data).one()
+    return agendamento
+
+
+def _inserir_ocorrencias(ocorrencias, status):
+    """Store pending occurrences as rows with ``status`` in one INSERT"""
+    if not ocorrencias:
+        return 0
+    agora = datetime.now()
+    db.session.execute(insert(Agendamento), [{
+        'paciente_id': o.paciente_id,
+        'recorrencia_id': o.recorrencia_id,
+        'data_original': o.data_original,
+        'data_consulta': o.data_consulta,
+        'hora_consulta': o.hora_consulta,
+        'duracao_minutos': o.duracao_minutos,
+        'inicio_minutos': o.inicio_minutos,
+        'fim_minutos': o.fim_minutos,
+        'tipo_consulta': o.tipo_consulta,
+        'observacao': o.observacao,
+        'status': status,
+        'data_registro': agora,
+        'atualizado_em': agora,
+    } for o in ocorrencias])
+    return len(ocorrencias)
+
+
+def _verificar_reativados(linhas):
+    """
+    Lock the days of the appointments about to occupy their slot again and
+    make sure none overlaps an active appointment or another of the batch.
+    """
+    for data in sorted({linha.data_consulta for linha in linhas}):
+        bloquear_agenda(data)
+    aceitos = {}
+    for linha in linhas:
+        do_dia = aceitos.setdefault(linha.data_consulta, [])
+        conflitos = buscar_conflitos(linha.data_consulta, linha.inicio_minutos, linha.fim_minutos,
+                                     ignorar_id=linha.id)
+        conflitos += [outro for outro in do_dia if outro[1] < linha.fim_minutos and outro[2] > linha.inicio_minutos]
+        if conflitos:
+            db.session.rollback()
+            raise ConflitoAgendamento(conflitos)
+        do_dia.append((linha.id, linha.inicio_minutos, linha.fim_minutos, linha.nome))
+
+
+def atualizar_status_em_lote(ids, ocorrencias, status):
+    """
+    Set ``status`` on many appointments in one transaction.
+
+    ``ids`` are Agendamento ids, changed by a single UPDATE. ``ocorrencias``
+    are ``(recorrencia_id, date)`` pairs of pending recurring occurrences,
+    validated against the series and inserted with the new status. Returns
+    the number of appointments changed.
+
+    Rows going back to a status that occupies the slot (e.g. a cancelled
+    appointment marked as done) are checked for overlaps under the agenda
+    lock of their days; ConflitoAgendamento is raised after rolling back.
+    """
+    if status not in STATUS_EM_LOTE:
+        raise ValueError(f'Invalid status for bulk update: {status}')
+
+    alterados = 0
+    if ids:
+        linhas = db.session.query(Agendamento.id, Agendamento.data_consulta, Agendamento.status,
+                                  Agendamento.inicio_minutos, Agendamento.fim_minutos, Paciente.nome) \
+            .join(Paciente, Paciente.id == Agendamento.paciente_id) \
+            .filter(Agendamento.id.in_(ids), Agendamento.status != status).all()
+        if status in STATUS_OCUPAM_HORARIO:
+            _verificar_reativados([l for l in linhas if l.status not in STATUS_OCUPAM_HORARIO])
+
+        resultado = db.session.execute(
+            update(Agendamento)
+            .where(Agendamento.id.in_(ids), Agendamento.status != status)
+            .values(status=status, atualizado_em=datetime.now())
+            .execution_options(synchronize_session=False)
+        )
+        alterados += resultado.rowcount
+        # Um evento por dia afetado, não um por agendamento
+        for data in {linha.data_consulta for linha in linhas}:
+            publicar('agendamentos', data=data)
+        marcar_pacientes(db.session.connection(),
+                         select(Agendamento.paciente_id).where(Agendamento.id.in_(ids)))
+
+    if ocorrencias:
+        pedidas = set(ocorrencias)
+        datas = [data for _, data in pedidas]
+        pendentes = [o for o in expandir_recorrencias(min(datas), max(datas))
+                     if (o.recorrencia_id, o.data_consulta) in pedidas]
+        alterados += _inserir_ocorrencias(pendentes, status)
+        for data in {o.data_consulta for o in pendentes}:
+            publicar('agendamentos', data=data)
+        marcar_pacientes(db.session.connection(), {o.paciente_id for o in pendentes})
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise
+    return alterados
+
+
+def encerrar_vencidos(status, ate, desde_recorrencias):
+    """
+    Roll appointments still 'agendada' before ``ate`` over to ``status``.
+
+    Stored rows change with one set-based UPDATE over the
+    (data_consulta, status) index. Pending recurring occurrences from
+    ``desde_recorrencias`` up to the day before ``ate`` are inserted with the
+    same status, so past occurrences stop showing as scheduled.
+    Returns ``(linhas_atualizadas, ocorrencias_inseridas)``.
+    """
+    resultado = db.session.execute(
+        update(Agendamento)
+        .where(Agendamento.status == 'agendada', Agendamento.data_consulta < ate)
+        .values(status=status, atualizado_em=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+    # Pode tocar qualquer dia passado. A versão dos pacientes não muda: as páginas
+    # do prontuário só listam agendamentos a partir de hoje
+    publicar('agendamentos')
+
+    inseridas = 0
+    if desde_recorrencias < ate:
+        inseridas = _inserir_ocorrencias(
+            expandir_recorrencias(desde_recorrencias, ate - timedelta(days=1)), status)
+
+    db.session.commit()
+    return resultado.rowcount, inseridas
+
+
+def preencher_intervalos():
+    """Compute the interval of rows created before the columns existed"""
+    pendentes = Agendamento.query.filter(
+        (Agendamento.inicio_minutos.is_(None)) | (Agendamento.fim_minutos.is_(None))
+    ).all()
+    for agendamento in pendentes:
+        calcular_intervalo(agendamento)
+    if pendentes:
+        db.session.commit()
+        logger.info(f'Computed time interval of {len(pendentes)} appointments')
+
+
+def instalar_restricao_sobreposicao():
+    """
+    On PostgreSQL, add an exclusion constraint rejecting overlapping active
+    appointments. Requires btree_gist; when it cannot be created (missing
+    privileges, overlaps already stored) the advisory lock alone guards writes.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.connect() as conn:
+        existe = conn.execute(text('SELECT 1 FROM pg_constraint WHERE conname = :nome'),
+                              {'nome': RESTRICAO_SOBREPOSICAO}).scalar()
+    if existe:
+        return
+
+    status = ', '.join(f"'{s}'" for s in STATUS_OCUPAM_HORARIO)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS btree_gist'))
+            conn.execute(text(
+                f'ALTER TABLE agendamentos ADD CONSTRAINT {RESTRICAO_SOBREPOSICAO} '
+                f'EXCLUDE USING gist (data_consulta WITH =, '
+                f'int4range(inicio_minutos, fim_minutos) WITH &&) '
+                f'WHERE (status IN ({status}))'
+            ))
+        logger.info(f'Created constraint {RESTRICAO_SOBREPOSICAO}')
+    except DBAPIError as e:
+        logger.warning(f'Could not create constraint {RESTRICAO_SOBREPOSICAO}: {e.orig}')
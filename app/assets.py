@@ -0,0 +1,252 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+import mimetypes
+from flask import current_app, request, send_from_directory, url_for, abort
+
+logger = logging.getLogger(__name__)
+
+# Arquivos compilados ficam em static/dist, com o hash do conteúdo no nome
+PASTA_DIST = 'dist'
+MANIFESTO = 'manifest.json'
+# Extensões processadas pela compilação
+EXTENSOES = ('.css', '.js')
+# Nomes com hash nunca mudam de conteúdo
+CACHE_IMUTAVEL = 'public, max-age=31536000, immutable'
+
+_IDENTIFICADOR = re.compile(r'[\w$\\]')
+# Depois destes caracteres uma barra inicia uma expressão regular, não uma divisão
+_ANTES_DE_REGEX = set('(,=:[!&|?{};+-*%<>~^\n')
+_PALAVRAS_ANTES_DE_REGEX = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'void', 'delete', 'throw')
+
+
+def minificar_js(codigo):
+    """
+    Strip comments and redundant whitespace from JavaScript.
+
+    Line breaks are kept (collapsed to one) so automatic semicolon insertion
+    behaves exactly as in the source; strings, template literals and regex
+    literals are copied untouched.
+    """
+    saida = []
+    i, n = 0, len(codigo)
+    espaco = None  # None, ' ' ou '\n' pendente entre dois tokens
+    ultimo_token = ''
+
+    def anterior():
+        return ultimo_token[-1] if ultimo_token else '\n'
+
+    def emitir(texto):
+        nonlocal espaco, ultimo_token
+        if espaco and saida:
+            ultimo = saida[-1][-1]
+            if espaco == '\n':
+                saida.append('\n')
+            elif (_IDENTIFICADOR.match(ultimo) and _IDENTIFICADOR.match(texto[0])) or \
+                    (ultimo in '+-' and texto[0] in '+-'):
+                saida.append(' ')
+        espaco = None
+        saida.append(texto)
+        ultimo_token = texto
+
+    while i < n:
+        c = codigo[i]
+        if c in ' \t\r\n':
+            j = i
+            while j < n and codigo[j] in ' \t\r\n':
+                j += 1
+            if saida:
+                espaco = '\n' if ('\n' in codigo[i:j] or espaco == '\n') else (espaco or ' ')
+            i = j
+        elif codigo.startswith('//', i):
+            fim = codigo.find('\n', i)
+            i = n if fim == -1 else fim
+        elif codigo.startswith('/*', i):
+            fim = codigo.find('*/', i + 2)
+            trecho = codigo[i:n if fim == -1 else fim + 2]
+            if saida:
+                espaco = '\n' if ('\n' in trecho or espaco == '\n') else (espaco or ' ')
+            i = n if fim == -1 else fim + 2
+        elif c in '\'"`':
+            j = i + 1
+            while j < n and codigo[j] != c:
+                j += 2 if codigo[j] == '\\' else 1
+            emitir(codigo[i:j + 1])
+            i = j + 1
+        elif c == '/' and ultimo_token not in ('++', '--') and \
+                (anterior() in _ANTES_DE_REGEX or ultimo_token in _PALAVRAS_ANTES_DE_REGEX):
+            j, classe = i + 1, False
+            while j < n and (codigo[j] != '/' or classe) and codigo[j] != '\n':
+                if codigo[j] == '\\':
+                    j += 1
+                elif codigo[j] == '[':
+                    classe = True
+                elif codigo[j] == ']':
+                    classe = False
+                j += 1
+            j += 1
+            while j < n and codigo[j].isalpha():
+                j += 1
+            emitir(codigo[i:j])
+            i = j
+        else:
+            j = i + 1
+            if _IDENTIFICADOR.match(c):
+                while j < n and _IDENTIFICADOR.match(codigo[j]):
+                    j += 1
+            elif codigo.startswith(('++', '--'), i):
+                # Um só token: depois de "i++" a barra é divisão, não regex
+                j = i + 2
+            emitir(codigo[i:j])
+            i = j
+    return ''.join(saida) + '\n'
+
+
+def minificar_css(codigo):
+    """Strip comments and whitespace from a stylesheet, leaving strings untouched"""
+    partes = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', codigo)
+    for indice in range(0, len(partes), 2):
+        trecho = re.sub(r'/\*.*?\*/', '', partes[indice], flags=re.S)
+        trecho = re.sub(r'\s+', ' ', trecho)
+        # Não remove o espaço antes de ':' (seletor "a :hover" difere de "a:hover")
+        trecho = re.sub(r'\s*([{};,>])\s*', r'\1', trecho)
+        trecho = re.sub(r':\s+', ':', trecho)
+        partes[indice] = trecho.replace(';}', '}')
+    return ''.join(partes).strip() + '\n'
+
+
+def _comprimir_brotli(dados):
+    try:
+        # brotli is optional: without it only the gzip variant is written
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(dados, quality=11)
+
+
+def compilar_estaticos(raiz, limpar=False):
+    """
+    Build every CSS/JS file below ``raiz`` (the static folder) into
+    ``raiz/dist``: minified, named after a hash of its content, with .gz and
+    .br siblings compressed at the highest level. Writes the manifest that
+    maps source paths to built paths and returns it.
+
+    Files from earlier builds are kept so pages rendered by workers still on
+    the previous release keep working; ``limpar`` removes them.
+    """
+    destino = os.path.join(raiz, PASTA_DIST)
+    manifesto = {}
+    gerados = {MANIFESTO}
+
+    for pasta, subpastas, arquivos in os.walk(raiz):
+        # Não compila a saída nem os uploads
+        subpastas[:] = [s for s in subpastas
+                        if os.path.join(pasta, s) not in (destino, os.path.join(raiz, 'uploads'))]
+        for arquivo in sorted(arquivos):
+            extensao = os.path.splitext(arquivo)[1]
+            if extensao not in EXTENSOES:
+                continue
+            origem = os.path.join(pasta, arquivo)
+            relativo = os.path.relpath(origem, raiz).replace(os.sep, '/')
+
+            with open(origem, encoding='utf-8') as f:
+                codigo = f.read()
+            minificado = (minificar_css if extensao == '.css' else minificar_js)(codigo).encode('utf-8')
+            resumo = hashlib.sha256(minificado).hexdigest()[:12]
+            compilado = f'{os.path.splitext(relativo)[0]}.{resumo}{extensao}'
+
+            caminho = os.path.join(destino, compilado)
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            with open(caminho, 'wb') as f:
+                f.write(minificado)
+            with open(caminho + '.gz', 'wb') as f:
+                # mtime fixo: o mesmo conteúdo gera sempre o mesmo .gz
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+                    gz.write(minificado)
+            gerados.update({compilado, compilado + '.gz'})
+            comprimido = _comprimir_brotli(minificado)
+            if comprimido is not None:
+                with open(caminho + '.br', 'wb') as f:
+                    f.write(comprimido)
+                gerados.add(compilado + '.br')
+
+            manifesto[relativo] = compilado
+            logger.info(f'{relativo} -> {compilado} ({len(codigo.encode())} -> {len(minificado)} bytes)')
+
+    os.makedirs(destino, exist_ok=True)
+    temporario = os.path.join(destino, MANIFESTO + '.tmp')
+    with open(temporario, 'w') as f:
+        json.dump(manifesto, f, indent=2, sort_keys=True)
+    # Troca atômica: um worker nunca lê um manifesto pela metade
+    os.replace(temporario, os.path.join(destino, MANIFESTO))
+
+    if limpar:
+        for pasta, _, arquivos in os.walk(destino):
+            for arquivo in arquivos:
+                caminho = os.path.join(pasta, arquivo)
+                if os.path.relpath(caminho, destino).replace(os.sep, '/') not in gerados:
+                    os.remove(caminho)
+    return manifesto
+
+
+def _manifesto():
+    app = current_app._get_current_object()
+    caminho = os.path.join(app.static_folder, PASTA_DIST, MANIFESTO)
+    try:
+        modificado = os.path.getmtime(caminho)
+    except OSError:
+        return {}
+    atual = app.extensions.get('assets')
+    if atual is None or atual[0] != modificado:
+        with open(caminho) as f:
+            atual = (modificado, json.load(f))
+        app.extensions['assets'] = atual
+    return atual[1]
+
+
+def versao_estaticos():
+    """Identifies the current asset build (changes on every gerar-estaticos)"""
+    _manifesto()
+    atual = current_app.extensions.get('assets')
+    return str(atual[0]) if atual else ''
+
+
+def asset_url(caminho):
+    """
+    URL of a static asset: the hashed build when the manifest has it, the
+    plain static file otherwise (development without a build).
+    """
+    compilado = _manifesto().get(caminho)
+    if compilado is None:
+        return url_for('static', filename=caminho)
+    return url_for('servir_asset', filename=compilado)
+
+
+def servir_asset(filename):
+    """Serve a built asset, pre-compressed when the browser accepts it"""
+    if filename == MANIFESTO:
+        abort(404)
+    pasta = os.path.join(current_app.static_folder, PASTA_DIST)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    arquivo, codificacao = filename, None
+    for extensao, nome in (('.br', 'br'), ('.gz', 'gzip')):
+        if request.accept_encodings[nome] and os.path.isfile(os.path.join(pasta, filename + extensao)):
+            arquivo, codificacao = filename + extensao, nome
+            break
+
+    response = send_from_directory(pasta, arquivo, mimetype=mimetype, max_age=31536000)
+    if codificacao:
+        response.headers['Content-Encoding'] = codificacao
+    response.headers['Cache-Control'] = CACHE_IMUTAVEL
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    """Register the built-asset route and the asset_url template helper"""
+    app.add_url_rule(f'{app.static_url_path}/{PASTA_DIST}/<path:filename>', 'servir_asset', servir_asset)
+    app.jinja_env.globals['asset_url'] = asset_url
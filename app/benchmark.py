@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import platform
+import threading
+import statistics
+import subprocess
+from datetime import date, datetime
+from sqlalchemy import event, func
+from app import db
+from app.models import Usuario, Paciente, Evolucao, Agendamento, FormularioPreConsulta, Radiografia
+from app.cache import get_cache
+
+# Itens por página das listas de pacientes
+POR_PAGINA = 10
+# Diferenças menores que isso são ruído de medição, não regressão
+DIFERENCA_MINIMA_MS = 1.0
+
+
+def rotas_quentes():
+    """
+    The pages users hit all day, as (name, path). Patient pages use the
+    patient with the most clinical notes, the worst case of the dataset.
+    """
+    paciente_id = db.session.query(Evolucao.paciente_id).group_by(Evolucao.paciente_id) \
+        .order_by(func.count(Evolucao.id).desc()).limit(1).scalar() \
+        or db.session.query(func.min(Paciente.id)).scalar()
+    nome = db.session.query(Paciente.nome).filter_by(id=paciente_id).scalar() if paciente_id else None
+    sobrenome = nome.split()[-1] if nome else 'Silva'
+    ultima_pagina = max(1, -(-db.session.query(func.count(Paciente.id)).scalar() // POR_PAGINA))
+    hoje = date.today()
+
+    rotas = [
+        ('dashboard', '/dashboard'),
+        ('pacientes', '/pacientes'),
+        ('pacientes_pagina_final', f'/pacientes?page={ultima_pagina}'),
+        ('busca_nome', f'/pacientes?busca={sobrenome}'),
+        ('busca_cpf', '/pacientes?busca=123.'),
+        ('agenda_dia', f'/agendamentos?data={hoje.isoformat()}'),
+        ('agenda_mes', f'/agendamentos/mes?ano={hoje.year}&mes={hoje.month}'),
+        ('formularios', '/formularios'),
+        ('anamnese_busca', f'/pacientes/anamnese?busca={sobrenome}'),
+    ]
+    if paciente_id:
+        rotas += [
+            ('paciente', f'/pacientes/{paciente_id}'),
+            ('evolucoes', f'/pacientes/{paciente_id}/evolucoes'),
+            ('radiografias', f'/pacientes/{paciente_id}/radiografias'),
+        ]
+    return rotas
+
+
+def tamanho_dados():
+    return {modelo.__tablename__: db.session.query(func.count()).select_from(modelo).scalar()
+            for modelo in (Paciente, Evolucao, Agendamento, FormularioPreConsulta, Radiografia)}
+
+
+def _commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _percentil(valores, fracao):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(fracao * (len(ordenados) - 1))))]
+
+
+def requisitar(cliente, caminho):
+    """
+    GET through the test client in a fresh app context. The CLI command's
+    context would otherwise be reused by every request, sharing the session
+    identity map and the logged-in user (g) between them.
+    """
+    with cliente.application.app_context():
+        resposta = cliente.get(caminho)
+        resposta.get_data()
+    return resposta
+
+
+def medir_rota(cliente, caminho, repeticoes, aquecimento, frio, contador):
+    for _ in range(aquecimento):
+        requisitar(cliente, caminho)
+    tempos, consultas = [], []
+    resposta = None
+    for _ in range(repeticoes):
+        if frio:
+            get_cache().clear()
+        contador[0] = 0
+        inicio = time.perf_counter()
+        resposta = requisitar(cliente, caminho)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        consultas.append(contador[0])
+    return {
+        'status': resposta.status_code,
+        'bytes': len(resposta.get_data()),
+        'consultas': max(consultas),
+        'mediana_ms': round(statistics.median(tempos), 2),
+        'p95_ms': round(_percentil(tempos, 0.95), 2),
+        'min_ms': round(min(tempos), 2),
+        'max_ms': round(max(tempos), 2),
+    }
+
+
+def executar_benchmark(app, repeticoes=20, aquecimento=2, frio=False, filtro=None):
+    """
+    Time every hot route through the test client, logged in as an admin.
+    Returns one result record: environment, dataset size and per-route
+    timings (median, p95, min, max in ms), bytes and SQL statements.
+    """
+    admin = Usuario.query.filter_by(tipo='admin', ativo=True).first()
+    if not admin:
+        raise ValueError('No active admin user to authenticate the requests')
+    rotas = [(nome, caminho) for nome, caminho in rotas_quentes() if not filtro or nome in filtro]
+    dados = tamanho_dados()
+    db.session.remove()
+
+    cliente = app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['_user_id'] = str(admin.id)
+        sessao['_fresh'] = True
+
+    contador = [0]
+    thread = threading.get_ident()
+
+    def contar(*args):
+        # As threads de invalidação e de tarefas usam o mesmo engine
+        if threading.get_ident() == thread:
+            contador[0] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', contar)
+    try:
+        resultados = {nome: {'caminho': caminho, **medir_rota(cliente, caminho, repeticoes, aquecimento, frio, contador)}
+                      for nome, caminho in rotas}
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', contar)
+
+    return {
+        'executado_em': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit_atual(),
+        'python': platform.python_version(),
+        'banco': db.engine.dialect.name,
+        'cache': app.config['CACHE_BACKEND'],
+        'frio': frio,
+        'repeticoes': repeticoes,
+        'dados': dados,
+        'rotas': resultados,
+    }
+
+
+def ultimo_resultado(arquivo):
+    """Last record stored in the JSONL results file, or None"""
+    if not os.path.exists(arquivo):
+        return None
+    ultimo = None
+    with open(arquivo) as f:
+        for linha in f:
+            if linha.strip():
+                ultimo = linha
+    return json.loads(ultimo) if ultimo else None
+
+
+def salvar_resultado(arquivo, resultado):
+    with open(arquivo, 'a') as f:
+        f.write(json.dumps(resultado, ensure_ascii=False) + '\n')
+
+
+def comparar(atual, anterior, limite):
+    """
+    Routes whose median got more than ``limite`` (a fraction) slower than in
+    ``anterior``, or that now run more SQL statements, as
+    (name, previous ms, current ms, previous statements, current statements).
+    """
+    regressoes = []
+    for nome, dados in atual['rotas'].items():
+        antes = anterior['rotas'].get(nome)
+        if not antes:
+            continue
+        mais_lenta = dados['mediana_ms'] > antes['mediana_ms'] * (1 + limite) and \
+            dados['mediana_ms'] - antes['mediana_ms'] >= DIFERENCA_MINIMA_MS
+        if mais_lenta or dados['consultas'] > antes['consultas']:
+            regressoes.append((nome, antes['mediana_ms'], dados['mediana_ms'], antes['consultas'], dados['consultas']))
+    return regressoes
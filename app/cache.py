@@ -0,0 +1,393 @@
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Marca de "não está no cache" (None é um valor válido)
+AUSENTE = object()
+
+# Tempo máximo que um cálculo segura a trava de single-flight
+TEMPO_TRAVA = 30
+# Intervalo entre verificações de quem espera o cálculo de outro processo
+ESPERA_TRAVA = 0.05
+
+
+class CacheError(Exception):
+    pass
+
+
+def _versao_inicial():
+    # Versões partem do relógio: um grupo perdido (reinício, despejo) nunca volta
+    # a um número já usado e não reaproveita chaves antigas
+    return int(time.time() * 1000)
+
+
+class Cache(ABC):
+    """
+    Base interface for cached values.
+
+    Every value has a TTL. Group versions (``versao``/``invalidar``) are kept
+    apart from the values and are never evicted: keys embed the versions of
+    the groups they depend on, so bumping a group makes all of its keys
+    unreachable at once and they simply age out.
+    """
+
+    # True quando todos os workers de todos os nós enxergam o mesmo cache
+    compartilhado = False
+
+    @abstractmethod
+    def get(self, key):
+        """Return the value stored under ``key`` or ``AUSENTE``"""
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Store ``value`` under ``key`` for ``ttl`` seconds"""
+
+    @abstractmethod
+    def add(self, key, value, ttl):
+        """Store ``value`` only if ``key`` is absent; return whether it was stored"""
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove ``key``"""
+
+    @abstractmethod
+    def clear(self):
+        """Remove every value and group version"""
+
+    @abstractmethod
+    def versao(self, grupo):
+        """Current version of ``grupo``"""
+
+    @abstractmethod
+    def invalidar(self, grupo):
+        """Bump the version of ``grupo``"""
+
+    def get_or_set(self, key, funcao, ttl):
+        """
+        Return the cached value of ``key``, computing it with ``funcao`` on a miss.
+
+        Only one caller computes a missing key (single-flight): concurrent
+        callers, in this or another worker, wait for the value instead of
+        running the same expensive query. If the computing caller does not
+        finish within TEMPO_TRAVA, the others compute on their own.
+        """
+        valor = self.get(key)
+        if valor is not AUSENTE:
+            return valor
+
+        trava = f'{key}:trava'
+        limite = time.monotonic() + TEMPO_TRAVA
+        while True:
+            if self.add(trava, 1, TEMPO_TRAVA):
+                try:
+                    # Outro processo pode ter terminado entre o get e a trava
+                    valor = self.get(key)
+                    if valor is AUSENTE:
+                        valor = funcao()
+                        self.set(key, valor, ttl)
+                    return valor
+                finally:
+                    self.delete(trava)
+
+            time.sleep(ESPERA_TRAVA)
+            valor = self.get(key)
+            if valor is not AUSENTE:
+                return valor
+            if time.monotonic() > limite:
+                logger.warning(f'Cache lock on {key} timed out, computing without it')
+                return funcao()
+
+
+class MemoryCache(Cache):
+    """Per-process LRU cache bounded by number of entries"""
+
+    def __init__(self, max_itens=1000):
+        self.max_itens = max_itens
+        self.lock = threading.Lock()
+        self.itens = OrderedDict()  # chave -> (expira, valor)
+        self.versoes = {}
+
+    def _vivo(self, key, agora):
+        item = self.itens.get(key)
+        if item is None:
+            return None
+        if item[0] <= agora:
+            del self.itens[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self.lock:
+            item = self._vivo(key, time.monotonic())
+            if item is None:
+                return AUSENTE
+            self.itens.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.itens[key] = (time.monotonic() + ttl, value)
+            self.itens.move_to_end(key)
+            while len(self.itens) > self.max_itens:
+                self.itens.popitem(last=False)
+
+    def add(self, key, value, ttl):
+        with self.lock:
+            if self._vivo(key, time.monotonic()) is not None:
+                return False
+            self.itens[key] = (time.monotonic() + ttl, value)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.itens.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.itens.clear()
+            self.versoes.clear()
+
+    def versao(self, grupo):
+        with self.lock:
+            return self.versoes.setdefault(grupo, _versao_inicial())
+
+    def invalidar(self, grupo):
+        with self.lock:
+            self.versoes[grupo] = self.versoes.get(grupo, _versao_inicial()) + 1
+
+
+class RedisCache(Cache):
+    """
+    Cache on a Redis-compatible server, shared by every worker and node.
+
+    Size is bounded by the server (``maxmemory`` with an LRU policy); every
+    value is written with its TTL.
+    """
+
+    compartilhado = True
+
+    def __init__(self, url, prefixo='clinica:'):
+        # redis is only needed when this backend is configured
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefixo = prefixo
+
+    def _chave(self, key):
+        return f'{self.prefixo}{key}'
+
+    def get(self, key):
+        dados = self.client.get(self._chave(key))
+        return AUSENTE if dados is None else pickle.loads(dados)
+
+    def set(self, key, value, ttl):
+        self.client.set(self._chave(key), pickle.dumps(value), px=int(ttl * 1000))
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self._chave(key), pickle.dumps(value), px=int(ttl * 1000), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self._chave(key))
+
+    def clear(self):
+        for chave in self.client.scan_iter(match=f'{self.prefixo}*', count=1000):
+            self.client.delete(chave)
+
+    def versao(self, grupo):
+        chave = self._chave(f'versao:{grupo}')
+        valor = self.client.get(chave)
+        if valor is None:
+            self.client.set(chave, _versao_inicial(), nx=True)
+            valor = self.client.get(chave)
+        return int(valor)
+
+    def invalidar(self, grupo):
+        chave = self._chave(f'versao:{grupo}')
+        self.client.set(chave, _versao_inicial(), nx=True)
+        self.client.incr(chave)
+
+
+class FileCache(Cache):
+    """
+    Cache in a local SQLite file, shared by the workers of one node.
+
+    When the file holds more than ``max_itens`` entries the ones closest to
+    expiring are evicted. Other nodes have their own file, so every worker
+    applies every change event (not ``compartilhado``).
+    """
+
+    def __init__(self, caminho, max_itens=1000):
+        self.caminho = caminho
+        self.max_itens = max_itens
+        self.local = threading.local()
+        self.gravacoes = 0
+        with self._conexao() as conexao:
+            conexao.execute('CREATE TABLE IF NOT EXISTS cache '
+                            '(chave TEXT PRIMARY KEY, valor BLOB NOT NULL, expira REAL NOT NULL)')
+            conexao.execute('CREATE INDEX IF NOT EXISTS ix_cache_expira ON cache (expira)')
+            conexao.execute('CREATE TABLE IF NOT EXISTS versoes (grupo TEXT PRIMARY KEY, valor INTEGER NOT NULL)')
+
+    def _conexao(self, escrita=True):
+        conexao = getattr(self.local, 'conexao', None)
+        if conexao is None:
+            conexao = sqlite3.connect(self.caminho, timeout=10, isolation_level=None)
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('PRAGMA synchronous=NORMAL')
+            self.local.conexao = conexao
+        return _Transacao(conexao, escrita)
+
+    def get(self, key):
+        with self._conexao(escrita=False) as conexao:
+            linha = conexao.execute('SELECT valor FROM cache WHERE chave = ? AND expira > ?',
+                                    (key, time.time())).fetchone()
+        return AUSENTE if linha is None else pickle.loads(linha[0])
+
+    def set(self, key, value, ttl):
+        agora = time.time()
+        with self._conexao() as conexao:
+            conexao.execute('INSERT OR REPLACE INTO cache (chave, valor, expira) VALUES (?, ?, ?)',
+                            (key, pickle.dumps(value), agora + ttl))
+            self.gravacoes += 1
+            if self.gravacoes % 100 == 0:
+                self._limitar(conexao, agora)
+
+    def _limitar(self, conexao, agora):
+        conexao.execute('DELETE FROM cache WHERE expira <= ?', (agora,))
+        excesso = conexao.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_itens
+        if excesso > 0:
+            conexao.execute('DELETE FROM cache WHERE chave IN '
+                            '(SELECT chave FROM cache ORDER BY expira LIMIT ?)', (excesso,))
+
+    def add(self, key, value, ttl):
+        agora = time.time()
+        with self._conexao() as conexao:
+            conexao.execute('DELETE FROM cache WHERE chave = ? AND expira <= ?', (key, agora))
+            cursor = conexao.execute('INSERT OR IGNORE INTO cache (chave, valor, expira) VALUES (?, ?, ?)',
+                                     (key, pickle.dumps(value), agora + ttl))
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self._conexao() as conexao:
+            conexao.execute('DELETE FROM cache WHERE chave = ?', (key,))
+
+    def clear(self):
+        with self._conexao() as conexao:
+            conexao.execute('DELETE FROM cache')
+            conexao.execute('DELETE FROM versoes')
+
+    def versao(self, grupo):
+        with self._conexao() as conexao:
+            conexao.execute('INSERT OR IGNORE INTO versoes (grupo, valor) VALUES (?, ?)',
+                            (grupo, _versao_inicial()))
+            return conexao.execute('SELECT valor FROM versoes WHERE grupo = ?', (grupo,)).fetchone()[0]
+
+    def invalidar(self, grupo):
+        with self._conexao() as conexao:
+            conexao.execute('INSERT INTO versoes (grupo, valor) VALUES (?, ?) '
+                            'ON CONFLICT (grupo) DO UPDATE SET valor = valor + 1',
+                            (grupo, _versao_inicial()))
+
+
+class _Transacao:
+    """
+    Transaction around a block. Writes start with BEGIN IMMEDIATE so that
+    concurrent writers queue on the busy timeout instead of failing.
+    """
+
+    def __init__(self, conexao, escrita):
+        self.conexao = conexao
+        self.escrita = escrita
+
+    def __enter__(self):
+        self.conexao.execute('BEGIN IMMEDIATE' if self.escrita else 'BEGIN')
+        return self.conexao
+
+    def __exit__(self, tipo, valor, traceback):
+        self.conexao.execute('ROLLBACK' if tipo else 'COMMIT')
+
+
+# --- Invalidação pelos eventos de alteração ----------------------------------
+
+def grupos_do_evento(evento):
+    """
+    Cache groups touched by a change event: the table and, for dated rows,
+    the month (``agendamentos:2024-05``) or ``agendamentos:*`` when the day is
+    not known.
+    """
+    if evento.data:
+        return (evento.modelo, f'{evento.modelo}:{evento.data:%Y-%m}')
+    return (evento.modelo, f'{evento.modelo}:*')
+
+
+def grupos_mes(ano, mes):
+    """Groups a per-month aggregate of the agenda depends on"""
+    return (f'agendamentos:{ano:04d}-{mes:02d}', 'agendamentos:*', 'recorrencias_agendamento')
+
+
+def _invalidar_eventos(cache, eventos):
+    if any(evento.modelo == '*' for evento in eventos):
+        cache.clear()
+        return
+    for grupo in {g for evento in eventos for g in grupos_do_evento(evento)}:
+        cache.invalidar(grupo)
+
+
+def init_cache(app):
+    """Create the cache backend configured for ``app`` and hook it to the invalidation bus"""
+    backend = app.config.get('CACHE_BACKEND', 'memory')
+
+    if backend == 'redis':
+        cache = RedisCache(app.config['CACHE_REDIS_URL'], prefixo=app.config.get('CACHE_PREFIXO', 'clinica:'))
+    elif backend == 'file':
+        cache = FileCache(app.config['CACHE_ARQUIVO'], max_itens=app.config['CACHE_MAX_ITENS'])
+    elif backend == 'memory':
+        cache = MemoryCache(max_itens=app.config['CACHE_MAX_ITENS'])
+    else:
+        raise CacheError(f'Unknown cache backend: {backend}')
+
+    # Num cache compartilhado basta o worker que gravou invalidar
+    app.extensions['invalidacao'].assinar(lambda eventos: _invalidar_eventos(cache, eventos),
+                                          remotos=not cache.compartilhado)
+    app.extensions['cache'] = cache
+    app.logger.info(f'Using {backend} cache backend')
+    return cache
+
+
+def get_cache():
+    return current_app.extensions['cache']
+
+
+def cached(ttl=None, grupos=(), nome=None):
+    """
+    Cache the return value of a function, keyed by its arguments.
+
+    ``grupos`` lists the cache groups (table names, see ``grupos_do_evento``)
+    the value depends on, or is a function of the same arguments returning
+    them; any committed change to those tables makes the cached value stale.
+    Values must be picklable for the shared backends: cache plain data, not
+    ORM objects. ``ttl`` defaults to CACHE_TTL.
+    """
+    def decorator(funcao):
+        prefixo = nome or f'{funcao.__module__}.{funcao.__qualname__}'
+
+        @wraps(funcao)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            dependencias = grupos(*args, **kwargs) if callable(grupos) else grupos
+            versoes = ','.join(str(cache.versao(g)) for g in dependencias)
+            argumentos = hashlib.md5(repr((args, sorted(kwargs.items()))).encode()).hexdigest()
+            chave = f'{prefixo}:{versoes}:{argumentos}'
+            return cache.get_or_set(chave, lambda: funcao(*args, **kwargs),
+                                    ttl or current_app.config['CACHE_TTL'])
+
+        wrapper.sem_cache = funcao
+        return wrapper
+    return decorator
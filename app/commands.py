@@ -0,0 +1,309 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+import click
+from app import db
+
+
+def _formatar_bytes(valor):
+    for unidade in ('B', 'KB', 'MB', 'GB'):
+        if abs(valor) < 1024:
+            return f'{valor:.1f} {unidade}'
+        valor /= 1024
+    return f'{valor:.1f} TB'
+
+
+def register_commands(app):
+
+    @app.cli.command('limpar-uploads')
+    @click.option('--carencia-horas', default=24, show_default=True,
+                  help='Mantém arquivos órfãos mais novos que este período.')
+    @click.option('--simular', is_flag=True, help='Apenas lista os órfãos, sem remover.')
+    def limpar_uploads(carencia_horas, simular):
+        """Remove arquivos de upload que nenhum registro referencia."""
+        from app.upload_gc import coletar_orfaos
+
+        stats = coletar_orfaos(carencia=timedelta(hours=carencia_horas), simular=simular)
+        acao = 'seriam liberados' if simular else 'liberados'
+        click.echo(f"{stats['verificados']} arquivos verificados ({_formatar_bytes(stats['bytes_total'])}), "
+                   f"{stats['orfaos']} órfãos, {_formatar_bytes(stats['bytes_liberados'])} {acao}.")
+
+    @app.cli.command('uso-armazenamento')
+    @click.option('--recalcular', is_flag=True, help='Reconstrói os totais a partir das radiografias.')
+    @click.option('--top', default=10, show_default=True, help='Quantidade de pacientes listados.')
+    def uso_armazenamento(recalcular, top):
+        """Mostra o uso de armazenamento total e por paciente."""
+        from app.models import Paciente, UsoArmazenamento
+        from app.upload_gc import recalcular_uso, uso_total
+
+        if recalcular:
+            click.echo(f'Totais recalculados para {recalcular_uso()} pacientes.')
+
+        total_bytes, total_arquivos = uso_total()
+        click.echo(f'Total: {_formatar_bytes(total_bytes)} em {total_arquivos} arquivos')
+
+        maiores = db.session.query(Paciente.id, Paciente.nome, UsoArmazenamento.total_bytes,
+                                   UsoArmazenamento.total_arquivos) \
+            .join(UsoArmazenamento, UsoArmazenamento.paciente_id == Paciente.id) \
+            .order_by(UsoArmazenamento.total_bytes.desc()).limit(top)
+        for paciente_id, nome, total, arquivos in maiores:
+            click.echo(f'  #{paciente_id} {nome}: {_formatar_bytes(total)} ({arquivos} arquivos)')
+
+    @app.cli.command('extrair-metadados')
+    @click.option('--reprocessar', is_flag=True, help='Reextrai os metadados de todas as radiografias.')
+    def extrair_metadados(reprocessar):
+        """Extrai metadados (EXIF/TIFF/DICOM) das radiografias pendentes."""
+        from app.radiograph_metadata import extrair_radiografia, ids_pendentes
+
+        ids = ids_pendentes(reprocessar=reprocessar)
+        resultados = {}
+        with click.progressbar(ids, label=f'{len(ids)} radiografias') as barra:
+            for radiografia_id in barra:
+                status = extrair_radiografia(radiografia_id)
+                resultados[status] = resultados.get(status, 0) + 1
+                db.session.expunge_all()
+        click.echo(', '.join(f'{status}: {total}' for status, total in resultados.items()) or 'Nada a processar.')
+
+    @app.cli.command('enviar-lembretes')
+    @click.option('--dias', default=1, show_default=True, help='Antecedência, em dias, das consultas lembradas.')
+    @click.option('--simular', is_flag=True, help='Apenas lista os lembretes, sem enviar SMS.')
+    def enviar_lembretes(dias, simular):
+        """Envia SMS de lembrete para as consultas agendadas (inclusive recorrentes)."""
+        from datetime import date
+        from app.agenda import agenda_do_periodo
+        from app.notifications import send_lembrete_consulta_sms
+
+        data = date.today() + timedelta(days=dias)
+        enviados = sem_telefone = 0
+        for agendamento in agenda_do_periodo(data, data, status='agendada'):
+            paciente = agendamento.paciente
+            if not paciente.telefone:
+                sem_telefone += 1
+                continue
+            if simular:
+                click.echo(f'{agendamento.hora_consulta} {paciente.nome} ({paciente.telefone})')
+            elif not send_lembrete_consulta_sms(paciente.telefone, paciente.nome.split()[0],
+                                                data.strftime('%d/%m/%Y'), agendamento.hora_consulta):
+                continue
+            enviados += 1
+
+        acao = 'seriam enviados' if simular else 'enviados'
+        click.echo(f'{data.strftime("%d/%m/%Y")}: {enviados} lembretes {acao}, {sem_telefone} pacientes sem telefone.')
+
+    @app.cli.command('encerrar-agendamentos')
+    @click.option('--status', default=None,
+                  help='Status aplicado (padrão: AGENDA_STATUS_VENCIDOS).')
+    @click.option('--dias', default=0, show_default=True,
+                  help='Mantém como agendadas as consultas dos últimos N dias antes de hoje.')
+    @click.option('--dias-recorrencias', default=7, show_default=True,
+                  help='Quantos dias para trás as ocorrências recorrentes pendentes são encerradas.')
+    def encerrar_agendamentos(status, dias, dias_recorrencias):
+        """Encerra consultas passadas que continuam como agendadas (rodar todas as noites)."""
+        from datetime import date
+        from app.agenda import encerrar_vencidos, STATUS_EM_LOTE
+
+        status = status or app.config['AGENDA_STATUS_VENCIDOS']
+        if status not in STATUS_EM_LOTE:
+            raise click.BadParameter(f'use um de: {", ".join(STATUS_EM_LOTE)}', param_hint='--status')
+
+        ate = date.today() - timedelta(days=dias)
+        atualizados, inseridas = encerrar_vencidos(status, ate, ate - timedelta(days=dias_recorrencias))
+        click.echo(f'Consultas anteriores a {ate.strftime("%d/%m/%Y")} marcadas como {status}: '
+                   f'{atualizados} agendamentos e {inseridas} ocorrências recorrentes.')
+
+    @app.cli.command('gerar-estaticos')
+    @click.option('--limpar', is_flag=True, help='Remove arquivos de compilações anteriores.')
+    def gerar_estaticos(limpar):
+        """Minifica, aplica hash e pré-comprime CSS/JS em static/dist (rodar a cada deploy)."""
+        from app.assets import compilar_estaticos, PASTA_DIST
+
+        manifesto = compilar_estaticos(app.static_folder, limpar=limpar)
+        for origem, compilado in sorted(manifesto.items()):
+            click.echo(f'  {origem} -> {PASTA_DIST}/{compilado}')
+        try:
+            import brotli
+        except ImportError:
+            click.echo('Pacote brotli não instalado: apenas versões gzip foram geradas.')
+        click.echo(f'{len(manifesto)} arquivos compilados.')
+
+    @app.cli.command('medir-compressao')
+    @click.option('--rota', 'rotas', multiple=True, help='Caminho a medir (pode repetir; padrão: páginas principais).')
+    @click.option('--repeticoes', default=20, show_default=True, help='Requisições por rota e codificação.')
+    @click.option('--banda-kbps', default=2000, show_default=True,
+                  help='Velocidade do link usada para estimar o tempo de transferência.')
+    def medir_compressao(rotas, repeticoes, banda_kbps):
+        """Compara bytes e tempo de resposta com e sem compressão, por rota."""
+        import time
+        import statistics
+        from app.models import Usuario, Paciente
+        from app.compression import modulo_brotli
+
+        admin = Usuario.query.filter_by(tipo='admin', ativo=True).first()
+        if not admin:
+            raise click.ClickException('nenhum usuário administrador ativo para autenticar as requisições.')
+        paciente = Paciente.query.first()
+        rotas = rotas or ['/dashboard', '/pacientes', '/agendamentos', '/agendamentos/mes', '/formularios'] + \
+            ([f'/pacientes/{paciente.id}'] if paciente else [])
+        codificacoes = ['identity', 'gzip'] + (['br'] if modulo_brotli() else [])
+        db.session.remove()
+
+        cliente = app.test_client()
+        with cliente.session_transaction() as sessao:
+            sessao['_user_id'] = str(admin.id)
+            sessao['_fresh'] = True
+
+        click.echo(f'{"rota":<28} {"codificação":<11} {"bytes":>9} {"servidor ms":>12} '
+                   f'{"transferência ms":>17} {"total ms":>9} {"economia ms":>12}')
+        for rota in rotas:
+            base = None
+            for codificacao in codificacoes:
+                tempos, tamanho, status = [], 0, None
+                for _ in range(repeticoes):
+                    inicio = time.perf_counter()
+                    resposta = cliente.get(rota, headers={'Accept-Encoding': codificacao})
+                    tamanho = len(resposta.get_data())
+                    tempos.append((time.perf_counter() - inicio) * 1000)
+                    status = resposta.status_code
+                servidor = statistics.median(tempos)
+                transferencia = tamanho * 8 / banda_kbps
+                total = servidor + transferencia
+                if base is None:
+                    base = (tamanho, total)
+                economia = f'{base[1] - total:.1f} ({100 - 100 * tamanho / base[0]:.0f}% bytes)' \
+                    if codificacao != 'identity' and base[0] else '-'
+                click.echo(f'{rota:<28} {codificacao:<11} {tamanho:>9} {servidor:>12.2f} '
+                           f'{transferencia:>17.1f} {total:>9.1f} {economia:>12}' +
+                           (f'  [HTTP {status}]' if status != 200 else ''))
+
+    @app.cli.command('gerar-dados')
+    @click.option('--pacientes', default=1000, show_default=True, help='Pacientes gerados.')
+    @click.option('--evolucoes', default=10000, show_default=True, help='Evoluções clínicas geradas.')
+    @click.option('--agendamentos', default=5000, show_default=True, help='Agendamentos gerados.')
+    @click.option('--formularios', default=1000, show_default=True, help='Formulários de pré-consulta gerados.')
+    @click.option('--radiografias', default=200, show_default=True,
+                  help='Radiografias geradas (cada uma grava um arquivo no storage).')
+    @click.option('--semente', default=42, show_default=True, help='Semente aleatória (mesma semente, mesmos dados).')
+    @click.option('--lote', default=5000, show_default=True, help='Linhas por INSERT.')
+    @click.option('--dias-passados', default=730, show_default=True, help='Período passado coberto pelos registros.')
+    @click.option('--dias-futuros', default=90, show_default=True, help='Agendamentos futuros até N dias.')
+    @click.option('--sim', is_flag=True, help='Não pede confirmação.')
+    def gerar_dados(pacientes, evolucoes, agendamentos, formularios, radiografias, semente, lote,
+                    dias_passados, dias_futuros, sim):
+        """Popula o banco com dados sintéticos de uma clínica (apenas para desenvolvimento e testes de carga)."""
+        from app.dataset import GeradorDados
+
+        if not sim:
+            click.confirm(f'Gerar dados sintéticos em {db.engine.url.render_as_string(hide_password=True)}?',
+                          abort=True)
+        gerador = GeradorDados(semente=semente, lote=lote, dias_passados=dias_passados,
+                               dias_futuros=dias_futuros, progresso=click.echo)
+        try:
+            resultado = gerador.gerar(pacientes, evolucoes, agendamentos, formularios, radiografias)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(', '.join(f'{tabela}: {total}' for tabela, total in resultado.items()))
+
+    @app.cli.command('benchmark')
+    @click.option('--repeticoes', default=20, show_default=True, help='Requisições medidas por rota.')
+    @click.option('--aquecimento', default=2, show_default=True, help='Requisições descartadas antes de medir.')
+    @click.option('--rota', 'rotas', multiple=True, help='Mede só as rotas com este nome (pode repetir).')
+    @click.option('--frio', is_flag=True, help='Esvazia o cache antes de cada requisição.')
+    @click.option('--saida', default='benchmarks.jsonl', show_default=True,
+                  help='Arquivo JSONL onde cada execução é acrescentada.')
+    @click.option('--limite', default=0.2, show_default=True,
+                  help='Aumento da mediana (fração) considerado regressão.')
+    @click.option('--falhar-em-regressao', is_flag=True, help='Termina com erro se houver regressão.')
+    def benchmark(repeticoes, aquecimento, rotas, frio, saida, limite, falhar_em_regressao):
+        """Mede as rotas mais usadas e compara com a execução anterior gravada em --saida."""
+        from app.benchmark import executar_benchmark, ultimo_resultado, salvar_resultado, comparar
+
+        try:
+            resultado = executar_benchmark(app, repeticoes=repeticoes, aquecimento=aquecimento,
+                                           frio=frio, filtro=set(rotas))
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        anterior = ultimo_resultado(saida)
+
+        click.echo('Dados: ' + ', '.join(f'{tabela}: {total}' for tabela, total in resultado['dados'].items()))
+        click.echo(f'{"rota":<24} {"status":>6} {"SQL":>4} {"bytes":>8} {"mediana ms":>11} {"p95 ms":>8} '
+                   f'{"anterior ms":>12}')
+        for nome, dados in resultado['rotas'].items():
+            antes = anterior['rotas'].get(nome, {}).get('mediana_ms') if anterior else None
+            click.echo(f'{nome:<24} {dados["status"]:>6} {dados["consultas"]:>4} {dados["bytes"]:>8} '
+                       f'{dados["mediana_ms"]:>11.2f} {dados["p95_ms"]:>8.2f} '
+                       f'{antes if antes is not None else "-":>12}')
+        salvar_resultado(saida, resultado)
+
+        if anterior is None:
+            return
+        if anterior['dados'] != resultado['dados']:
+            click.echo('Atenção: a execução anterior usou outro volume de dados; compare com cuidado.')
+        regressoes = comparar(resultado, anterior, limite)
+        for nome, antes_ms, agora_ms, antes_sql, agora_sql in regressoes:
+            click.echo(f'REGRESSÃO {nome}: {antes_ms:.2f} -> {agora_ms:.2f} ms, {antes_sql} -> {agora_sql} consultas')
+        if regressoes and falhar_em_regressao:
+            raise SystemExit(1)
+
+    @app.cli.command('verificar-consultas')
+    @click.option('--banco', help='URL de um banco vazio (ex.: PostgreSQL local); padrão: SQLite temporário.')
+    @click.option('--rodadas', default=2, show_default=True,
+                  help='Vezes que os dados são gerados; cada rodada mede todas as rotas de novo.')
+    @click.option('--rota', 'rotas', multiple=True, help='Verifica só as rotas com este nome (pode repetir).')
+    @click.option('--mostrar-sql', is_flag=True, help='Lista as consultas de todas as rotas, não só das que falharam.')
+    def verificar_consultas(banco, rodadas, rotas, mostrar_sql):
+        """Confere o número de consultas SQL de cada rota com o orçamento declarado em app/query_budget.py."""
+        from app import create_app
+        from app.query_budget import verificar_orcamentos
+
+        pasta = tempfile.mkdtemp(prefix='clinica-consultas-')
+        config = {
+            'SQLALCHEMY_DATABASE_URI': banco or f'sqlite:///{os.path.join(pasta, "clinica.sqlite3")}',
+            'STORAGE_BACKEND': 'local',
+            'UPLOAD_ROOT': os.path.join(pasta, 'uploads'),
+            'CACHE_BACKEND': 'memory',
+            'TRACING_DESTINO': '',
+        }
+        try:
+            verificacao = create_app(config)
+            with verificacao.app_context():
+                medicoes = verificar_orcamentos(verificacao, rodadas=max(rodadas, 1), filtro=set(rotas),
+                                                progresso=click.echo)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+
+        click.echo(f'{"rota":<24} {"status":>10} {"consultas por rodada":>22} {"orçamento":>10}')
+        for medicao in medicoes:
+            orcamento = medicao.orcamento if medicao.orcamento is not None else '-'
+            click.echo(f'{medicao.nome:<24} {"/".join(map(str, medicao.status)):>10} '
+                       f'{" -> ".join(str(len(c)) for c in medicao.consultas):>22} {orcamento:>10}'
+                       f'  {"FALHOU" if medicao.falhou else "ok"}')
+
+        falhas = [medicao for medicao in medicoes if medicao.falhou]
+        for medicao in medicoes:
+            if medicao not in falhas and not mostrar_sql:
+                continue
+            click.echo(f'\n{medicao.nome} ({medicao.caminhos[-1]})')
+            if medicao.orcamento is None:
+                click.echo('  sem orçamento declarado em ORCAMENTOS')
+            if medicao.excedeu:
+                click.echo(f'  {medicao.maximo} consultas, orçamento de {medicao.orcamento}')
+            if medicao.cresceu:
+                click.echo('  o número de consultas cresceu com o volume de dados; consultas a mais:')
+                for vezes, sql in medicao.acrescidas():
+                    click.echo(f'    +{vezes}  {sql}')
+            if any(status >= 500 for status in medicao.status):
+                click.echo(f'  erro HTTP {max(medicao.status)}')
+            repetidas = medicao.repetidas()
+            if repetidas:
+                click.echo('  consultas repetidas (provável N+1):')
+                for vezes, sql in repetidas:
+                    click.echo(f'    {vezes}x  {sql}')
+            if medicao.excedeu or mostrar_sql:
+                click.echo('  todas as consultas da última rodada:')
+                for numero, sql in enumerate(medicao.consultas[-1], 1):
+                    click.echo(f'    {numero:>3}. {" ".join(sql.split())}')
+        if falhas:
+            raise SystemExit(1)
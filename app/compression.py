@@ -0,0 +1,172 @@
+import zlib
+
+# Tipos que valem a pena comprimir (texto); imagens, ZIPs e PDFs já são comprimidos
+TIPOS_COMPRIMIVEIS = {
+    'text/html', 'text/plain', 'text/css', 'text/javascript', 'text/calendar', 'text/csv',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+}
+# Streams de longa duração: cada evento precisa chegar na hora, sem buffer do compressor
+TIPOS_STREAMING = {'text/event-stream'}
+
+
+def _aceita(accept_encoding, codificacao):
+    """Whether the Accept-Encoding header allows ``codificacao`` (q > 0)"""
+    for item in accept_encoding.split(','):
+        nome, _, parametros = item.strip().partition(';')
+        if nome.strip().lower() not in (codificacao, '*'):
+            continue
+        parametros = parametros.replace(' ', '')
+        if parametros.startswith('q='):
+            try:
+                return float(parametros[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def _com_vary(headers):
+    """``headers`` with Accept-Encoding added to Vary"""
+    novos = []
+    tem_vary = False
+    for nome, valor in headers:
+        if nome.lower() == 'vary':
+            tem_vary = True
+            if 'accept-encoding' not in valor.lower() and valor.strip() != '*':
+                valor = f'{valor}, Accept-Encoding'
+        novos.append((nome, valor))
+    if not tem_vary:
+        novos.append(('Vary', 'Accept-Encoding'))
+    return novos
+
+
+def modulo_brotli():
+    try:
+        # brotli is optional: without it responses are compressed with gzip only
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+class _Gzip:
+    def __init__(self, nivel):
+        self.compressor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+
+    def comprimir(self, dados, descarregar):
+        saida = self.compressor.compress(dados)
+        if descarregar:
+            saida += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return saida
+
+    def finalizar(self):
+        return self.compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, modulo, nivel):
+        self.compressor = modulo.Compressor(quality=nivel)
+
+    def comprimir(self, dados, descarregar):
+        saida = self.compressor.process(dados)
+        if descarregar:
+            saida += self.compressor.flush()
+        return saida
+
+    def finalizar(self):
+        return self.compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    WSGI middleware compressing text responses with brotli or gzip.
+
+    The encoding is negotiated from Accept-Encoding (brotli preferred when
+    the package is installed). Only the types in TIPOS_COMPRIMIVEIS are
+    compressed, and only above ``minimo`` bytes when the length is known.
+    Responses already encoded (pre-compressed static assets), marked
+    ``no-transform``, event streams, HEAD requests and bodiless statuses
+    pass through untouched. Every response of a compressible type carries
+    ``Vary: Accept-Encoding``, compressed or not, so a shared cache never
+    serves the identity copy to clients that asked for gzip or brotli.
+
+    The body is compressed chunk by chunk as the application yields it, so
+    streamed responses stay streamed; when the length is unknown every
+    chunk is flushed so the client sees it without waiting for the next.
+    """
+
+    def __init__(self, app, minimo=1024, nivel_gzip=6, nivel_brotli=4):
+        self.app = app
+        self.minimo = minimo
+        self.nivel_gzip = nivel_gzip
+        self.nivel_brotli = nivel_brotli
+        self.brotli = modulo_brotli()
+
+    def _escolher(self, environ):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accept = environ.get('HTTP_ACCEPT_ENCODING', '')
+        if self.brotli and _aceita(accept, 'br'):
+            return 'br'
+        if _aceita(accept, 'gzip'):
+            return 'gzip'
+        return None
+
+    @staticmethod
+    def _varia(headers):
+        """Whether the body of this response depends on Accept-Encoding"""
+        valores = {nome.lower(): valor for nome, valor in headers}
+        tipo = valores.get('content-type', '').split(';')[0].strip().lower()
+        if tipo in TIPOS_STREAMING or tipo not in TIPOS_COMPRIMIVEIS:
+            return False
+        return 'content-encoding' not in valores and 'no-transform' not in valores.get('cache-control', '')
+
+    def _comprimivel(self, status, headers):
+        codigo = int(status.split(' ', 1)[0])
+        if codigo < 200 or codigo in (204, 206, 304):
+            return False
+        tamanho = next((valor for nome, valor in headers if nome.lower() == 'content-length'), None)
+        return tamanho is None or int(tamanho) >= self.minimo
+
+    def __call__(self, environ, start_response):
+        codificacao = self._escolher(environ)
+        estado = {}
+
+        def iniciar(status, headers, exc_info=None):
+            if not self._varia(headers):
+                return start_response(status, headers, exc_info)
+            # Comprimida ou não, a resposta depende do Accept-Encoding
+            headers = _com_vary(headers)
+            if codificacao and self._comprimivel(status, headers):
+                estado['streaming'] = not any(nome.lower() == 'content-length' for nome, _ in headers)
+                novos = []
+                for nome, valor in headers:
+                    if nome.lower() == 'content-length':
+                        continue
+                    if nome.lower() == 'etag' and not valor.startswith('W/'):
+                        # O corpo mudou de bytes: a ETag original passa a ser fraca
+                        valor = f'W/{valor}'
+                    novos.append((nome, valor))
+                novos.append(('Content-Encoding', codificacao))
+                headers = novos
+                estado['compressor'] = (_Brotli(self.brotli, self.nivel_brotli) if codificacao == 'br'
+                                        else _Gzip(self.nivel_gzip))
+            return start_response(status, headers, exc_info)
+
+        corpo = self.app(environ, iniciar)
+        if 'compressor' not in estado:
+            return corpo
+        return self._comprimir(corpo, estado['compressor'], estado['streaming'])
+
+    def _comprimir(self, corpo, compressor, streaming):
+        try:
+            for parte in corpo:
+                if not parte:
+                    continue
+                saida = compressor.comprimir(parte, streaming)
+                if saida:
+                    yield saida
+            yield compressor.finalizar()
+        finally:
+            if hasattr(corpo, 'close'):
+                corpo.close()
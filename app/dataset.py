@@ -0,0 +1,374 @@
+import io
+import time
+import uuid
+import zlib
+import struct
+import random
+import logging
+import unicodedata
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, insert, select
+from app import db
+from app.models import (Paciente, Evolucao, Agendamento, FormularioPreConsulta, Radiografia,
+                        RadiografiaMetadados)
+from app.agenda import carregar_expediente, carregar_ocupacao, minutos_em_hora, DURACAO_PADRAO
+from app.invalidation import publicar
+from app.storage import get_storage
+from app.upload_gc import recalcular_uso
+
+logger = logging.getLogger(__name__)
+
+NOMES_FEMININOS = [
+    'Maria', 'Ana', 'Francisca', 'Antônia', 'Adriana', 'Juliana', 'Márcia', 'Fernanda', 'Patrícia', 'Aline',
+    'Sandra', 'Camila', 'Amanda', 'Bruna', 'Jéssica', 'Letícia', 'Júlia', 'Luciana', 'Vanessa', 'Mariana',
+    'Gabriela', 'Beatriz', 'Larissa', 'Raquel', 'Débora', 'Tatiane', 'Simone', 'Cláudia', 'Renata', 'Helena',
+]
+NOMES_MASCULINOS = [
+    'José', 'João', 'Antônio', 'Francisco', 'Carlos', 'Paulo', 'Pedro', 'Lucas', 'Luiz', 'Marcos',
+    'Luís', 'Gabriel', 'Rafael', 'Daniel', 'Marcelo', 'Bruno', 'Eduardo', 'Felipe', 'Raimundo', 'Rodrigo',
+    'Manoel', 'Mateus', 'André', 'Fernando', 'Fábio', 'Leonardo', 'Gustavo', 'Guilherme', 'Leandro', 'Tiago',
+]
+SOBRENOMES = [
+    'Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima', 'Gomes',
+    'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes', 'Soares', 'Fernandes', 'Vieira', 'Barbosa',
+    'Rocha', 'Dias', 'Nascimento', 'Andrade', 'Moreira', 'Nunes', 'Marques', 'Machado', 'Mendes', 'Freitas',
+    'Cardoso', 'Ramos', 'Gonçalves', 'Santana', 'Teixeira', 'Araújo', 'Pinto', 'Correia', 'Batista', 'Moura',
+]
+# (cidade, UF, DDD)
+CIDADES = [
+    ('São Paulo', 'SP', '11'), ('Campinas', 'SP', '19'), ('Rio de Janeiro', 'RJ', '21'), ('Niterói', 'RJ', '21'),
+    ('Belo Horizonte', 'MG', '31'), ('Uberlândia', 'MG', '34'), ('Curitiba', 'PR', '41'), ('Londrina', 'PR', '43'),
+    ('Porto Alegre', 'RS', '51'), ('Florianópolis', 'SC', '48'), ('Salvador', 'BA', '71'), ('Recife', 'PE', '81'),
+    ('Fortaleza', 'CE', '85'), ('Belém', 'PA', '91'), ('Manaus', 'AM', '92'), ('Goiânia', 'GO', '62'),
+    ('Brasília', 'DF', '61'), ('Vitória', 'ES', '27'), ('Natal', 'RN', '84'), ('São Luís', 'MA', '98'),
+]
+LOGRADOUROS = ['Rua', 'Avenida', 'Travessa', 'Alameda', 'Praça']
+NOMES_RUAS = [
+    'das Flores', 'Sete de Setembro', 'XV de Novembro', 'Tiradentes', 'Dom Pedro II', 'Getúlio Vargas',
+    'Santos Dumont', 'Rui Barbosa', 'da Independência', 'Marechal Deodoro', 'Castro Alves', 'dos Andradas',
+    'Barão do Rio Branco', 'Duque de Caxias', 'São João', 'Brasil', 'José Bonifácio', 'Afonso Pena',
+]
+BAIRROS = ['Centro', 'Jardim América', 'Vila Nova', 'Boa Vista', 'Santa Cruz', 'São José', 'Bela Vista',
+           'Jardim Paulista', 'Vila Mariana', 'Liberdade', 'Copacabana', 'Savassi', 'Batel', 'Moinhos de Vento']
+DOMINIOS = ['gmail.com', 'hotmail.com', 'yahoo.com.br', 'outlook.com', 'uol.com.br', 'bol.com.br', 'terra.com.br']
+
+DOENCAS = ['Hipertensão', 'Diabetes tipo 2', 'Asma', 'Hipotireoidismo', 'Gastrite', 'Rinite alérgica', 'Anemia']
+MEDICAMENTOS = ['Losartana 50mg', 'Metformina 850mg', 'Levotiroxina 50mcg', 'Omeprazol 20mg', 'Sinvastatina 20mg',
+                'Anlodipino 5mg', 'Loratadina 10mg']
+ALERGIAS = ['Penicilina', 'Dipirona', 'Látex', 'Ibuprofeno', 'Sulfa', 'Frutos do mar']
+HABITOS = ['Fumante', 'Ex-fumante', 'Bruxismo', 'Consumo social de álcool', 'Roer unhas', 'Uso de fio dental diário']
+
+PROCEDIMENTOS = [
+    'Profilaxia e aplicação de flúor', 'Restauração em resina composta', 'Tratamento endodôntico',
+    'Exodontia simples', 'Raspagem e alisamento radicular', 'Clareamento dental', 'Instalação de aparelho ortodôntico',
+    'Manutenção ortodôntica', 'Moldagem para prótese', 'Cimentação de coroa', 'Avaliação periodontal',
+    'Selante de fóssulas e fissuras', 'Ajuste oclusal', 'Exodontia de terceiro molar', 'Instalação de implante',
+]
+DENTES = ['11', '12', '16', '21', '24', '26', '36', '37', '38', '46', '47', '48']
+SUPERVISORES = ['Dra. Helena Prado', 'Dr. Ricardo Menezes', 'Dra. Camila Duarte', 'Dr. Sérgio Tavares',
+                'Dra. Luíza Campos']
+TIPOS_CONSULTA = ['Avaliação', 'Retorno', 'Limpeza', 'Restauração', 'Canal', 'Extração', 'Ortodontia', 'Urgência']
+QUEIXAS = ['Dor ao mastigar', 'Sensibilidade ao frio', 'Sangramento gengival', 'Dente quebrado', 'Mau hálito',
+           'Revisão de rotina', 'Estética do sorriso']
+
+MODALIDADES = ['IO', 'PX', 'CR', 'DX']
+APARELHOS = [('Carestream', 'CS 8100'), ('Vatech', 'PaX-i'), ('Planmeca', 'ProMax 2D'), ('Dabi Atlante', 'Spectro 70X'),
+             ('Gendex', 'GXDP-300')]
+
+
+def _sem_acentos(texto):
+    return unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode()
+
+
+def gerar_cpf(numero):
+    """Formatted CPF with valid check digits from a 9-digit base number"""
+    digitos = [int(d) for d in f'{numero % 10 ** 9:09d}']
+    for tamanho in (9, 10):
+        soma = sum(d * peso for d, peso in zip(digitos, range(tamanho + 1, 1, -1)))
+        resto = soma * 10 % 11
+        digitos.append(0 if resto == 10 else resto)
+    texto = ''.join(map(str, digitos))
+    return f'{texto[:3]}.{texto[3:6]}.{texto[6:9]}-{texto[9:]}'
+
+
+def gerar_png(largura, altura, semente):
+    """Small grayscale PNG with a noisy gradient, standing in for a radiograph"""
+    aleatorio = random.Random(semente)
+    linhas = b''.join(
+        b'\x00' + bytes(min(255, (x + y) * 255 // (largura + altura) + aleatorio.randint(0, 40))
+                        for x in range(largura))
+        for y in range(altura)
+    )
+
+    def bloco(tipo, dados):
+        return struct.pack('>I', len(dados)) + tipo + dados + struct.pack('>I', zlib.crc32(tipo + dados))
+
+    return (b'\x89PNG\r\n\x1a\n' + bloco(b'IHDR', struct.pack('>IIBBBBB', largura, altura, 8, 0, 0, 0, 0)) +
+            bloco(b'IDAT', zlib.compress(linhas, 9)) + bloco(b'IEND', b''))
+
+
+class GeradorDados:
+    """
+    Fills the database with a synthetic but plausible clinic: patients with
+    valid CPFs, phones and addresses from Brazilian cities, clinical notes,
+    appointments that never overlap (they respect the PostgreSQL exclusion
+    constraint), pre-consultation forms and radiographs backed by small
+    placeholder images in the configured storage.
+
+    Rows are written with Core INSERTs in batches of ``lote`` (mapper events
+    are skipped, so derived columns are filled here). The same ``semente``
+    generates the same data.
+    """
+
+    def __init__(self, semente=42, lote=5000, dias_passados=730, dias_futuros=90, progresso=None):
+        self.aleatorio = random.Random(semente)
+        self.semente = semente
+        self.lote = lote
+        self.hoje = date.today()
+        self.dias_passados = dias_passados
+        self.dias_futuros = dias_futuros
+        self.progresso = progresso or (lambda mensagem: logger.info(mensagem))
+
+    def _inserir(self, modelo, linhas, total):
+        """INSERT the rows produced by ``linhas`` in batches, committing each one"""
+        tabela = modelo.__table__
+        lote, gravadas, inicio = [], 0, time.perf_counter()
+        for linha in linhas:
+            lote.append(linha)
+            if len(lote) >= self.lote:
+                db.session.execute(insert(tabela), lote)
+                db.session.commit()
+                gravadas += len(lote)
+                lote = []
+                self.progresso(f'  {tabela.name}: {gravadas}/{total}')
+        if lote:
+            db.session.execute(insert(tabela), lote)
+            db.session.commit()
+            gravadas += len(lote)
+        duracao = time.perf_counter() - inicio
+        self.progresso(f'{tabela.name}: {gravadas} linhas em {duracao:.1f}s ({gravadas / max(duracao, 1e-9):.0f}/s)')
+        return gravadas
+
+    def _ids_desde(self, coluna, maior_antes):
+        return db.session.execute(select(coluna).where(coluna > maior_antes).order_by(coluna)).scalars().all()
+
+    def _data_passada(self, dias):
+        return self.hoje - timedelta(days=self.aleatorio.randint(0, dias))
+
+    # --- Pacientes ---
+
+    def _paciente(self, numero):
+        a = self.aleatorio
+        feminino = a.random() < 0.55
+        primeiro = a.choice(NOMES_FEMININOS if feminino else NOMES_MASCULINOS)
+        sobrenomes = a.sample(SOBRENOMES, a.choice((1, 2, 2, 3)))
+        nome = ' '.join([primeiro] + sobrenomes)
+        cidade, uf, ddd = a.choice(CIDADES)
+        usuario = _sem_acentos(f'{primeiro}.{sobrenomes[-1]}').lower()
+        return {
+            'nome': nome,
+            'nascimento': self.hoje - timedelta(days=a.randint(3 * 365, 90 * 365)),
+            'telefone': f'({ddd}) 9{a.randint(1000, 9999)}-{a.randint(0, 9999):04d}',
+            'email': f'{usuario}{a.randint(1, 9999)}@{a.choice(DOMINIOS)}' if a.random() < 0.8 else None,
+            'endereco': f'{a.choice(LOGRADOUROS)} {a.choice(NOMES_RUAS)}, {a.randint(1, 3000)} - '
+                        f'{a.choice(BAIRROS)}, {cidade}/{uf}',
+            # Multiplicar por um número primo com 10^9 (3^18) embaralha sem repetir
+            'cpf': gerar_cpf(numero * 387420489 + 104729),
+            'genero': 'Feminino' if feminino else 'Masculino',
+            'doencas': ', '.join(a.sample(DOENCAS, a.randint(1, 2))) if a.random() < 0.3 else None,
+            'medicamentos': ', '.join(a.sample(MEDICAMENTOS, a.randint(1, 2))) if a.random() < 0.3 else None,
+            'alergias': a.choice(ALERGIAS) if a.random() < 0.15 else None,
+            'cirurgias': None,
+            'habitos': ', '.join(a.sample(HABITOS, a.randint(1, 2))) if a.random() < 0.4 else None,
+            'observacoes': None,
+            'data_cadastro': datetime.combine(self._data_passada(self.dias_passados), datetime.min.time()),
+        }
+
+    def gerar_pacientes(self, quantidade):
+        maior_antes = db.session.query(func.coalesce(func.max(Paciente.id), 0)).scalar()
+        self._inserir(Paciente, (self._paciente(maior_antes + i) for i in range(1, quantidade + 1)), quantidade)
+        return self._ids_desde(Paciente.id, maior_antes)
+
+    # --- Evoluções ---
+
+    def _evolucao(self, pacientes):
+        a = self.aleatorio
+        data = self._data_passada(self.dias_passados)
+        return {
+            'paciente_id': a.choice(pacientes),
+            'data': data,
+            'procedimento': f'{a.choice(PROCEDIMENTOS)} - dente {a.choice(DENTES)}',
+            'supervisor': a.choice(SUPERVISORES),
+            'observacao': 'Paciente sem intercorrências.' if a.random() < 0.7 else 'Retornar em 15 dias.',
+            'detalhes': None,
+            'data_registro': datetime.combine(data, datetime.min.time()) + timedelta(hours=a.randint(8, 18)),
+        }
+
+    def gerar_evolucoes(self, quantidade, pacientes):
+        return self._inserir(Evolucao, (self._evolucao(pacientes) for _ in range(quantidade)), quantidade)
+
+    # --- Agendamentos ---
+
+    def _horarios(self):
+        """Every free 30-minute slot of the working hours in the generated period"""
+        expediente = carregar_expediente(current_app.config['AGENDA_EXPEDIENTE'])
+        primeiro = self.hoje - timedelta(days=self.dias_passados)
+        ultimo = self.hoje + timedelta(days=self.dias_futuros)
+        # Gerar de novo sobre um banco já populado não pode sobrepor os agendamentos existentes
+        ocupacao = carregar_ocupacao(primeiro, ultimo)
+        horarios = []
+        dia = primeiro
+        while dia <= ultimo:
+            ocupados = ocupacao.get(dia, ())
+            for inicio, fim in expediente.get(dia.weekday(), ()):
+                horarios.extend((dia, minuto) for minuto in range(inicio, fim - DURACAO_PADRAO + 1, DURACAO_PADRAO)
+                                if not any(minuto < termino and comeco < minuto + DURACAO_PADRAO
+                                           for comeco, termino in ocupados))
+            dia += timedelta(days=1)
+        self.aleatorio.shuffle(horarios)
+        return horarios
+
+    def _agendamento(self, indice, horarios, pacientes):
+        a = self.aleatorio
+        dia, inicio = horarios[indice % len(horarios)]
+        if indice >= len(horarios):
+            # Horário já ocupado: fica como consulta cancelada, que não ocupa a agenda
+            status = 'cancelada'
+        elif dia < self.hoje:
+            status = a.choices(('concluida', 'faltou', 'cancelada'), (85, 10, 5))[0]
+        else:
+            status = a.choices(('agendada', 'cancelada'), (95, 5))[0]
+        registro = datetime.combine(dia, datetime.min.time()) - timedelta(days=a.randint(1, 30))
+        return {
+            'paciente_id': a.choice(pacientes),
+            'data_consulta': dia,
+            'hora_consulta': minutos_em_hora(inicio),
+            'tipo_consulta': a.choice(TIPOS_CONSULTA),
+            'observacao': None,
+            'status': status,
+            'data_registro': registro,
+            'duracao_minutos': DURACAO_PADRAO,
+            'inicio_minutos': inicio,
+            'fim_minutos': inicio + DURACAO_PADRAO,
+            'atualizado_em': registro,
+        }
+
+    def gerar_agendamentos(self, quantidade, pacientes):
+        horarios = self._horarios()
+        if quantidade > len(horarios):
+            self.progresso(f'Agenda com {len(horarios)} horários no período: '
+                           f'{quantidade - len(horarios)} agendamentos serão gerados como cancelados')
+        return self._inserir(Agendamento, (self._agendamento(i, horarios, pacientes) for i in range(quantidade)),
+                             quantidade)
+
+    # --- Formulários ---
+
+    def _formulario(self, agendamento_id, paciente_id, data_consulta):
+        a = self.aleatorio
+        envio = datetime.combine(data_consulta, datetime.min.time()) - timedelta(days=a.randint(2, 7))
+        preenchido = data_consulta < self.hoje or a.random() < 0.4
+        return {
+            'paciente_id': paciente_id,
+            'agendamento_id': agendamento_id,
+            'token': uuid.UUID(int=a.getrandbits(128)).hex + uuid.UUID(int=a.getrandbits(128)).hex,
+            'data_envio': envio,
+            'data_preenchimento': envio + timedelta(hours=a.randint(1, 48)) if preenchido else None,
+            'status': 'preenchido' if preenchido else 'pendente',
+            'historico_medico': a.choice(DOENCAS) if preenchido and a.random() < 0.3 else None,
+            'queixas': a.choice(QUEIXAS) if preenchido else None,
+            'medicamentos_atuais': a.choice(MEDICAMENTOS) if preenchido and a.random() < 0.3 else None,
+            'alergias_novas': None,
+            'observacoes': None,
+        }
+
+    def gerar_formularios(self, quantidade, maior_agendamento_antes):
+        """Forms for a random sample of the appointments just generated"""
+        total = db.session.query(func.count(Agendamento.id)).filter(Agendamento.id > maior_agendamento_antes).scalar()
+        if not total or not quantidade:
+            return 0
+        proporcao = min(1.0, quantidade / total)
+        consulta = db.session.execute(
+            select(Agendamento.id, Agendamento.paciente_id, Agendamento.data_consulta)
+            .where(Agendamento.id > maior_agendamento_antes)
+            .execution_options(yield_per=self.lote)
+        )
+        # Amostra lida em blocos: não carrega todos os agendamentos na memória
+        escolhidos = [linha for linha in consulta if self.aleatorio.random() < proporcao][:quantidade]
+        return self._inserir(FormularioPreConsulta, (self._formulario(*linha) for linha in escolhidos),
+                             len(escolhidos))
+
+    # --- Radiografias ---
+
+    def gerar_radiografias(self, quantidade, pacientes, variantes=8):
+        """Rows, extracted metadata and one placeholder file per radiograph"""
+        storage = get_storage()
+        imagens = [gerar_png(256, 192, self.semente + i) for i in range(variantes)]
+        maior_antes = db.session.query(func.coalesce(func.max(Radiografia.id), 0)).scalar()
+
+        def linhas():
+            a = self.aleatorio
+            for _ in range(quantidade):
+                dados = a.choice(imagens)
+                chave = f'uploads/radiografias/{uuid.UUID(int=a.getrandbits(128)).hex}.png'
+                storage.save(chave, io.BytesIO(dados), content_type='image/png')
+                envio = datetime.combine(self._data_passada(self.dias_passados), datetime.min.time())
+                yield {
+                    'paciente_id': a.choice(pacientes),
+                    'nome_arquivo': f'{a.choice(("Periapical", "Panorâmica", "Interproximal"))} {a.choice(DENTES)}',
+                    'descricao': None,
+                    'arquivo_caminho': chave,
+                    'arquivo_nome_original': f'RX_{a.randint(10000, 99999)}.png',
+                    'arquivo_tipo': 'image/png',
+                    'arquivo_tamanho': len(dados),
+                    'data_upload': envio,
+                }
+
+        gravadas = self._inserir(Radiografia, linhas(), quantidade)
+
+        def metadados():
+            a = self.aleatorio
+            consulta = db.session.execute(
+                select(Radiografia.id, Radiografia.data_upload).where(Radiografia.id > maior_antes)
+            ).all()
+            for radiografia_id, envio in consulta:
+                fabricante, dispositivo = a.choice(APARELHOS)
+                yield {
+                    'radiografia_id': radiografia_id,
+                    'status': 'extraido',
+                    'formato': 'png',
+                    'modalidade': a.choice(MODALIDADES),
+                    'largura': 256,
+                    'altura': 192,
+                    'data_aquisicao': envio,
+                    'fabricante': fabricante,
+                    'dispositivo': dispositivo,
+                    'erro': None,
+                    'data_extracao': envio,
+                }
+
+        self._inserir(RadiografiaMetadados, metadados(), gravadas)
+        recalcular_uso()
+        return gravadas
+
+    def gerar(self, pacientes, evolucoes, agendamentos, formularios, radiografias):
+        """Generate everything; returns the number of rows per table"""
+        ids = self.gerar_pacientes(pacientes)
+        if not ids:
+            ids = db.session.execute(select(Paciente.id)).scalars().all()
+        if not ids:
+            raise ValueError('No patients to attach the generated records to')
+
+        maior_agendamento = db.session.query(func.coalesce(func.max(Agendamento.id), 0)).scalar()
+        resultado = {
+            'pacientes': len(ids) if pacientes else 0,
+            'evolucoes': self.gerar_evolucoes(evolucoes, ids),
+            'agendamentos': self.gerar_agendamentos(agendamentos, ids),
+        }
+        resultado['formularios'] = self.gerar_formularios(formularios, maior_agendamento)
+        resultado['radiografias'] = self.gerar_radiografias(radiografias, ids)
+
+        # Inserções em massa não passam pelos eventos do ORM: avisa os caches de todos os workers
+        publicar('*')
+        db.session.commit()
+        return resultado
@@ -0,0 +1,174 @@
+import io
+import os
+import csv
+import json
+import logging
+import zipfile
+from datetime import datetime, date
+from werkzeug.utils import secure_filename
+from app.models import Evolucao, Agendamento, FormularioPreConsulta, Radiografia
+from app.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Linhas lidas do banco por vez ao escrever os CSVs
+ROWS_PER_BATCH = 500
+
+# Acima disso o tamanho do membro pode passar do limite do ZIP clássico
+ZIP64_THRESHOLD = 1 << 31
+
+CAMPOS_PACIENTE = ['id', 'nome', 'nascimento', 'telefone', 'email', 'endereco', 'cpf', 'genero',
+                   'doencas', 'medicamentos', 'alergias', 'cirurgias', 'habitos', 'observacoes',
+                   'data_cadastro']
+CAMPOS_EVOLUCAO = ['id', 'data', 'procedimento', 'supervisor', 'observacao', 'detalhes', 'data_registro']
+CAMPOS_AGENDAMENTO = ['id', 'data_consulta', 'hora_consulta', 'tipo_consulta', 'observacao', 'status',
+                      'data_registro']
+CAMPOS_FORMULARIO = ['id', 'agendamento_id', 'data_envio', 'data_preenchimento', 'status',
+                     'historico_medico', 'queixas', 'medicamentos_atuais', 'alergias_novas', 'observacoes']
+CAMPOS_RADIOGRAFIA = ['id', 'nome_arquivo', 'descricao', 'arquivo_nome_original', 'arquivo_tipo',
+                      'arquivo_tamanho', 'data_upload', 'arquivo_no_pacote', 'situacao']
+
+
+class _ZipSink(io.RawIOBase):
+    """
+    Write-only, non-seekable stream for zipfile.
+
+    zipfile appends data descriptors when it cannot seek back, so each
+    chunk it writes can be handed to the client right away.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def _serializar(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return valor
+
+
+def _linha(obj, campos):
+    return {campo: _serializar(getattr(obj, campo)) for campo in campos}
+
+
+def _nome_no_pacote(radiografia):
+    nome = secure_filename(radiografia.arquivo_nome_original or '') or \
+        os.path.basename(radiografia.arquivo_caminho)
+    return f'radiografias/{radiografia.id}_{nome}'
+
+
+def _escrever_csv(zf, sink, nome, campos, linhas):
+    """Write rows to a CSV member, yielding the zip bytes produced every batch"""
+    with zf.open(nome, 'w') as membro:
+        texto = io.TextIOWrapper(membro, encoding='utf-8-sig', newline='')
+        writer = csv.DictWriter(texto, fieldnames=campos)
+        writer.writeheader()
+        for i, linha in enumerate(linhas, 1):
+            writer.writerow(linha)
+            if i % ROWS_PER_BATCH == 0:
+                texto.flush()
+                yield sink.drain()
+        texto.flush()
+        texto.detach()
+    yield sink.drain()
+
+
+def exportar_paciente(paciente):
+    """
+    Generate the ZIP export of a patient's record, chunk by chunk.
+
+    Clinical records are streamed from the database in batches and each
+    radiograph is copied from storage in chunks, so neither the archive nor
+    any file is ever held whole in memory or written to disk.
+    """
+    for chunk in _gerar_zip(paciente):
+        if chunk:
+            yield chunk
+
+
+def _gerar_zip(paciente):
+    storage = get_storage()
+    sink = _ZipSink()
+    situacao_arquivos = {}
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        manifesto = {
+            'gerado_em': datetime.now().isoformat(),
+            'paciente': _linha(paciente, CAMPOS_PACIENTE),
+            'arquivos': {
+                'evolucoes': 'evolucoes.csv',
+                'agendamentos': 'agendamentos.csv',
+                'formularios_pre_consulta': 'formularios_pre_consulta.csv',
+                'radiografias': 'radiografias.csv'
+            }
+        }
+        zf.writestr('paciente.json', json.dumps(manifesto, ensure_ascii=False, indent=2))
+        yield sink.drain()
+
+        evolucoes = paciente.evolucoes.order_by(Evolucao.data).yield_per(ROWS_PER_BATCH)
+        yield from _escrever_csv(zf, sink, 'evolucoes.csv', CAMPOS_EVOLUCAO,
+                                 (_linha(e, CAMPOS_EVOLUCAO) for e in evolucoes))
+
+        agendamentos = paciente.agendamentos.order_by(Agendamento.data_consulta,
+                                                      Agendamento.hora_consulta).yield_per(ROWS_PER_BATCH)
+        yield from _escrever_csv(zf, sink, 'agendamentos.csv', CAMPOS_AGENDAMENTO,
+                                 (_linha(a, CAMPOS_AGENDAMENTO) for a in agendamentos))
+
+        formularios = paciente.formularios.order_by(FormularioPreConsulta.data_envio).yield_per(ROWS_PER_BATCH)
+        yield from _escrever_csv(zf, sink, 'formularios_pre_consulta.csv', CAMPOS_FORMULARIO,
+                                 (_linha(f, CAMPOS_FORMULARIO) for f in formularios))
+
+        radiografias = paciente.radiografias.filter(Radiografia.arquivo_caminho.isnot(None)) \
+            .order_by(Radiografia.id).yield_per(ROWS_PER_BATCH)
+        for radiografia in radiografias:
+            info = zipfile.ZipInfo(_nome_no_pacote(radiografia),
+                                   date_time=(radiografia.data_upload or datetime.now()).timetuple()[:6])
+            # Imagens já são comprimidas; armazenar sem compressão economiza CPU
+            info.compress_type = zipfile.ZIP_STORED
+            tamanho = radiografia.arquivo_tamanho or 0
+            try:
+                with zf.open(info, 'w', force_zip64=not tamanho or tamanho >= ZIP64_THRESHOLD) as membro:
+                    for chunk in storage.open(radiografia.arquivo_caminho):
+                        membro.write(chunk)
+                        yield sink.drain()
+                situacao_arquivos[radiografia.id] = 'incluido'
+            except Exception as e:
+                # O membro parcial fica no pacote; a situação é registrada no CSV
+                logger.warning(f"Export: file of radiograph {radiografia.id} unavailable: {e}")
+                situacao_arquivos[radiografia.id] = 'arquivo_indisponivel'
+            yield sink.drain()
+
+        def linhas_radiografias():
+            for radiografia in paciente.radiografias.order_by(Radiografia.id).yield_per(ROWS_PER_BATCH):
+                linha = _linha(radiografia, CAMPOS_RADIOGRAFIA[:-2])
+                if radiografia.arquivo_caminho:
+                    linha['arquivo_no_pacote'] = _nome_no_pacote(radiografia)
+                    linha['situacao'] = situacao_arquivos.get(radiografia.id, 'arquivo_indisponivel')
+                else:
+                    linha['situacao'] = 'sem_arquivo'
+                yield linha
+
+        yield from _escrever_csv(zf, sink, 'radiografias.csv', CAMPOS_RADIOGRAFIA, linhas_radiografias())
+
+    # Diretório central do ZIP
+    yield sink.drain()
@@ -1,8 +1,8 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed, FileRequired
+from flask_wtf.file import FileField, FileAllowed, FileRequired, MultipleFileField
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, DateField, SelectField
-from wtforms import TextAreaField, TimeField, HiddenField, RadioField, ValidationError
-from wtforms.validators import DataRequired, Email, Length, EqualTo, Optional
+from wtforms import TextAreaField, TimeField, HiddenField, RadioField, IntegerField, ValidationError
+from wtforms.validators import DataRequired, Email, Length, EqualTo, Optional, NumberRange
 from email_validator import validate_email
 from datetime import date
 import re
@@ -75,6 +75,10 @@ class AgendamentoForm(FlaskForm):
     paciente_id = HiddenField('ID do Paciente')
     data_consulta = DateField('Data da Consulta', validators=[DataRequired(message='Campo obrigatório')], default=date.today)
     hora_consulta = StringField('Hora da Consulta', validators=[DataRequired(message='Campo obrigatório')])
+    duracao_minutos = IntegerField('Duração (minutos)', validators=[
+        DataRequired(message='Campo obrigatório'),
+        NumberRange(min=5, max=480, message='A duração deve estar entre 5 e 480 minutos')
+    ], default=30)
     tipo_consulta = StringField('Tipo de Consulta', validators=[DataRequired(message='Campo obrigatório')])
     observacao = TextAreaField('Observação', validators=[Optional()])
     status = SelectField('Status', choices=[
@@ -92,6 +96,62 @@ class AgendamentoForm(FlaskForm):
             if not pattern.match(field.data):
                 raise ValidationError('Formato de hora inválido. Use HH:MM')
 
+class RecorrenciaForm(FlaskForm):
+    data_inicio = DateField('Primeira Consulta', validators=[DataRequired(message='Campo obrigatório')], default=date.today)
+    hora_consulta = StringField('Hora da Consulta', validators=[DataRequired(message='Campo obrigatório')])
+    duracao_minutos = IntegerField('Duração (minutos)', validators=[
+        DataRequired(message='Campo obrigatório'),
+        NumberRange(min=5, max=480, message='A duração deve estar entre 5 e 480 minutos')
+    ], default=30)
+    frequencia = SelectField('Repetir', choices=[
+        ('semanal', 'Semanal'),
+        ('mensal', 'Mensal'),
+        ('diaria', 'Diária')
+    ], default='semanal')
+    intervalo = IntegerField('A cada', validators=[
+        DataRequired(message='Campo obrigatório'),
+        NumberRange(min=1, max=52, message='O intervalo deve estar entre 1 e 52')
+    ], default=1)
+    data_fim = DateField('Até', validators=[Optional()])
+    total_ocorrencias = IntegerField('Número de Consultas', validators=[
+        Optional(),
+        NumberRange(min=1, max=500, message='Informe entre 1 e 500 consultas')
+    ])
+    tipo_consulta = StringField('Tipo de Consulta', validators=[DataRequired(message='Campo obrigatório')])
+    observacao = TextAreaField('Observação', validators=[Optional()])
+    submit = SubmitField('Salvar')
+    
+    def validate_hora_consulta(self, field):
+        if field.data:
+            pattern = re.compile(r'^([0-1]?[0-9]|2[0-3]):([0-5][0-9])$')
+            if not pattern.match(field.data):
+                raise ValidationError('Formato de hora inválido. Use HH:MM')
+    
+    def validate_data_fim(self, field):
+        if field.data and self.data_inicio.data and field.data < self.data_inicio.data:
+            raise ValidationError('A data final deve ser posterior à primeira consulta')
+
+class EncerrarRecorrenciaForm(FlaskForm):
+    data_fim = DateField('Última Consulta', validators=[DataRequired(message='Campo obrigatório')], default=date.today)
+    submit = SubmitField('Encerrar Série')
+
+class StatusEmLoteForm(FlaskForm):
+    status = SelectField('Marcar como', choices=[
+        ('concluida', 'Concluída'),
+        ('faltou', 'Faltou'),
+        ('cancelada', 'Cancelada')
+    ], default='concluida')
+    submit = SubmitField('Aplicar')
+
+class AssinaturaAgendaForm(FlaskForm):
+    submit = SubmitField('Gerar Novo Link')
+
+class TracemallocForm(FlaskForm):
+    acao = SelectField('Rastreamento de memória', choices=[
+        ('iniciar', 'Iniciar'),
+        ('parar', 'Parar')
+    ])
+
 class FormularioPreConsultaForm(FlaskForm):
     paciente_id = HiddenField('ID do Paciente')
     agendamento_id = HiddenField('ID do Agendamento')
@@ -163,6 +223,16 @@ class RadiografiaForm(FlaskForm):
     descricao = TextAreaField('Descrição', validators=[Optional()])
     arquivo = FileField('Arquivo de Radiografia', validators=[
         FileRequired(message='Selecione um arquivo'),
-        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'pdf'], 'Apenas imagens ou PDF são permitidos')
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'pdf', 'dcm'], 'Apenas imagens, DICOM ou PDF são permitidos')
     ])
     submit = SubmitField('Salvar')
+
+
+class RadiografiaLoteForm(FlaskForm):
+    nome_base = StringField('Nome da Série', validators=[DataRequired(message='Campo obrigatório')])
+    descricao = TextAreaField('Descrição', validators=[Optional()])
+    arquivos = MultipleFileField('Arquivos da Série', validators=[
+        FileRequired(message='Selecione ao menos um arquivo'),
+        FileAllowed(['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'pdf', 'dcm'], 'Apenas imagens, DICOM ou PDF são permitidos')
+    ])
+    submit = SubmitField('Enviar Série')
\ No newline at end of file
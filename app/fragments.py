@@ -0,0 +1,99 @@
+import hashlib
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup, escape
+from app.cache import get_cache
+
+
+class FragmentCacheExtension(Extension):
+    """
+    ``{% cache %}`` tag: stores the rendered HTML of a template block.
+
+        {% cache 'agenda-dia', versao_dados('agendamentos'), data_atual,
+                 lacunas={'csrf': form.hidden_tag()} %}
+            ... {{ lacuna('csrf') }} ...
+        {% endcache %}
+
+    The first argument names the fragment; the others make up the key and
+    should include ``versao_dados(...)`` of the tables the block shows, so
+    any committed change renders it again. Per-user content cannot live in
+    a shared fragment: mark it with ``lacuna(nome)`` and pass the value in
+    ``lacunas``, which is evaluated on every request and filled in after
+    the fragment comes out of the cache. ``ttl`` overrides CACHE_TTL.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        partes = [parser.parse_expression()]
+        opcoes = []
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.type == 'name' and parser.stream.look().type == 'assign':
+                nome = next(parser.stream).value
+                next(parser.stream)
+                opcoes.append(nodes.Keyword(nome, parser.parse_expression()))
+            else:
+                partes.append(parser.parse_expression())
+
+        corpo = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_renderizar', [nodes.List(partes)], opcoes),
+                               [], [], corpo).set_lineno(lineno)
+
+    def _renderizar(self, partes, caller, ttl=None, lacunas=None):
+        nome, partes = partes[0], partes[1:]
+        chave = f'fragmento:{nome}:{hashlib.md5(repr(partes).encode()).hexdigest()}'
+        html = get_cache().get_or_set(chave, lambda: str(caller()), ttl or current_app.config['CACHE_TTL'])
+        for lacuna_nome, valor in (lacunas or {}).items():
+            html = html.replace(_marca(lacuna_nome), str(escape(valor)))
+        return Markup(html)
+
+
+def _marca(nome):
+    return f'<!--lacuna:{nome}-->'
+
+
+def lacuna(nome):
+    """Placeholder for per-request content inside a cached fragment"""
+    return Markup(_marca(nome))
+
+
+def versao_dados(*grupos):
+    """Current versions of cache groups, to be used as part of a fragment key"""
+    cache = get_cache()
+    return tuple(cache.versao(grupo) for grupo in grupos)
+
+
+class Adiado:
+    """
+    List computed on first use. Views pass query results wrapped in it so a
+    fragment served from the cache never runs the query.
+    """
+
+    def __init__(self, funcao, *args, **kwargs):
+        self.funcao = funcao
+        self.args = args
+        self.kwargs = kwargs
+        self._itens = None
+
+    @property
+    def itens(self):
+        if self._itens is None:
+            self._itens = list(self.funcao(*self.args, **self.kwargs))
+        return self._itens
+
+    def __iter__(self):
+        return iter(self.itens)
+
+    def __len__(self):
+        return len(self.itens)
+
+    def __bool__(self):
+        return bool(self.itens)
+
+
+def init_fragments(app):
+    """Register the {% cache %} tag and its helpers in the Jinja environment"""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals.update(versao_dados=versao_dados, lacuna=lacuna)
@@ -0,0 +1,204 @@
+import hashlib
+import logging
+import threading
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from flask import current_app
+from sqlalchemy import func, or_, select, union
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Agendamento, RecorrenciaAgendamento, Paciente
+from app.agenda import expandir_recorrencias, minutos_em_hora
+
+logger = logging.getLogger(__name__)
+
+STATUS_ICAL = {
+    'agendada': 'CONFIRMED',
+    'concluida': 'CONFIRMED',
+    'faltou': 'CONFIRMED',
+    'cancelada': 'CANCELLED',
+}
+
+# Último feed gerado e VEVENTs já serializados, por processo
+_feed = {}
+_eventos = {}
+_lock = threading.Lock()
+
+
+def janela_feed(hoje=None):
+    """Dates covered by the feed: recent past plus the coming months"""
+    hoje = hoje or date.today()
+    return (hoje - timedelta(days=current_app.config['ICAL_DIAS_PASSADOS']),
+            hoje + timedelta(days=current_app.config['ICAL_DIAS_FUTUROS']))
+
+
+def versao_agenda(inicio, fim):
+    """
+    Cheap fingerprint of everything the feed shows between two dates.
+
+    Aggregate queries (row count and last change of appointments and of
+    recurring series in the window, last change of their patients) change
+    whenever a row is added, edited, removed or moved in or out of the
+    window, or a patient shown in it is renamed.
+    """
+    no_periodo = Agendamento.data_consulta.between(inicio, fim)
+    series_no_periodo = (RecorrenciaAgendamento.data_inicio <= fim,
+                         or_(RecorrenciaAgendamento.data_fim.is_(None), RecorrenciaAgendamento.data_fim >= inicio))
+    agendamentos = db.session.query(func.count(Agendamento.id), func.max(Agendamento.atualizado_em)) \
+        .filter(no_periodo).one()
+    recorrencias = db.session.query(func.count(RecorrenciaAgendamento.id),
+                                    func.max(RecorrenciaAgendamento.atualizado_em)) \
+        .filter(*series_no_periodo).one()
+    # O SUMMARY leva o nome do paciente: a versão do prontuário muda ao renomeá-lo
+    pacientes = db.session.query(func.max(Paciente.atualizado_em)).filter(Paciente.id.in_(union(
+        select(Agendamento.paciente_id).where(no_periodo),
+        select(RecorrenciaAgendamento.paciente_id).where(*series_no_periodo),
+    ))).scalar()
+
+    modificado = max((m for m in (agendamentos[1], recorrencias[1], pacientes) if m), default=None)
+    chave = f'{inicio}:{fim}:{agendamentos[0]}:{agendamentos[1]}:{recorrencias[0]}:{recorrencias[1]}:{pacientes}'
+    return hashlib.md5(chave.encode()).hexdigest(), modificado
+
+
+def _escapar(texto):
+    return (texto or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _dobrar(linha):
+    """Fold content lines longer than 75 octets (RFC 5545, 3.1)"""
+    dados = linha.encode('utf-8')
+    if len(dados) <= 75:
+        return linha
+    partes = []
+    while dados:
+        limite = 75 if not partes else 74
+        corte = min(limite, len(dados))
+        # Não quebra no meio de um caractere UTF-8
+        while corte < len(dados) and (dados[corte] & 0xC0) == 0x80:
+            corte -= 1
+        partes.append(dados[:corte].decode('utf-8'))
+        dados = dados[corte:]
+    return '\r\n '.join(partes)
+
+
+def _utc(momento):
+    momento = momento or datetime.now()
+    return momento.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+@lru_cache(maxsize=4)
+def _fuso(nome):
+    try:
+        return ZoneInfo(nome)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f'Unknown time zone {nome!r} in ICAL_FUSO_HORARIO, using UTC')
+        return timezone.utc
+
+
+def _local_utc(dia, minutos, fuso):
+    """
+    Wall-clock time of the clinic as UTC. Times with TZID would need a
+    VTIMEZONE component (RFC 5545, 3.2.19); UTC ones are exact everywhere.
+    """
+    momento = datetime.combine(dia, datetime.min.time(), tzinfo=fuso) + timedelta(minutes=minutos)
+    return momento.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _uid(agendamento, dominio):
+    # Ocorrências recorrentes mantêm o UID ao serem materializadas
+    if agendamento.recorrencia_id and agendamento.data_original:
+        return f'recorrencia-{agendamento.recorrencia_id}-{agendamento.data_original:%Y%m%d}@{dominio}'
+    return f'agendamento-{agendamento.id}@{dominio}'
+
+
+def _vevent(agendamento, atualizado_em, fuso, dominio):
+    inicio = agendamento.inicio_minutos
+    fim = agendamento.fim_minutos
+    if inicio is None:
+        inicio = int(agendamento.hora_consulta[:2]) * 60 + int(agendamento.hora_consulta[3:5])
+        fim = inicio + (agendamento.duracao_minutos or 30)
+
+    linhas = [
+        'BEGIN:VEVENT',
+        f'UID:{_uid(agendamento, dominio)}',
+        f'DTSTAMP:{_utc(atualizado_em)}',
+        f'DTSTART:{_local_utc(agendamento.data_consulta, inicio, fuso)}',
+        f'DTEND:{_local_utc(agendamento.data_consulta, fim, fuso)}',
+        f'SUMMARY:{_escapar(f"{agendamento.tipo_consulta} - {agendamento.paciente.nome}")}',
+        f'STATUS:{STATUS_ICAL.get(agendamento.status, "CONFIRMED")}',
+    ]
+    descricao = f'{agendamento.hora_consulta}–{minutos_em_hora(fim)}'
+    if agendamento.observacao:
+        descricao += f'\n{agendamento.observacao}'
+    linhas.append(f'DESCRIPTION:{_escapar(descricao)}')
+    linhas.append('END:VEVENT')
+    return '\r\n'.join(_dobrar(l) for l in linhas) + '\r\n'
+
+
+def gerar_feed(inicio, fim, versao, modificado):
+    """
+    Build the VCALENDAR body for the window, reusing the VEVENT text of
+    every appointment whose last change is the one already serialized.
+    """
+    nome_fuso = current_app.config['ICAL_FUSO_HORARIO']
+    fuso = _fuso(nome_fuso)
+    dominio = current_app.config['ICAL_DOMINIO']
+
+    agendamentos = Agendamento.query.options(joinedload(Agendamento.paciente)) \
+        .filter(Agendamento.data_consulta.between(inicio, fim)) \
+        .order_by(Agendamento.data_consulta, Agendamento.hora_consulta).all()
+
+    itens = [(('a', a.id), a.atualizado_em or a.data_registro, a) for a in agendamentos]
+    itens += [(('r', o.recorrencia_id, o.data_consulta), o.recorrencia.atualizado_em, o)
+              for o in expandir_recorrencias(inicio, fim)]
+
+    with _lock:
+        anteriores = dict(_eventos)
+
+    eventos = {}
+    partes = [
+        'BEGIN:VCALENDAR\r\n',
+        'VERSION:2.0\r\n',
+        'PRODID:-//Clinica Odontologica//Agenda//PT-BR\r\n',
+        'CALSCALE:GREGORIAN\r\n',
+        'METHOD:PUBLISH\r\n',
+        _dobrar(f'X-WR-CALNAME:{_escapar(current_app.config["ICAL_NOME"])}') + '\r\n',
+        # Só sugere o fuso para exibição: os horários vão em UTC
+        f'X-WR-TIMEZONE:{nome_fuso}\r\n',
+    ]
+    for chave, atualizado_em, agendamento in itens:
+        # Paciente renomeado também invalida o evento
+        assinatura = (atualizado_em, agendamento.paciente.nome)
+        cache = anteriores.get(chave)
+        if cache and cache[0] == assinatura:
+            texto = cache[1]
+        else:
+            texto = _vevent(agendamento, atualizado_em, fuso, dominio)
+        eventos[chave] = (assinatura, texto)
+        partes.append(texto)
+    partes.append('END:VCALENDAR\r\n')
+
+    corpo = ''.join(partes).encode('utf-8')
+    with _lock:
+        # Só guarda os eventos da janela atual, o que limita o tamanho do cache
+        _eventos.clear()
+        _eventos.update(eventos)
+        _feed.update(versao=versao, janela=(inicio, fim), modificado=modificado, corpo=corpo)
+    return corpo
+
+
+def feed_agenda():
+    """
+    Return ``(corpo, versao, modificado)`` for the current window. The body is
+    only rebuilt when the window's fingerprint changed since the last build.
+    """
+    inicio, fim = janela_feed()
+    versao, modificado = versao_agenda(inicio, fim)
+
+    with _lock:
+        if _feed.get('versao') == versao:
+            return _feed['corpo'], versao, _feed['modificado']
+
+    return gerar_feed(inicio, fim, versao, modificado), versao, modificado
@@ -0,0 +1,119 @@
+import json
+import time
+import logging
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from app.tracing import span_atual
+
+logger = logging.getLogger(__name__)
+
+# Quantas consultas aparecem no registro de requisição lenta
+MAX_CONSULTAS_REGISTRO = 5
+# Tamanho máximo do SQL registrado
+MAX_SQL = 300
+
+
+class MedicaoRequisicao:
+    """SQL executed during one request: count and time per distinct statement"""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.consultas = 0
+        self.tempo_db = 0.0
+        # SQL -> [execuções, segundos]; os parâmetros vêm separados, então a
+        # mesma consulta com ids diferentes cai na mesma chave
+        self.por_sql = {}
+
+    def registrar(self, sql, duracao):
+        self.consultas += 1
+        self.tempo_db += duracao
+        dados = self.por_sql.setdefault(sql, [0, 0.0])
+        dados[0] += 1
+        dados[1] += duracao
+
+    def repetidas(self, minimo):
+        """Statements run at least ``minimo`` times: the signature of an N+1"""
+        return {sql: dados for sql, dados in self.por_sql.items() if dados[0] >= minimo}
+
+    def principais(self, limite=MAX_CONSULTAS_REGISTRO):
+        ordenadas = sorted(self.por_sql.items(), key=lambda item: item[1][1], reverse=True)
+        return ordenadas[:limite]
+
+
+def _resumo(sql, dados):
+    return {'sql': ' '.join(sql.split())[:MAX_SQL], 'vezes': dados[0], 'ms': round(dados[1] * 1000, 2)}
+
+
+def medicao_atual():
+    """Measurement of the current request, or None outside a request"""
+    if not has_request_context():
+        return None
+    return g.get('medicao_sql')
+
+
+def _antes_de_executar(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and medicao_atual() is not None:
+        # No contexto da execução: uma consulta que falha não deixa início pendurado
+        context.inicio_medicao = time.perf_counter()
+
+
+def _depois_de_executar(conn, cursor, statement, parameters, context, executemany):
+    medicao = medicao_atual()
+    inicio = getattr(context, 'inicio_medicao', None)
+    if medicao is None or inicio is None:
+        return
+    medicao.registrar(statement, time.perf_counter() - inicio)
+
+
+def _iniciar_medicao():
+    g.medicao_sql = MedicaoRequisicao()
+
+
+def _registrar_requisicao(app, response):
+    medicao = g.pop('medicao_sql', None)
+    if medicao is None:
+        return response
+    duracao = time.perf_counter() - medicao.inicio
+    response.headers['Server-Timing'] = (f'db;dur={medicao.tempo_db * 1000:.1f};desc="{medicao.consultas} SQL", '
+                                         f'app;dur={duracao * 1000:.1f}')
+
+    repetidas = medicao.repetidas(app.config['INSTRUMENTACAO_REPETICOES'])
+    lenta = duracao * 1000 >= app.config['INSTRUMENTACAO_LENTA_MS']
+    if not (lenta or repetidas or medicao.consultas >= app.config['INSTRUMENTACAO_MAX_CONSULTAS']):
+        return response
+
+    # Uma linha JSON por requisição, para filtrar com jq/grep nos logs do gunicorn
+    span = span_atual()
+    logger.warning(json.dumps({
+        'evento': 'requisicao_lenta' if lenta else 'requisicao_com_muitas_consultas',
+        'metodo': request.method,
+        'rota': request.url_rule.rule if request.url_rule else None,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duracao_ms': round(duracao * 1000, 1),
+        'db_ms': round(medicao.tempo_db * 1000, 1),
+        'consultas': medicao.consultas,
+        'consultas_distintas': len(medicao.por_sql),
+        'n_mais_1': [_resumo(sql, dados) for sql, dados in repetidas.items()],
+        'principais': [_resumo(sql, dados) for sql, dados in medicao.principais()],
+        'trace_id': span.trace_id if span else None,
+    }, ensure_ascii=False))
+    return response
+
+
+def init_instrumentation(app):
+    """
+    Measure every request: SQL statements (count, time, repeated statements)
+    from the engine events and the total handler time. Each response gets a
+    Server-Timing header; requests over INSTRUMENTACAO_LENTA_MS, with more
+    than INSTRUMENTACAO_MAX_CONSULTAS statements or with a statement repeated
+    INSTRUMENTACAO_REPETICOES times (N+1) are logged as one JSON line.
+    """
+    with app.app_context():
+        from app import db
+        event.listen(db.engine, 'before_cursor_execute', _antes_de_executar)
+        event.listen(db.engine, 'after_cursor_execute', _depois_de_executar)
+    # Chamada antes das outras extensões: o before_request roda primeiro e o
+    # after_request por último, e o tempo medido inclui os hooks delas
+    app.before_request(_iniciar_medicao)
+    app.after_request(lambda response: _registrar_requisicao(app, response))
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import uuid
+import select
+import logging
+import threading
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import delete, event, func, inspect, insert, select as sql_select, text
+from sqlalchemy.orm import Session
+from app import db
+from app.models import RegistroAlteracao
+
+logger = logging.getLogger(__name__)
+
+# Canal do LISTEN/NOTIFY no PostgreSQL
+CANAL = 'invalidacao'
+
+# Por quanto tempo as linhas de registro_alteracoes são guardadas (SQLite)
+RETENCAO_REGISTRO = timedelta(hours=1)
+
+# Identifica este processo: eventos que ele mesmo publicou já foram aplicados no commit
+_TOKEN = uuid.uuid4().hex[:12]
+
+
+def origem():
+    # Inclui o pid para continuar único depois de um fork do gunicorn
+    return f'{os.getpid()}:{_TOKEN}'
+
+
+class Evento(namedtuple('Evento', 'modelo id data')):
+    """
+    A committed change: table name, row id and, for appointments, the day.
+
+    ``id`` or ``data`` set to None means "any row" / "any day"; the model
+    ``'*'`` means everything may have changed (e.g. after the listener lost
+    its connection and could have missed notifications).
+    """
+
+    def afeta(self, modelo, data=None):
+        if self.modelo == '*':
+            return True
+        if self.modelo != modelo:
+            return False
+        return data is None or self.data is None or self.data == data
+
+    def para_json(self):
+        return json.dumps({'m': self.modelo, 'id': self.id,
+                           'd': self.data.isoformat() if self.data else None, 'o': origem()})
+
+    @classmethod
+    def de_json(cls, texto):
+        dados = json.loads(texto)
+        evento = cls(dados['m'], dados.get('id'), date.fromisoformat(dados['d']) if dados.get('d') else None)
+        return evento, dados.get('o')
+
+
+# --- Publicação --------------------------------------------------------------
+
+def _eventos_do_objeto(objeto):
+    tabela = objeto.__tablename__
+    estado = inspect(objeto)
+    # Objetos novos ainda não têm identity key durante o after_flush
+    identidade = estado.mapper.primary_key_from_instance(objeto)[0]
+    if not hasattr(objeto, 'data_consulta'):
+        return [Evento(tabela, identidade, None)]
+
+    # Agendamento mudado de dia invalida o dia antigo e o novo
+    historico = estado.attrs.data_consulta.history
+    datas = {d for d in (historico.added or [objeto.data_consulta]) + list(historico.deleted or ()) if d}
+    return [Evento(tabela, identidade, d) for d in datas] or [Evento(tabela, identidade, None)]
+
+
+def _emitir(connection, eventos):
+    """Write events inside the current transaction; they only go out if it commits"""
+    if connection.dialect.name == 'postgresql':
+        for evento in eventos:
+            connection.execute(text('SELECT pg_notify(:canal, :payload)'),
+                               {'canal': CANAL, 'payload': evento.para_json()})
+        return
+
+    connection.execute(insert(RegistroAlteracao.__table__), [{
+        'modelo': e.modelo, 'registro_id': e.id, 'data': e.data,
+        'origem': origem(), 'criado_em': datetime.now(),
+    } for e in eventos])
+
+
+def _registrar(session, eventos):
+    pendentes = session.info.setdefault('invalidacoes', set())
+    novos = [e for e in eventos if e not in pendentes]
+    if novos:
+        pendentes.update(novos)
+        _emitir(session.connection(), novos)
+
+
+@event.listens_for(Session, 'after_flush')
+def _coletar_alteracoes(session, flush_context):
+    eventos = []
+    for objeto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(objeto, RegistroAlteracao) or not hasattr(objeto, '__tablename__'):
+            continue
+        if objeto in session.dirty and not session.is_modified(objeto, include_collections=False):
+            continue
+        eventos.extend(_eventos_do_objeto(objeto))
+    if eventos:
+        _registrar(session, eventos)
+
+
+def publicar(modelo, id=None, data=None):
+    """
+    Announce a change made without the ORM unit of work (bulk UPDATE or
+    INSERT statements), which the flush hook cannot see. Call it inside the
+    transaction that makes the change.
+    """
+    _registrar(db.session(), [Evento(modelo, id, data)])
+
+
+@event.listens_for(Session, 'after_commit')
+def _aplicar_apos_commit(session):
+    eventos = session.info.pop('invalidacoes', None)
+    if eventos and has_app_context():
+        barramento = current_app.extensions.get('invalidacao')
+        if barramento:
+            barramento.despachar(eventos, local=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_alteracoes(session):
+    session.info.pop('invalidacoes', None)
+
+
+# --- Recepção ----------------------------------------------------------------
+
+class BarramentoInvalidacao:
+    """
+    Delivers change events from every worker to the local caches of this one.
+
+    Callbacks registered with ``assinar`` receive a list of ``Evento``. Changes
+    committed in this process are delivered right after the commit; changes
+    from other processes arrive through a listener thread, via LISTEN/NOTIFY
+    on PostgreSQL or by polling ``registro_alteracoes`` on other databases.
+    Callbacks registered with ``remotos=False`` only see the local commits
+    (for state shared by all workers, which only the writer must touch).
+    """
+
+    def __init__(self, app, intervalo):
+        self.app = app
+        self.intervalo = intervalo
+        self.lock = threading.Lock()
+        self.assinantes = []
+        self.thread = None
+        self.pid = None
+
+    def assinar(self, funcao, remotos=True):
+        with self.lock:
+            self.assinantes.append((funcao, remotos))
+        return funcao
+
+    def despachar(self, eventos, local=False):
+        eventos = list(eventos)
+        with self.lock:
+            assinantes = [funcao for funcao, remotos in self.assinantes if local or remotos]
+        for funcao in assinantes:
+            try:
+                funcao(eventos)
+            except Exception:
+                logger.exception(f'Invalidation callback {funcao.__name__} failed')
+
+    def iniciar(self):
+        """Start the listener thread of this process, once per fork"""
+        if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            alvo = self._escutar_postgres if db.engine.dialect.name == 'postgresql' else self._consultar_registro
+            self.thread = threading.Thread(target=alvo, name='invalidacao', daemon=True)
+            self.thread.start()
+
+    def _recebidos(self, mensagens):
+        eventos = []
+        for mensagem in mensagens:
+            try:
+                evento, remetente = Evento.de_json(mensagem)
+            except (ValueError, KeyError):
+                logger.warning(f'Ignoring malformed invalidation payload: {mensagem!r}')
+                continue
+            if remetente != origem():
+                eventos.append(evento)
+        if eventos:
+            self.despachar(eventos)
+
+    def _escutar_postgres(self):
+        primeira = True
+        while True:
+            conexao = None
+            try:
+                with self.app.app_context():
+                    # Conexão dedicada, fora do pool: fica presa no LISTEN
+                    conexao = db.engine.raw_connection()
+                    conexao.detach()
+                dbapi = conexao.driver_connection
+                dbapi.autocommit = True
+                with dbapi.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CANAL}')
+                if not primeira:
+                    # Notificações enviadas durante a queda se perderam
+                    self.despachar([Evento('*', None, None)])
+                primeira = False
+
+                while True:
+                    if select.select([dbapi], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi.poll()
+                    mensagens = []
+                    while dbapi.notifies:
+                        mensagens.append(dbapi.notifies.pop(0).payload)
+                    self._recebidos(mensagens)
+            except Exception:
+                logger.exception('Invalidation listener lost its connection, reconnecting')
+                time.sleep(5)
+            finally:
+                if conexao is not None:
+                    try:
+                        conexao.close()
+                    except Exception:
+                        pass
+
+    def _consultar_registro(self):
+        tabela = RegistroAlteracao.__table__
+        with self.app.app_context():
+            cursor = None
+            ultima_limpeza = time.monotonic()
+            while True:
+                try:
+                    if cursor is None:
+                        cursor = db.session.execute(sql_select(func.max(tabela.c.id))).scalar() or 0
+                    linhas = db.session.execute(
+                        sql_select(tabela.c.id, tabela.c.modelo, tabela.c.registro_id,
+                                   tabela.c.data, tabela.c.origem)
+                        .where(tabela.c.id > cursor).order_by(tabela.c.id)
+                    ).all()
+                    if linhas:
+                        cursor = linhas[-1].id
+                        eventos = [Evento(l.modelo, l.registro_id, l.data)
+                                   for l in linhas if l.origem != origem()]
+                        if eventos:
+                            self.despachar(eventos)
+
+                    if time.monotonic() - ultima_limpeza > RETENCAO_REGISTRO.total_seconds() / 4:
+                        db.session.execute(delete(tabela).where(
+                            tabela.c.criado_em < datetime.now() - RETENCAO_REGISTRO))
+                        db.session.commit()
+                        ultima_limpeza = time.monotonic()
+                except Exception:
+                    logger.exception('Invalidation poll failed')
+                    db.session.rollback()
+                finally:
+                    # Nova transação a cada volta para enxergar os commits dos outros processos
+                    db.session.remove()
+                time.sleep(self.intervalo)
+
+
+def init_invalidation(app):
+    """Create the bus of this process; the listener starts with the first request"""
+    barramento = BarramentoInvalidacao(app, app.config['INVALIDACAO_INTERVALO'])
+    app.extensions['invalidacao'] = barramento
+    app.before_request(barramento.iniciar)
+    return barramento
+
+
+def ao_alterar(funcao, remotos=True):
+    """Register ``funcao(eventos)`` to run whenever any worker commits a change"""
+    return current_app.extensions['invalidacao'].assinar(funcao, remotos)
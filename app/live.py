@@ -0,0 +1,190 @@
+import json
+import queue
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Agendamento
+
+logger = logging.getLogger(__name__)
+
+# Atraso máximo esperado entre o timestamp de uma alteração e o commit dela;
+# linhas desse período são relidas a cada consulta para que nenhuma escape
+MARGEM_COMMIT = timedelta(seconds=5)
+
+# Eventos pendentes por navegador; quem não consome a tempo é desconectado
+TAMANHO_FILA = 100
+
+
+def serializar_agendamento(agendamento):
+    """Event payload sent to the agenda page"""
+    return {
+        'id': agendamento.id,
+        'data': agendamento.data_consulta.isoformat(),
+        'hora': agendamento.hora_consulta,
+        'duracao': agendamento.duracao_minutos,
+        'paciente_id': agendamento.paciente_id,
+        'paciente': agendamento.paciente.nome,
+        'tipo': agendamento.tipo_consulta,
+        'observacao': agendamento.observacao or '',
+        'status': agendamento.status,
+        'recorrencia': f'{agendamento.recorrencia_id}:{agendamento.data_original.isoformat()}'
+                       if agendamento.recorrencia_id and agendamento.data_original else None,
+        'atualizado_em': (agendamento.atualizado_em or agendamento.data_registro).isoformat(),
+    }
+
+
+class AgendaHub:
+    """
+    Fans appointment changes out to every SSE client of this worker.
+
+    A single background thread watches the database for changed
+    appointments and pushes each change into the queue of every client, so
+    the database sees one query loop per worker however many browsers are
+    connected. Every change is delivered, since an appointment moved to
+    another day must also leave the page of its old day. The thread starts
+    with the first subscriber and stops when the last one leaves; changes
+    announced on the invalidation bus wake it before the next interval.
+
+    Each client holds a server thread for as long as its page is open, so at
+    most ``maximo`` clients are accepted per worker and the remaining
+    threads stay free for ordinary requests.
+    """
+
+    def __init__(self, app, intervalo, maximo):
+        self.app = app
+        self.intervalo = intervalo
+        self.maximo = maximo
+        self.lock = threading.Lock()
+        self.assinantes = set()
+        self.thread = None
+        self.acordar = threading.Event()
+        self.cursor = None
+        self.enviados = {}  # id -> atualizado_em já publicado
+
+    def assinar(self):
+        """Queue of events for a new client, or None when this worker is full"""
+        fila = queue.Queue(maxsize=TAMANHO_FILA)
+        with self.lock:
+            if len(self.assinantes) >= self.maximo:
+                return None
+            self.assinantes.add(fila)
+            if self.thread is None or not self.thread.is_alive():
+                self.cursor = datetime.now() - MARGEM_COMMIT
+                self.enviados = {}
+                self.thread = threading.Thread(target=self._executar, name='agenda-hub', daemon=True)
+                self.thread.start()
+        return fila
+
+    def cancelar(self, fila):
+        with self.lock:
+            self.assinantes.discard(fila)
+
+    def publicar(self, evento):
+        """Deliver an event to every connected client"""
+        with self.lock:
+            destinos = list(self.assinantes)
+        for fila in destinos:
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento: encerra o stream, o navegador reconecta e recarrega
+                logger.info('Dropping slow agenda SSE client')
+                self.cancelar(fila)
+                fila.queue.clear()
+                fila.put_nowait(None)
+
+    def notificar(self, eventos):
+        """Invalidation bus callback: check right away when appointments changed"""
+        if any(evento.afeta('agendamentos') for evento in eventos):
+            self.acordar.set()
+
+    def _executar(self):
+        with self.app.app_context():
+            while True:
+                with self.lock:
+                    if not self.assinantes:
+                        self.thread = None
+                        return
+                try:
+                    self._verificar()
+                except Exception:
+                    logger.exception('Agenda hub poll failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                self.acordar.wait(self.intervalo)
+                self.acordar.clear()
+
+    def _verificar(self):
+        # Faixa do índice em atualizado_em: só as linhas alteradas desde a última consulta
+        alterados = Agendamento.query.options(joinedload(Agendamento.paciente)) \
+            .filter(Agendamento.atualizado_em > self.cursor - MARGEM_COMMIT) \
+            .order_by(Agendamento.atualizado_em).all()
+
+        for agendamento in alterados:
+            if self.enviados.get(agendamento.id) == agendamento.atualizado_em:
+                continue
+            self.enviados[agendamento.id] = agendamento.atualizado_em
+            self.cursor = max(self.cursor, agendamento.atualizado_em)
+            self.publicar(serializar_agendamento(agendamento))
+
+        # Esquece o que já saiu da margem de releitura
+        limite = self.cursor - MARGEM_COMMIT * 2
+        self.enviados = {i: t for i, t in self.enviados.items() if t > limite}
+
+
+_criacao = threading.Lock()
+
+
+def get_hub():
+    """The hub of this worker process, created on first use"""
+    app = current_app._get_current_object()
+    hub = app.extensions.get('agenda_hub')
+    if hub is None:
+        with _criacao:
+            hub = app.extensions.get('agenda_hub')
+            if hub is None:
+                hub = AgendaHub(app, app.config['AGENDA_SSE_INTERVALO'], app.config['AGENDA_SSE_MAXIMO'])
+                app.extensions['invalidacao'].assinar(hub.notificar)
+                app.extensions['agenda_hub'] = hub
+    return hub
+
+
+def eventos_agenda(hub, fila, desde=None, keepalive=15):
+    """
+    Generate the SSE stream of a client subscribed to ``hub`` with ``fila``.
+
+    When the browser reconnects with Last-Event-ID, changes made since then
+    are replayed first so nothing is lost across reconnects. The replay is
+    not limited to the day on the page: an appointment moved away from it
+    must reach the page to be removed, and the page ignores other days.
+    """
+    try:
+        yield 'retry: 3000\n\n'
+        if desde:
+            perdidos = Agendamento.query.options(joinedload(Agendamento.paciente)) \
+                .filter(Agendamento.atualizado_em > desde) \
+                .order_by(Agendamento.atualizado_em).all()
+            for agendamento in perdidos:
+                yield _formatar(serializar_agendamento(agendamento))
+        # O stream pode durar horas: não segura uma conexão do pool
+        db.session.remove()
+
+        while True:
+            try:
+                evento = fila.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': ping\n\n'
+                continue
+            if evento is None:
+                return
+            yield _formatar(evento)
+    finally:
+        hub.cancelar(fila)
+
+
+def _formatar(evento):
+    return f"id: {evento['atualizado_em']}\nevent: agendamento\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
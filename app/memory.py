@@ -0,0 +1,210 @@
+import os
+import gc
+import json
+import signal
+import logging
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from flask import current_app, g, request
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Locais de alocação listados no relatório
+MAX_LOCAIS = 25
+# Rotas listadas no relatório
+MAX_ROTAS = 20
+# Frames do próprio tracemalloc e do import não interessam
+_FILTROS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def rss_atual():
+    """Resident memory of this process in bytes (peak RSS where /proc is missing)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _local(estatistica):
+    quadro = estatistica.traceback[0]
+    return f'{quadro.filename}:{quadro.lineno}'
+
+
+def _diferencas(atual, referencia):
+    return [{
+        'local': _local(e),
+        'tamanho_kb': round(e.size / 1024, 1),
+        'diferenca_kb': round(e.size_diff / 1024, 1),
+        'blocos': e.count,
+        'diferenca_blocos': e.count_diff,
+    } for e in atual.compare_to(referencia, 'lineno')[:MAX_LOCAIS]]
+
+
+class DiagnosticoMemoria:
+    """
+    Memory diagnostics of one worker process.
+
+    With tracemalloc running, each report takes a snapshot and lists the
+    allocation sites that grew the most since the previous report and since
+    the first one (the baseline). Every request also records how much the
+    RSS and the traced memory grew while it ran, per endpoint; with several
+    threads per worker concurrent requests share the blame, so read it as
+    a ranking, not an exact figure.
+    """
+
+    def __init__(self, quadros):
+        self.quadros = quadros
+        self.lock = threading.Lock()
+        self.linha_base = None
+        self.anterior = None
+        # endpoint -> [requisições, crescimento RSS, maior crescimento RSS, crescimento rastreado]
+        self.rotas = {}
+
+    # --- tracemalloc ---
+
+    def iniciar(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.quadros)
+            logger.info(f'tracemalloc started in worker {os.getpid()} ({self.quadros} frames)')
+
+    def parar(self):
+        tracemalloc.stop()
+        with self.lock:
+            self.linha_base = self.anterior = None
+
+    def _capturar(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTROS)
+        with self.lock:
+            anterior, self.anterior = self.anterior, snapshot
+            if self.linha_base is None:
+                self.linha_base = snapshot
+            linha_base = self.linha_base
+        return {
+            'desde_anterior': _diferencas(snapshot, anterior) if anterior else [],
+            'desde_inicio': _diferencas(snapshot, linha_base),
+        }
+
+    # --- Por rota ---
+
+    def inicio_requisicao(self):
+        g.memoria_inicio = (rss_atual(), tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0)
+
+    def fim_requisicao(self, response):
+        inicio = g.pop('memoria_inicio', None)
+        if inicio is not None:
+            crescimento = rss_atual() - inicio[0]
+            rastreado = tracemalloc.get_traced_memory()[0] - inicio[1] if tracemalloc.is_tracing() else 0
+            with self.lock:
+                dados = self.rotas.setdefault(request.endpoint or 'sem_rota', [0, 0, 0, 0])
+                dados[0] += 1
+                dados[1] += crescimento
+                dados[2] = max(dados[2], crescimento)
+                dados[3] += rastreado
+        return response
+
+    # --- Relatório ---
+
+    def relatorio(self):
+        rastreando = tracemalloc.is_tracing()
+        atual, pico = tracemalloc.get_traced_memory() if rastreando else (0, 0)
+        with self.lock:
+            rotas = sorted(self.rotas.items(), key=lambda item: item[1][1], reverse=True)[:MAX_ROTAS]
+        return {
+            'pid': os.getpid(),
+            'rss_mb': round(rss_atual() / 1024 ** 2, 1),
+            'tracemalloc': {
+                'ativo': rastreando,
+                'quadros': tracemalloc.get_traceback_limit() if rastreando else 0,
+                'atual_mb': round(atual / 1024 ** 2, 1),
+                'pico_mb': round(pico / 1024 ** 2, 1),
+                **(self._capturar() if rastreando else {}),
+            },
+            'rotas': [{
+                'endpoint': endpoint,
+                'requisicoes': requisicoes,
+                'rss_kb_total': round(total / 1024, 1),
+                'rss_kb_maximo': round(maximo / 1024, 1),
+                'rastreado_kb_total': round(rastreado / 1024, 1),
+            } for endpoint, (requisicoes, total, maximo, rastreado) in rotas],
+            'sqlalchemy': estado_sqlalchemy(),
+            'gc': {'contagem': gc.get_count(), 'nao_coletaveis': len(gc.garbage)},
+        }
+
+
+def estado_sqlalchemy():
+    """
+    Sessions alive in this process (one per thread of the scoped session),
+    the objects held in their identity maps by model, and the pool state.
+    """
+    from app import db
+    sessoes = [o for o in gc.get_objects() if isinstance(o, Session)]
+    por_modelo = Counter()
+    for sessao in sessoes:
+        for objeto in list(sessao.identity_map.values()):
+            por_modelo[type(objeto).__name__] += 1
+
+    pool = db.engine.pool
+    estado_pool = {'status': pool.status()}
+    for nome, metodo in (('tamanho', 'size'), ('em_uso', 'checkedout'), ('ociosas', 'checkedin')):
+        if hasattr(pool, metodo):
+            estado_pool[nome] = getattr(pool, metodo)()
+    if hasattr(pool, 'overflow'):
+        # Negativo enquanto o pool não chegou ao tamanho configurado
+        estado_pool['excedente'] = max(pool.overflow(), 0)
+    return {
+        'sessoes': len(sessoes),
+        'objetos_no_identity_map': sum(por_modelo.values()),
+        'por_modelo': dict(por_modelo.most_common()),
+        'pool': estado_pool,
+    }
+
+
+def get_diagnostico():
+    return current_app.extensions['memoria']
+
+
+def instalar_sinal(app):
+    """
+    SIGUSR2 on a worker: the first signal starts tracemalloc, the next ones
+    log a report. The work runs on a thread, never inside the handler.
+
+    Called from gunicorn's post_worker_init hook (gunicorn.conf.py): the
+    worker has reset its signals by then, and with --preload the application
+    is imported in the master, where SIGUSR2 means binary upgrade.
+    """
+    diagnostico = app.extensions['memoria']
+
+    def relatar():
+        if not tracemalloc.is_tracing():
+            diagnostico.iniciar()
+            return
+        with app.app_context():
+            logger.warning(json.dumps({'evento': 'relatorio_memoria', **diagnostico.relatorio()},
+                                      ensure_ascii=False, default=str))
+
+    def ao_receber(signum, frame):
+        threading.Thread(target=relatar, name='memoria', daemon=True).start()
+
+    # signal() só funciona no thread principal
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, ao_receber)
+
+
+def init_memory(app):
+    """Per-route memory growth, and tracemalloc when MEMORIA_TRACEMALLOC is set"""
+    diagnostico = DiagnosticoMemoria(app.config['MEMORIA_TRACEMALLOC'] or 1)
+    app.extensions['memoria'] = diagnostico
+    if app.config['MEMORIA_TRACEMALLOC']:
+        diagnostico.iniciar()
+    app.before_request(diagnostico.inicio_requisicao)
+    app.after_request(diagnostico.fim_requisicao)
+    return diagnostico
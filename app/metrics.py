@@ -0,0 +1,150 @@
+import os
+import hmac
+import time
+import logging
+import functools
+from flask import current_app, request, abort, Response
+from sqlalchemy import event
+from app.instrumentation import medicao_atual
+
+logger = logging.getLogger(__name__)
+
+# Faixas dos histogramas (segundos / bytes)
+FAIXAS_REQUISICAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAIXAS_ENVIO = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+FAIXAS_UPLOAD_BYTES = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+FAIXAS_UPLOAD_SEGUNDOS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def modulo_prometheus():
+    try:
+        # prometheus_client is optional: without it no metrics are collected
+        import prometheus_client
+        return prometheus_client
+    except ImportError:
+        return None
+
+
+class Metricas:
+    """
+    The application's Prometheus metrics.
+
+    Under gunicorn (see gunicorn.conf.py) PROMETHEUS_MULTIPROC_DIR is set
+    before the workers start, so every value lives in a memory-mapped file
+    per process and /metrics adds up the files of all workers.
+    """
+
+    def __init__(self, prometheus):
+        self.requisicao_segundos = prometheus.Histogram(
+            'clinica_requisicao_segundos', 'Request latency by route',
+            ['rota', 'metodo'], buckets=FAIXAS_REQUISICAO)
+        self.requisicao_sql_segundos = prometheus.Histogram(
+            'clinica_requisicao_sql_segundos', 'Time spent in SQL per request, by route',
+            ['rota', 'metodo'], buckets=FAIXAS_REQUISICAO)
+        self.respostas = prometheus.Counter(
+            'clinica_respostas', 'Responses by route and status code',
+            ['rota', 'metodo', 'status'])
+
+        # Pool de conexões: soma dos workers vivos
+        self.pool_em_uso = prometheus.Gauge(
+            'clinica_db_pool_em_uso', 'Database connections checked out',
+            multiprocess_mode='livesum')
+        self.pool_excedente = prometheus.Gauge(
+            'clinica_db_pool_excedente', 'Database connections open beyond the pool size',
+            multiprocess_mode='livesum')
+
+        self.notificacao_segundos = prometheus.Histogram(
+            'clinica_notificacao_segundos', 'Notification send latency',
+            ['canal'], buckets=FAIXAS_ENVIO)
+        self.notificacao_falhas = prometheus.Counter(
+            'clinica_notificacao_falhas', 'Notifications not sent', ['canal'])
+
+        self.upload_bytes = prometheus.Histogram(
+            'clinica_upload_bytes', 'Size of uploaded files', ['backend'], buckets=FAIXAS_UPLOAD_BYTES)
+        self.upload_segundos = prometheus.Histogram(
+            'clinica_upload_segundos', 'Time to write an uploaded file to storage',
+            ['backend'], buckets=FAIXAS_UPLOAD_SEGUNDOS)
+
+
+_prometheus = modulo_prometheus()
+# Criadas uma vez por processo: o registro do prometheus_client é global
+METRICAS = Metricas(_prometheus) if _prometheus else None
+
+
+def medir_notificacao(canal):
+    """Decorator for notification senders, which return False when nothing was sent"""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envolvida(*args, **kwargs):
+            if METRICAS is None:
+                return funcao(*args, **kwargs)
+            inicio = time.perf_counter()
+            enviado = False
+            try:
+                enviado = funcao(*args, **kwargs)
+                return enviado
+            finally:
+                METRICAS.notificacao_segundos.labels(canal).observe(time.perf_counter() - inicio)
+                if not enviado:
+                    METRICAS.notificacao_falhas.labels(canal).inc()
+        return envolvida
+    return decorador
+
+
+def registrar_upload(backend, tamanho, segundos):
+    if METRICAS is not None:
+        METRICAS.upload_bytes.labels(backend).observe(tamanho)
+        METRICAS.upload_segundos.labels(backend).observe(segundos)
+
+
+def _registrar_resposta(response):
+    medicao = medicao_atual()
+    if medicao is not None:
+        # Rota como declarada (/pacientes/<int:paciente_id>), nunca a URL: número fixo de séries
+        rota = request.url_rule.rule if request.url_rule else 'sem_rota'
+        METRICAS.requisicao_segundos.labels(rota, request.method).observe(time.perf_counter() - medicao.inicio)
+        METRICAS.requisicao_sql_segundos.labels(rota, request.method).observe(medicao.tempo_db)
+        METRICAS.respostas.labels(rota, request.method, str(response.status_code)).inc()
+    return response
+
+
+def _atualizar_pool(pool):
+    if hasattr(pool, 'checkedout'):
+        METRICAS.pool_em_uso.set(pool.checkedout())
+    if hasattr(pool, 'overflow'):
+        METRICAS.pool_excedente.set(max(pool.overflow(), 0))
+
+
+def exportar_metricas():
+    """Prometheus scrape endpoint; METRICAS_TOKEN is required as a bearer token"""
+    token = current_app.config['METRICAS_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registro = _prometheus.CollectorRegistry()
+        from prometheus_client import multiprocess
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = _prometheus.REGISTRY
+    return Response(_prometheus.generate_latest(registro), mimetype=_prometheus.CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app):
+    """Record request, pool, notification and upload metrics and serve them at /metrics"""
+    if METRICAS is None:
+        app.logger.info('prometheus_client not installed, /metrics disabled')
+        return
+
+    with app.app_context():
+        from app import db
+        pool = db.engine.pool
+        event.listen(db.engine, 'checkout', lambda *args: _atualizar_pool(pool))
+        event.listen(db.engine, 'checkin', lambda *args: _atualizar_pool(pool))
+    # Depois de init_instrumentation: este after_request roda antes do dela e ainda vê a medição
+    app.after_request(_registrar_resposta)
+    # Rotas, taxas de requisição e o pool não ficam públicos: sem token, sem /metrics
+    if not app.config['METRICAS_TOKEN']:
+        app.logger.info('METRICAS_TOKEN not set, /metrics disabled')
+        return
+    app.add_url_rule('/metrics', 'exportar_metricas', exportar_metricas)
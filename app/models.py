@@ -16,6 +16,7 @@ class Usuario(UserMixin, db.Model):
     ativo = db.Column(db.Boolean, default=True)
     ultimo_acesso = db.Column(db.DateTime)
     data_cadastro = db.Column(db.DateTime, default=datetime.now)
+    ical_token = db.Column(db.String(64), unique=True, index=True)  # acesso ao feed iCalendar da agenda
 
 class Paciente(db.Model):
     __tablename__ = 'pacientes'
@@ -35,6 +36,9 @@ class Paciente(db.Model):
     habitos = db.Column(db.Text)
     observacoes = db.Column(db.Text)
     data_cadastro = db.Column(db.DateTime, default=datetime.now)
+    # Versão do prontuário: incrementada a cada gravação do paciente ou dos seus registros (ver app/versioning.py)
+    versao = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    atualizado_em = db.Column(db.DateTime)
     
     # Relationships
     evolucoes = db.relationship('Evolucao', backref='paciente', lazy='dynamic', cascade='all, delete-orphan')
@@ -74,15 +78,41 @@ class Radiografia(db.Model):
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
     nome_arquivo = db.Column(db.String(256), nullable=False)
     descricao = db.Column(db.Text)
-    arquivo_caminho = db.Column(db.String(512))  # Caminho para o arquivo no servidor
+    arquivo_caminho = db.Column(db.String(512), index=True)  # Chave do arquivo no storage
     arquivo_nome_original = db.Column(db.String(256))  # Nome original do arquivo
     arquivo_tipo = db.Column(db.String(128))  # Tipo MIME do arquivo
     arquivo_tamanho = db.Column(db.Integer)  # Tamanho em bytes
     data_upload = db.Column(db.DateTime, default=datetime.now)
     
+    # Metadados extraídos do cabeçalho do arquivo (EXIF/TIFF/DICOM)
+    metadados = db.relationship('RadiografiaMetadados', backref='radiografia', uselist=False,
+                                cascade='all, delete-orphan')
+    
     def __repr__(self):
         return f'<Radiografia {self.id} - Paciente {self.paciente_id}>'
 
+class RadiografiaMetadados(db.Model):
+    __tablename__ = 'radiografia_metadados'
+    
+    radiografia_id = db.Column(db.Integer, db.ForeignKey('radiografias.id', ondelete='CASCADE'), primary_key=True)
+    status = db.Column(db.String(20), default='pendente', index=True)  # pendente, extraido, erro
+    formato = db.Column(db.String(16))  # jpeg, png, gif, bmp, tiff, dicom, pdf
+    modalidade = db.Column(db.String(16), index=True)  # Código DICOM: IO, PX, CR, DX...
+    largura = db.Column(db.Integer)
+    altura = db.Column(db.Integer)
+    data_aquisicao = db.Column(db.DateTime, index=True)
+    fabricante = db.Column(db.String(128))
+    dispositivo = db.Column(db.String(128), index=True)
+    erro = db.Column(db.Text)
+    data_extracao = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_radiografia_metadados_dimensoes', 'largura', 'altura'),
+    )
+    
+    def __repr__(self):
+        return f'<RadiografiaMetadados {self.radiografia_id} - {self.status}>'
+
 class Agendamento(db.Model):
     __tablename__ = 'agendamentos'
     
@@ -94,10 +124,59 @@ class Agendamento(db.Model):
     observacao = db.Column(db.Text)
     status = db.Column(db.String(20), default='agendada')  # agendada, concluida, cancelada, faltou
     data_registro = db.Column(db.DateTime, default=datetime.now)
+    duracao_minutos = db.Column(db.Integer, nullable=False, default=30, server_default='30')
+    # Intervalo ocupado em minutos desde a meia-noite, derivado de hora_consulta/duracao_minutos
+    inicio_minutos = db.Column(db.Integer)
+    fim_minutos = db.Column(db.Integer)
+    # Ocorrência de uma série recorrente gravada ao ser editada/cancelada
+    recorrencia_id = db.Column(db.Integer, db.ForeignKey('recorrencias_agendamento.id', ondelete='SET NULL'))
+    data_original = db.Column(db.Date)  # data da ocorrência que este registro substitui
+    atualizado_em = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, index=True)
+    
+    __table_args__ = (
+        # Cobre a agregação mensal por dia/status sem ler a tabela
+        db.Index('ix_agendamentos_data_status', 'data_consulta', 'status'),
+        # Busca de sobreposição: faixa de início dentro do dia
+        db.Index('ix_agendamentos_data_inicio', 'data_consulta', 'inicio_minutos'),
+        # Uma ocorrência é materializada no máximo uma vez
+        db.Index('ix_agendamentos_recorrencia_data', 'recorrencia_id', 'data_original', unique=True),
+    )
     
     def __repr__(self):
         return f'<Agendamento {self.id} - Paciente {self.paciente_id}>'
 
+class RecorrenciaAgendamento(db.Model):
+    """
+    Regra de agendamento recorrente. As ocorrências são calculadas sob demanda
+    para o período consultado; só viram linhas em `agendamentos` quando editadas.
+    """
+    __tablename__ = 'recorrencias_agendamento'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id', ondelete='CASCADE'), nullable=False, index=True)
+    frequencia = db.Column(db.String(10), nullable=False, default='semanal')  # diaria, semanal, mensal
+    intervalo = db.Column(db.Integer, nullable=False, default=1)
+    data_inicio = db.Column(db.Date, nullable=False)
+    data_fim = db.Column(db.Date)  # inclusive; vazio = sem data de término
+    total_ocorrencias = db.Column(db.Integer)  # vazio = sem limite
+    hora_consulta = db.Column(db.String(5), nullable=False)  # Format: HH:MM
+    duracao_minutos = db.Column(db.Integer, nullable=False, default=30)
+    tipo_consulta = db.Column(db.String(128), nullable=False)
+    observacao = db.Column(db.Text)
+    data_registro = db.Column(db.DateTime, default=datetime.now)
+    atualizado_em = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    paciente = db.relationship('Paciente', backref=db.backref('recorrencias', lazy='dynamic',
+                                                              cascade='all, delete-orphan'))
+    agendamentos = db.relationship('Agendamento', backref='recorrencia', lazy='dynamic')
+    
+    __table_args__ = (
+        db.Index('ix_recorrencias_periodo', 'data_inicio', 'data_fim'),
+    )
+    
+    def __repr__(self):
+        return f'<Recorrencia {self.id} - Paciente {self.paciente_id}>'
+
 class FormularioPreConsulta(db.Model):
     __tablename__ = 'formularios_pre_consulta'
     
@@ -149,3 +228,32 @@ class FormularioPrimeiraConsulta(db.Model):
     
     def __repr__(self):
         return f'<FormularioPrimeiraConsulta {self.id} - {self.nome or "Não preenchido"}>'
+
+class UsoArmazenamento(db.Model):
+    __tablename__ = 'uso_armazenamento'
+    
+    # Totais mantidos incrementalmente a cada gravação de Radiografia (ver app/upload_gc.py)
+    paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id', ondelete='CASCADE'), primary_key=True)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    total_arquivos = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<UsoArmazenamento Paciente {self.paciente_id} - {self.total_bytes} bytes>'
+
+class RegistroAlteracao(db.Model):
+    __tablename__ = 'registro_alteracoes'
+    
+    # Fila de invalidação entre processos quando o banco não tem LISTEN/NOTIFY (ver app/invalidation.py)
+    id = db.Column(db.Integer, primary_key=True)
+    modelo = db.Column(db.String(50), nullable=False)
+    registro_id = db.Column(db.Integer)
+    data = db.Column(db.Date)
+    origem = db.Column(db.String(50), nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.now, index=True)
+    
+    # Os processos leem "id > último visto": no SQLite, sem AUTOINCREMENT, os ids
+    # voltariam a ser usados depois que a limpeza esvazia a tabela
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    def __repr__(self):
+        return f'<RegistroAlteracao {self.modelo} {self.registro_id}>'
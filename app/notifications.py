@@ -4,6 +4,8 @@ import re
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from twilio.rest import Client
+from app.metrics import medir_notificacao
+from app.tracing import rastreada
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -16,6 +18,8 @@ TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
 TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
 
+@medir_notificacao('email')
+@rastreada('enviar e-mail', 'sendgrid')
 def send_email(to_email, subject, html_content, text_content=None):
     """
     Send an email using SendGrid API
@@ -82,6 +86,8 @@ def send_formulario_email(paciente_nome, paciente_email, token_url):
     
     return send_email(paciente_email, subject, html_content, text_content)
 
+@medir_notificacao('sms')
+@rastreada('enviar SMS', 'twilio')
 def send_lembrete_consulta_sms(telefone, paciente_nome, data_consulta, hora_consulta):
     """
     Send appointment reminder via SMS using Twilio
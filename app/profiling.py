@@ -0,0 +1,123 @@
+import os
+import sys
+import uuid
+import threading
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from flask import current_app, g, request, url_for
+from flask_login import current_user
+
+# Extensão dos perfis: "folded stacks", lido por flamegraph.pl, speedscope e inferno
+EXTENSAO = '.folded'
+
+
+@lru_cache(maxsize=None)
+def _arquivo(caminho):
+    """Shortest path of a source file relative to sys.path (e.g. flask/app.py)"""
+    relativos = [os.path.relpath(caminho, base) for base in sys.path
+                 if base and caminho.startswith(os.path.join(base, ''))]
+    return min(relativos, key=len) if relativos else caminho
+
+
+class AmostradorPilhas:
+    """
+    Sampling profiler for one thread.
+
+    A background thread reads the stack of ``thread_id`` every ``intervalo``
+    seconds and counts identical stacks, which is what a flame graph needs.
+    The profiled thread runs unmodified (no tracing hook), so timings stay
+    close to those of an unprofiled request.
+    """
+
+    def __init__(self, thread_id, intervalo):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.pilhas = Counter()
+        self.parado = threading.Event()
+        self.thread = threading.Thread(target=self._amostrar, name='perfil', daemon=True)
+
+    def iniciar(self):
+        self.thread.start()
+
+    def parar(self):
+        self.parado.set()
+        self.thread.join()
+        return self.pilhas
+
+    def _amostrar(self):
+        while not self.parado.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            pilha = []
+            while frame is not None:
+                codigo = frame.f_code
+                pilha.append(f'{codigo.co_name} ({_arquivo(codigo.co_filename)}:{codigo.co_firstlineno})')
+                frame = frame.f_back
+            if pilha:
+                self.pilhas[';'.join(reversed(pilha))] += 1
+
+
+def pasta_perfis():
+    return current_app.config['PERFIL_DIR']
+
+
+def listar_perfis():
+    """Saved profiles, newest first, as (name, size in bytes, modification time)"""
+    pasta = pasta_perfis()
+    if not os.path.isdir(pasta):
+        return []
+    perfis = []
+    for nome in os.listdir(pasta):
+        if nome.endswith(EXTENSAO):
+            info = os.stat(os.path.join(pasta, nome))
+            perfis.append((nome, info.st_size, datetime.fromtimestamp(info.st_mtime)))
+    return sorted(perfis, key=lambda perfil: perfil[2], reverse=True)
+
+
+def _salvar(nome, pilhas):
+    pasta = pasta_perfis()
+    os.makedirs(pasta, exist_ok=True)
+    with open(os.path.join(pasta, nome), 'w') as f:
+        for pilha, amostras in pilhas.most_common():
+            f.write(f'{pilha} {amostras}\n')
+    # Mantém só os mais recentes
+    for antigo, _, _ in listar_perfis()[current_app.config['PERFIL_MAX_ARQUIVOS']:]:
+        os.remove(os.path.join(pasta, antigo))
+
+
+def _pedido():
+    return 'perfil' in request.args or 'X-Perfil' in request.headers
+
+
+def _iniciar_perfil():
+    # Sem o pedido explícito nada mais é feito: nem a sessão é consultada
+    if not _pedido() or not current_user.is_authenticated or current_user.tipo != 'admin':
+        return
+    g.perfil_nome = f'{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint}-{uuid.uuid4().hex[:6]}{EXTENSAO}'
+    g.perfil = AmostradorPilhas(threading.get_ident(), current_app.config['PERFIL_INTERVALO_MS'] / 1000)
+    g.perfil.iniciar()
+
+
+def _anunciar_perfil(response):
+    if 'perfil' in g:
+        response.headers['X-Perfil'] = url_for('baixar_perfil', nome=g.perfil_nome)
+    return response
+
+
+def _encerrar_perfil(exc):
+    amostrador = g.pop('perfil', None)
+    if amostrador is not None:
+        _salvar(g.perfil_nome, amostrador.parar())
+        current_app.logger.info(f'Profile of {request.path} saved as {g.perfil_nome}')
+
+
+def init_profiling(app):
+    """
+    Profile requests sent by an admin with ``?perfil=1`` or an ``X-Perfil``
+    header. The folded stacks are written to PERFIL_DIR, listed at
+    /admin/perfis, and the response carries the download URL in X-Perfil.
+    """
+    app.before_request(_iniciar_perfil)
+    app.after_request(_anunciar_perfil)
+    # teardown: roda também quando a view levanta exceção
+    app.teardown_request(_encerrar_perfil)
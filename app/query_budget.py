@@ -0,0 +1,171 @@
+import re
+import threading
+from collections import Counter
+from datetime import date
+from sqlalchemy import event, func
+from app import db
+from app.models import Usuario, Paciente, Radiografia, FormularioPreConsulta
+from app.cache import get_cache
+from app.benchmark import rotas_quentes, requisitar
+
+# Consultas SQL permitidas por rota (incluindo a do usuário logado), com o
+# cache vazio e para qualquer volume de dados: listas paginadas ou de um dia
+# não podem crescer com o banco.
+# Uma rota que passou a consultar menos deve ter o orçamento reduzido junto.
+ORCAMENTOS = {
+    'dashboard': 6,
+    'pacientes': 3,
+    'pacientes_pagina_final': 3,
+    'busca_nome': 3,
+    'busca_cpf': 3,
+    'agenda_dia': 3,
+    'agenda_mes': 3,
+    'formularios': 3,
+    'formularios_preenchidos': 3,
+    'formularios_todos': 3,
+    'formulario': 5,
+    'anamnese_busca': 3,
+    'paciente': 9,
+    'evolucoes': 4,
+    'radiografias': 5,
+    'novo_agendamento': 2,
+    'agenda_conflitos': 3,
+    'horarios_livres': 3,
+    'usuarios': 2,
+    'primeira_consulta': 3,
+}
+
+# Volume de cada rodada de dados; a segunda rodada dobra o banco
+VOLUME_PADRAO = {
+    'pacientes': 300,
+    'evolucoes': 2000,
+    'agendamentos': 1500,
+    'formularios': 200,
+    'radiografias': 20,
+}
+
+
+def rotas_verificadas():
+    """Hot routes of the benchmark plus the other read-only pages, as (name, path)"""
+    rotas = rotas_quentes()
+    paciente_id = db.session.query(func.min(Paciente.id)).scalar()
+    formulario_id = db.session.query(func.max(FormularioPreConsulta.id)).scalar()
+    hoje = date.today().isoformat()
+    rotas += [
+        ('formularios_preenchidos', '/formularios?tipo=preenchido'),
+        ('formularios_todos', '/formularios?tipo=todos'),
+        ('agenda_conflitos', f'/agendamentos/conflitos?data={hoje}&hora=09:00'),
+        ('horarios_livres', '/agendamentos/horarios-livres'),
+        ('usuarios', '/admin/usuarios'),
+        ('primeira_consulta', '/admin/formularios-primeira-consulta'),
+    ]
+    if paciente_id:
+        rotas.append(('novo_agendamento', f'/pacientes/{paciente_id}/agendamentos/novo'))
+    if formulario_id:
+        rotas.append(('formulario', f'/formularios/{formulario_id}'))
+    return rotas
+
+
+def normalizar(sql):
+    """One-line SQL with literal numbers and IN lists collapsed, to group repeats"""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    return re.sub(r'\((?:\?|%\(\w+\)s|:\w+)(?:, (?:\?|%\(\w+\)s|:\w+))+\)', '(...)', sql)
+
+
+class MedicaoRota:
+    """SQL statements one route ran at each data volume, against its budget"""
+
+    def __init__(self, nome, orcamento):
+        self.nome = nome
+        self.orcamento = orcamento
+        self.caminhos = []
+        self.status = []
+        self.consultas = []
+
+    @property
+    def maximo(self):
+        return max(len(consultas) for consultas in self.consultas)
+
+    @property
+    def excedeu(self):
+        return self.orcamento is not None and self.maximo > self.orcamento
+
+    @property
+    def cresceu(self):
+        """More statements with more rows: a query per row somewhere"""
+        return len(self.consultas[-1]) > len(self.consultas[0])
+
+    @property
+    def falhou(self):
+        return self.orcamento is None or self.excedeu or self.cresceu or any(s >= 500 for s in self.status)
+
+    def repetidas(self):
+        """Statements run more than once in the largest run, as (times, SQL)"""
+        contagem = Counter(normalizar(sql) for sql in self.consultas[-1])
+        return [(vezes, sql) for sql, vezes in contagem.most_common() if vezes > 1]
+
+    def acrescidas(self):
+        """Statements the largest run made beyond the smallest one, as (extra times, SQL)"""
+        extras = Counter(normalizar(sql) for sql in self.consultas[-1])
+        extras.subtract(Counter(normalizar(sql) for sql in self.consultas[0]))
+        return [(vezes, sql) for sql, vezes in extras.most_common() if vezes > 0]
+
+
+def _medir(cliente, caminho, capturadas):
+    # Cache vazio: o orçamento vale para a requisição que realmente consulta o banco
+    get_cache().clear()
+    capturadas.clear()
+    resposta = requisitar(cliente, caminho)
+    return resposta.status_code, list(capturadas)
+
+
+def verificar_orcamentos(app, rodadas=2, volume=None, semente=42, filtro=None, progresso=print):
+    """
+    Seed the (empty) database of ``app`` ``rodadas`` times with ``volume``
+    rows and, after each round, request every route once as an admin while
+    recording its SQL. Returns one MedicaoRota per route.
+    """
+    from app.dataset import GeradorDados
+
+    if db.session.query(func.count(Paciente.id)).scalar():
+        raise ValueError(f'{db.engine.url.render_as_string(hide_password=True)} already has patients; '
+                         'the check needs an empty database')
+    admin = Usuario.query.filter_by(tipo='admin', ativo=True).first()
+    if not admin:
+        raise ValueError('No active admin user to authenticate the requests')
+    admin_id = admin.id
+
+    cliente = app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['_user_id'] = str(admin_id)
+        sessao['_fresh'] = True
+
+    capturadas = []
+    thread = threading.get_ident()
+
+    def capturar(conn, cursor, statement, *args):
+        # Só as consultas da requisição: as threads de invalidação e de tarefas usam o mesmo engine
+        if threading.get_ident() == thread:
+            capturadas.append(statement)
+
+    medicoes = {}
+    for rodada in range(rodadas):
+        GeradorDados(semente=semente + rodada, progresso=progresso).gerar(**(volume or VOLUME_PADRAO))
+        rotas = [(nome, caminho) for nome, caminho in rotas_verificadas() if not filtro or nome in filtro]
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute', capturar)
+        try:
+            # Descartada: consultas feitas uma vez por processo não contam para a primeira rota
+            _medir(cliente, '/dashboard', capturadas)
+            for nome, caminho in rotas:
+                medicao = medicoes.setdefault(nome, MedicaoRota(nome, ORCAMENTOS.get(nome)))
+                status, consultas = _medir(cliente, caminho, capturadas)
+                medicao.caminhos.append(caminho)
+                medicao.status.append(status)
+                medicao.consultas.append(consultas)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capturar)
+        progresso(f'Rodada {rodada + 1}: {db.session.query(func.count(Paciente.id)).scalar()} pacientes, '
+                  f'{db.session.query(func.count(Radiografia.id)).scalar()} radiografias')
+    return list(medicoes.values())
@@ -0,0 +1,388 @@
+import struct
+import logging
+from datetime import datetime
+from app import db
+from app.models import Radiografia, RadiografiaMetadados
+from app.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Tamanho dos blocos lidos do storage; cabeçalhos cabem quase sempre no primeiro
+BLOCK_SIZE = 64 * 1024
+MAX_CACHED_BLOCKS = 16
+
+# Tamanho em bytes de cada tipo de campo TIFF
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+TIFF_TAG_WIDTH = 256
+TIFF_TAG_HEIGHT = 257
+TIFF_TAG_MAKE = 271
+TIFF_TAG_MODEL = 272
+TIFF_TAG_DATETIME = 306
+TIFF_TAG_EXIF_IFD = 34665
+EXIF_TAG_DATETIME_ORIGINAL = 36867
+EXIF_TAG_DATETIME_DIGITIZED = 36868
+
+# Marcadores JPEG "Start Of Frame" (C4, C8 e CC não são SOF)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+DICOM_IMPLICIT_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+# VRs explícitos cujo comprimento ocupa 4 bytes (precedido por 2 reservados)
+DICOM_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+DICOM_UNDEFINED_LENGTH = 0xFFFFFFFF
+# Sequências de tamanho indefinido aninhadas; arquivos reais ficam em poucos níveis
+DICOM_MAX_NIVEIS = 32
+DICOM_TAGS = {
+    (0x0002, 0x0010): 'transfer_syntax',
+    (0x0008, 0x0020): 'study_date',
+    (0x0008, 0x0022): 'acquisition_date',
+    (0x0008, 0x0023): 'content_date',
+    (0x0008, 0x0030): 'study_time',
+    (0x0008, 0x0032): 'acquisition_time',
+    (0x0008, 0x0033): 'content_time',
+    (0x0008, 0x0060): 'modality',
+    (0x0008, 0x0070): 'manufacturer',
+    (0x0008, 0x1090): 'model',
+    (0x0028, 0x0010): 'rows',
+    (0x0028, 0x0011): 'columns',
+}
+
+
+class RangedFile:
+    """
+    Read-only, seekable file over ``Storage.read``.
+
+    Only the blocks actually touched by the parsers are fetched, so pixel
+    data is never downloaded.
+    """
+
+    def __init__(self, storage, key, block_size=BLOCK_SIZE):
+        self.storage = storage
+        self.key = key
+        self.block_size = block_size
+        self.pos = 0
+        self.blocks = {}
+
+    def seek(self, pos, whence=0):
+        self.pos = self.pos + pos if whence == 1 else pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def _block(self, index):
+        if index not in self.blocks:
+            if len(self.blocks) >= MAX_CACHED_BLOCKS:
+                self.blocks.clear()
+            self.blocks[index] = self.storage.read(self.key, index * self.block_size, self.block_size)
+        return self.blocks[index]
+
+    def read(self, size):
+        out = bytearray()
+        while size > 0:
+            index, offset = divmod(self.pos, self.block_size)
+            chunk = self._block(index)[offset:offset + size]
+            if not chunk:
+                break
+            out += chunk
+            self.pos += len(chunk)
+            size -= len(chunk)
+        return bytes(out)
+
+
+def _exif_datetime(valor):
+    try:
+        return datetime.strptime(valor[:19], '%Y:%m:%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+
+def _dicom_datetime(data, hora):
+    if not data:
+        return None
+    try:
+        resultado = datetime.strptime(data[:8], '%Y%m%d')
+    except ValueError:
+        return None
+    hora = (hora or '').split('.')[0].replace(':', '')
+    if len(hora) >= 4 and hora.isdigit():
+        resultado = resultado.replace(hour=int(hora[:2]), minute=int(hora[2:4]),
+                                      second=int(hora[4:6]) if len(hora) >= 6 else 0)
+    return resultado
+
+
+# --- TIFF / EXIF ---------------------------------------------------------------
+
+def _ler_ifd(f, base, offset, endian):
+    f.seek(base + offset)
+    count = struct.unpack(endian + 'H', f.read(2))[0]
+    if count > 1024:
+        raise ValueError('IFD TIFF inválido')
+
+    entradas = {}
+    for _ in range(count):
+        entrada = f.read(12)
+        if len(entrada) < 12:
+            break
+        tag, tipo, quantidade = struct.unpack(endian + 'HHI', entrada[:8])
+        entradas[tag] = (tipo, quantidade, entrada[8:12])
+    return entradas
+
+
+def _valor_tiff(f, base, endian, entrada):
+    tipo, quantidade, bruto = entrada
+    tamanho = TIFF_TYPE_SIZES.get(tipo, 1) * quantidade
+    if tamanho > 4:
+        f.seek(base + struct.unpack(endian + 'I', bruto)[0])
+        bruto = f.read(min(tamanho, 1024))
+
+    if tipo == 2:
+        return bruto[:tamanho].split(b'\0', 1)[0].decode('latin-1').strip() or None
+    if tipo == 3:
+        return struct.unpack(endian + 'H', bruto[:2])[0]
+    if tipo == 4:
+        return struct.unpack(endian + 'I', bruto[:4])[0]
+    return None
+
+
+def _ler_tiff(f, base, dados):
+    f.seek(base)
+    ordem = f.read(2)
+    if ordem == b'II':
+        endian = '<'
+    elif ordem == b'MM':
+        endian = '>'
+    else:
+        return
+    if struct.unpack(endian + 'H', f.read(2))[0] != 42:
+        return
+
+    ifd0 = _ler_ifd(f, base, struct.unpack(endian + 'I', f.read(4))[0], endian)
+
+    def valor(entradas, tag):
+        return _valor_tiff(f, base, endian, entradas[tag]) if tag in entradas else None
+
+    dados.setdefault('largura', valor(ifd0, TIFF_TAG_WIDTH))
+    dados.setdefault('altura', valor(ifd0, TIFF_TAG_HEIGHT))
+    dados['fabricante'] = valor(ifd0, TIFF_TAG_MAKE)
+    dados['dispositivo'] = valor(ifd0, TIFF_TAG_MODEL)
+    data = valor(ifd0, TIFF_TAG_DATETIME)
+
+    if TIFF_TAG_EXIF_IFD in ifd0:
+        ponteiro = valor(ifd0, TIFF_TAG_EXIF_IFD)
+        if not isinstance(ponteiro, int):
+            raise ValueError('Ponteiro EXIF inválido')
+        exif = _ler_ifd(f, base, ponteiro, endian)
+        data = valor(exif, EXIF_TAG_DATETIME_ORIGINAL) or valor(exif, EXIF_TAG_DATETIME_DIGITIZED) or data
+
+    dados['data_aquisicao'] = _exif_datetime(data)
+
+
+# --- JPEG ----------------------------------------------------------------------
+
+def _ler_jpeg(f, dados):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return
+        if byte != b'\xff':
+            continue
+
+        marcador = f.read(1)
+        while marcador == b'\xff':
+            marcador = f.read(1)
+        if not marcador:
+            return
+        marcador = marcador[0]
+
+        if marcador == 0x01 or 0xD0 <= marcador <= 0xD8:
+            continue
+        # Início dos dados da imagem: nada mais a ler no cabeçalho
+        if marcador in (0xDA, 0xD9):
+            return
+
+        tamanho = struct.unpack('>H', f.read(2))[0]
+        if tamanho < 2:
+            raise ValueError('Segmento JPEG inválido')
+        inicio = f.tell()
+
+        if marcador == 0xE1 and f.read(6) == b'Exif\0\0':
+            _ler_tiff(f, inicio + 6, dados)
+        elif marcador in JPEG_SOF_MARKERS:
+            f.seek(inicio + 1)
+            dados['altura'], dados['largura'] = struct.unpack('>HH', f.read(4))
+            return
+
+        f.seek(inicio + tamanho - 2)
+
+
+# --- DICOM ---------------------------------------------------------------------
+
+def _ler_cabecalho_elemento(f, explicito):
+    cabecalho = f.read(8)
+    if len(cabecalho) < 8:
+        return None
+    grupo, elemento = struct.unpack('<HH', cabecalho[:4])
+
+    # Itens e delimitadores nunca têm VR
+    if grupo == 0xFFFE or not explicito:
+        return grupo, elemento, None, struct.unpack('<I', cabecalho[4:])[0]
+
+    vr = cabecalho[4:6]
+    if vr in DICOM_LONG_VRS:
+        return grupo, elemento, vr, struct.unpack('<I', f.read(4))[0]
+    return grupo, elemento, vr, struct.unpack('<H', cabecalho[6:])[0]
+
+
+def _pular_elementos(f, explicito, delimitador, nivel=1):
+    """Skip elements until ``delimitador`` (end of an undefined-length item or sequence)"""
+    if nivel > DICOM_MAX_NIVEIS:
+        raise ValueError('DICOM com sequências aninhadas demais')
+    while True:
+        elemento = _ler_cabecalho_elemento(f, explicito)
+        if elemento is None:
+            raise ValueError('DICOM truncado')
+        grupo, numero, _, tamanho = elemento
+        if (grupo, numero) == delimitador:
+            return
+        if tamanho == DICOM_UNDEFINED_LENGTH:
+            # Sequência (ou item) de tamanho indefinido dentro de outra
+            fim = (0xFFFE, 0xE00D) if (grupo, numero) == (0xFFFE, 0xE000) else (0xFFFE, 0xE0DD)
+            _pular_elementos(f, explicito, fim, nivel + 1)
+        else:
+            f.seek(tamanho, 1)
+
+
+def _ler_dicom(f, dados):
+    valores = {}
+    explicito = True
+    f.seek(132)
+
+    while True:
+        elemento = _ler_cabecalho_elemento(f, explicito)
+        if elemento is None:
+            break
+        grupo, numero, vr, tamanho = elemento
+
+        # Após o grupo de meta-informação, a sintaxe de transferência define o VR
+        if grupo != 0x0002 and explicito and \
+                valores.get('transfer_syntax') == DICOM_IMPLICIT_LITTLE_ENDIAN:
+            explicito = False
+            f.seek(-8 if vr is None or vr not in DICOM_LONG_VRS else -12, 1)
+            continue
+
+        # Tudo o que interessa está antes dos dados de pixel (7FE0,0010)
+        if grupo > 0x0028:
+            break
+
+        if tamanho == DICOM_UNDEFINED_LENGTH:
+            _pular_elementos(f, explicito, (0xFFFE, 0xE0DD))
+            continue
+
+        nome = DICOM_TAGS.get((grupo, numero))
+        if nome is None:
+            f.seek(tamanho, 1)
+            continue
+
+        bruto = f.read(tamanho)
+        if nome in ('rows', 'columns'):
+            valores[nome] = struct.unpack('<H', bruto[:2])[0] if len(bruto) >= 2 else None
+        else:
+            valores[nome] = bruto.split(b'\0', 1)[0].decode('latin-1').strip() or None
+
+    dados['modalidade'] = valores.get('modality')
+    dados['largura'] = valores.get('columns')
+    dados['altura'] = valores.get('rows')
+    dados['fabricante'] = valores.get('manufacturer')
+    dados['dispositivo'] = valores.get('model')
+    dados['data_aquisicao'] = (
+        _dicom_datetime(valores.get('acquisition_date'), valores.get('acquisition_time')) or
+        _dicom_datetime(valores.get('content_date'), valores.get('content_time')) or
+        _dicom_datetime(valores.get('study_date'), valores.get('study_time'))
+    )
+
+
+def extrair_metadados(f):
+    """
+    Read image metadata from the header of a seekable binary file.
+
+    Only header structures are parsed (EXIF/TIFF IFDs, JPEG markers, PNG
+    IHDR, DICOM data elements up to the pixel data); pixel data is never
+    read or decoded. A truncated or malformed header raises ValueError.
+    """
+    try:
+        return _extrair(f)
+    except struct.error:
+        raise ValueError('Cabeçalho truncado ou inválido') from None
+
+
+def _extrair(f):
+    f.seek(0)
+    cabecalho = f.read(132)
+    dados = {}
+
+    if cabecalho[128:132] == b'DICM':
+        dados['formato'] = 'dicom'
+        _ler_dicom(f, dados)
+    elif cabecalho[:2] == b'\xff\xd8':
+        dados['formato'] = 'jpeg'
+        _ler_jpeg(f, dados)
+    elif cabecalho[:8] == b'\x89PNG\r\n\x1a\n' and cabecalho[12:16] == b'IHDR':
+        dados['formato'] = 'png'
+        dados['largura'], dados['altura'] = struct.unpack('>II', cabecalho[16:24])
+    elif cabecalho[:6] in (b'GIF87a', b'GIF89a'):
+        dados['formato'] = 'gif'
+        dados['largura'], dados['altura'] = struct.unpack('<HH', cabecalho[6:10])
+    elif cabecalho[:2] == b'BM' and len(cabecalho) >= 26:
+        dados['formato'] = 'bmp'
+        largura, altura = struct.unpack('<ii', cabecalho[18:26])
+        dados['largura'], dados['altura'] = largura, abs(altura)
+    elif cabecalho[:4] in (b'II*\0', b'MM\0*'):
+        dados['formato'] = 'tiff'
+        _ler_tiff(f, 0, dados)
+    elif cabecalho[:4] == b'%PDF':
+        dados['formato'] = 'pdf'
+
+    return dados
+
+
+def extrair_radiografia(radiografia_id):
+    """Extract and store the metadata of one radiograph (runs on the worker pool)"""
+    radiografia = db.session.get(Radiografia, radiografia_id)
+    if radiografia is None:
+        return None
+
+    metadados = radiografia.metadados or RadiografiaMetadados(radiografia=radiografia)
+    metadados.data_extracao = datetime.now()
+
+    try:
+        if not radiografia.arquivo_caminho:
+            raise ValueError('Radiografia sem arquivo associado')
+
+        dados = extrair_metadados(RangedFile(get_storage(), radiografia.arquivo_caminho))
+        for campo in ('formato', 'modalidade', 'largura', 'altura', 'data_aquisicao', 'fabricante', 'dispositivo'):
+            valor = dados.get(campo)
+            if isinstance(valor, str):
+                # Cada coluna tem o seu tamanho (formato e modalidade: 16); o PostgreSQL recusa o excesso
+                valor = valor[:RadiografiaMetadados.__table__.c[campo].type.length]
+            setattr(metadados, campo, valor)
+        metadados.status = 'extraido'
+        metadados.erro = None
+    except Exception as e:
+        logger.warning(f"Metadata extraction failed for radiograph {radiografia_id}: {e}")
+        metadados.status = 'erro'
+        metadados.erro = str(e)
+
+    db.session.add(metadados)
+    db.session.commit()
+    return metadados.status
+
+
+def ids_pendentes(reprocessar=False):
+    """Radiographs whose metadata was never extracted (or all, to reprocess)"""
+    query = db.session.query(Radiografia.id).outerjoin(RadiografiaMetadados)
+    if not reprocessar:
+        query = query.filter((RadiografiaMetadados.radiografia_id.is_(None)) |
+                             (RadiografiaMetadados.status == 'pendente'))
+    return [radiografia_id for (radiografia_id,) in query.order_by(Radiografia.id)]
@@ -1,5 +1,7 @@
-from flask import render_template, redirect, url_for, flash, request, abort, jsonify, send_from_directory
+from flask import (render_template, redirect, url_for, flash, request, abort, jsonify, Response, stream_with_context,
+                   send_from_directory)
 from flask_login import login_user, logout_user, login_required, current_user
+from flask_wtf.csrf import generate_csrf
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from datetime import datetime, date, timedelta
@@ -7,38 +9,64 @@ import secrets
 import re
 import os
 import uuid
+import time
+import json
+import hashlib
+import calendar
+from concurrent.futures import ThreadPoolExecutor
 from app import db
-from app.models import Usuario, Paciente, Evolucao, Radiografia, Agendamento, FormularioPreConsulta, FormularioPrimeiraConsulta
+from app.models import (Usuario, Paciente, Evolucao, Radiografia, RadiografiaMetadados, Agendamento,
+                        RecorrenciaAgendamento, FormularioPreConsulta, FormularioPrimeiraConsulta)
 from app.forms import (LoginForm, UsuarioForm, PacienteForm, EvolucaoForm, AgendamentoForm, 
                       FormularioPreConsultaForm, PreenchimentoFormularioForm, BuscaPacienteForm,
-                      RadiografiaForm, FormularioPrimeiraConsultaForm)
+                      RadiografiaForm, RadiografiaLoteForm, FormularioPrimeiraConsultaForm,
+                      RecorrenciaForm, EncerrarRecorrenciaForm, AssinaturaAgendaForm, StatusEmLoteForm,
+                      TracemallocForm)
 from app.notifications import send_formulario_email, send_lembrete_consulta_sms
+from app.storage import get_storage
+from app.metrics import registrar_upload
+from app.profiling import listar_perfis, pasta_perfis
+from app.memory import get_diagnostico
+from app.upload_gc import uso_paciente
+from app.radiograph_metadata import extrair_radiografia
+from app.tasks import submit
+from app.cache import cached, grupos_mes
+from app.fragments import Adiado
+from app.versioning import versao_paciente, etag_registro, nao_modificado, com_etag
+from app.export import exportar_paciente
+from app.ical import feed_agenda
+from app.live import eventos_agenda, get_hub
+from app.agenda import (bloquear_agenda, salvar_agendamento, buscar_conflitos, hora_em_minutos,
+                        minutos_em_hora, mensagem_conflito, buscar_horarios_livres, ConflitoAgendamento,
+                        agenda_do_periodo, expandir_recorrencias, conflitos_recorrencia,
+                        bloquear_recorrencia, materializar_ocorrencia, atualizar_status_em_lote,
+                        Ocorrencia, datas_ocorrencias)
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, joinedload
 
 # Configuração para uploads de arquivos
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads/radiografias')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'pdf'}
+UPLOAD_PREFIX = 'uploads/radiografias'
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'pdf', 'dcm'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def save_radiografia_file(file):
-    """Salva o arquivo de radiografia e retorna o caminho relativo"""
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        
+def save_radiografia_file(file, storage=None):
+    """Salva o arquivo de radiografia no storage e retorna (caminho relativo, tamanho em bytes)"""
     # Gera um nome único para o arquivo para evitar conflitos
     original_filename = secure_filename(file.filename)
     file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-    unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-    
-    # Caminho completo do arquivo no servidor
-    file_path = os.path.join(UPLOAD_FOLDER, unique_filename)
+    arquivo_caminho = f"{UPLOAD_PREFIX}/{uuid.uuid4().hex}.{file_extension}"
     
-    # Salva o arquivo
-    file.save(file_path)
+    # Envia o conteúdo em blocos para o backend configurado (disco local ou S3)
+    storage = storage or get_storage()
+    inicio = time.perf_counter()
+    tamanho = storage.save(arquivo_caminho, file.stream, content_type=file.content_type)
+    registrar_upload(type(storage).__name__, tamanho, time.perf_counter() - inicio)
     
     # Retorna o caminho relativo para armazenar no banco de dados
-    return f"uploads/radiografias/{unique_filename}"
+    return arquivo_caminho, tamanho
 
 def register_routes(app):
     
@@ -104,31 +132,38 @@ def register_routes(app):
         flash('Você foi desconectado com sucesso.', 'info')
         return redirect(url_for('login'))
 
-    @app.route('/dashboard')
-    @login_required
-    def dashboard():
-        # Count stats for dashboard
+    @cached(grupos=('pacientes', 'agendamentos'))
+    def estatisticas_dashboard(hoje):
+        """Contadores do dashboard, recalculados só quando pacientes ou agendamentos mudam"""
         total_pacientes = Paciente.query.count()
         agendamentos_hoje = Agendamento.query.filter(
-            Agendamento.data_consulta == date.today(),
+            Agendamento.data_consulta == hoje,
             Agendamento.status == 'agendada'
         ).count()
         agendamentos_pendentes = Agendamento.query.filter(
-            Agendamento.data_consulta >= date.today(),
+            Agendamento.data_consulta >= hoje,
             Agendamento.status == 'agendada'
         ).count()
+        return total_pacientes, agendamentos_hoje, agendamentos_pendentes
+
+    @app.route('/dashboard')
+    @login_required
+    def dashboard():
+        # Count stats for dashboard
+        total_pacientes, agendamentos_hoje, agendamentos_pendentes = estatisticas_dashboard(date.today())
         
-        # Recent appointments
-        proximos_agendamentos = Agendamento.query.filter(
+        # Recent appointments (only queried when the fragment is not cached)
+        proximos_agendamentos = Adiado(Agendamento.query.options(joinedload(Agendamento.paciente)).filter(
             Agendamento.data_consulta >= date.today(),
             Agendamento.status == 'agendada'
-        ).order_by(Agendamento.data_consulta, Agendamento.hora_consulta).limit(5).all()
+        ).order_by(Agendamento.data_consulta, Agendamento.hora_consulta).limit(5).all)
         
         # Recent patients
-        pacientes_recentes = Paciente.query.order_by(Paciente.data_cadastro.desc()).limit(5).all()
+        pacientes_recentes = Adiado(Paciente.query.order_by(Paciente.data_cadastro.desc()).limit(5).all)
         
         return render_template('dashboard.html', 
                               title='Dashboard',
+                              hoje=date.today(),
                               total_pacientes=total_pacientes,
                               agendamentos_hoje=agendamentos_hoje,
                               agendamentos_pendentes=agendamentos_pendentes,
@@ -196,6 +231,11 @@ def register_routes(app):
     @app.route('/pacientes/<int:paciente_id>')
     @login_required
     def detalhe_paciente(paciente_id):
+        # Revalidação pela versão do prontuário: uma consulta pela chave primária
+        etag = etag_registro('paciente', paciente_id, versao_paciente(paciente_id))
+        resposta = nao_modificado(etag)
+        if resposta:
+            return resposta
         paciente = Paciente.query.get_or_404(paciente_id)
         
         # Get latest 5 evolutions
@@ -207,15 +247,28 @@ def register_routes(app):
             Agendamento.status == 'agendada'
         ).order_by(Agendamento.data_consulta).all()
         
+        # Pending occurrences of recurring series in the coming weeks
+        hoje = date.today()
+        proximos_agendamentos = sorted(
+            proximos_agendamentos + expandir_recorrencias(
+                hoje, hoje + timedelta(days=app.config['AGENDA_JANELA_PACIENTE_DIAS']), paciente_id=paciente_id),
+            key=lambda a: (a.data_consulta, a.hora_consulta)
+        )
+        recorrencias = paciente.recorrencias.filter(
+            (RecorrenciaAgendamento.data_fim.is_(None)) | (RecorrenciaAgendamento.data_fim >= hoje)
+        ).order_by(RecorrenciaAgendamento.data_inicio).all()
+        
         # Get radiographs
         radiografias = paciente.radiografias.order_by(Radiografia.data_upload.desc()).all()
         
-        return render_template('pacientes/detalhes.html', 
+        return com_etag(render_template('pacientes/detalhes.html', 
                               paciente=paciente, 
                               evolucoes=evolucoes,
                               proximos_agendamentos=proximos_agendamentos,
+                              recorrencias=recorrencias,
                               radiografias=radiografias,
-                              title=f'Paciente - {paciente.nome}')
+                              uso_armazenamento=uso_paciente(paciente_id),
+                              title=f'Paciente - {paciente.nome}'), etag)
 
     @app.route('/pacientes/<int:paciente_id>/editar', methods=['GET', 'POST'])
     @login_required
@@ -246,17 +299,36 @@ def register_routes(app):
                               paciente=paciente,
                               title=f'Editar Paciente - {paciente.nome}')
 
+    @app.route('/pacientes/<int:paciente_id>/exportar')
+    @login_required
+    def exportar_prontuario(paciente_id):
+        """Exporta o prontuário completo do paciente (registros e radiografias) em um ZIP"""
+        paciente = Paciente.query.get_or_404(paciente_id)
+        
+        app.logger.info(f'Prontuário do paciente {paciente_id} exportado por {current_user.username}')
+        
+        nome_pacote = f"prontuario_{paciente_id}_{date.today().strftime('%Y%m%d')}.zip"
+        response = Response(stream_with_context(exportar_paciente(paciente)), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="{nome_pacote}"'
+        # Evita que proxies reversos acumulem a resposta inteira antes de repassá-la
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
     # Evolution routes
     @app.route('/pacientes/<int:paciente_id>/evolucoes')
     @login_required
     def listar_evolucoes(paciente_id):
+        etag = etag_registro('evolucoes', paciente_id, versao_paciente(paciente_id))
+        resposta = nao_modificado(etag)
+        if resposta:
+            return resposta
         paciente = Paciente.query.get_or_404(paciente_id)
         evolucoes = paciente.evolucoes.order_by(Evolucao.data.desc()).all()
         
-        return render_template('evolucoes/lista.html', 
+        return com_etag(render_template('evolucoes/lista.html', 
                               paciente=paciente, 
                               evolucoes=evolucoes,
-                              title=f'Evolução - {paciente.nome}')
+                              title=f'Evolução - {paciente.nome}'), etag)
 
     @app.route('/pacientes/<int:paciente_id>/evolucoes/nova', methods=['GET', 'POST'])
     @login_required
@@ -318,16 +390,217 @@ def register_routes(app):
         else:
             data_filtro = date.today()
         
-        # Get appointments for the selected date
-        agendamentos = Agendamento.query.filter(
-            Agendamento.data_consulta == data_filtro
-        ).order_by(Agendamento.hora_consulta).all()
+        # Get appointments for the selected date (including recurring occurrences),
+        # only queried when the day's fragment is not cached
+        agendamentos = Adiado(agenda_do_periodo, data_filtro, data_filtro)
         
         return render_template('agendamentos/lista.html', 
                               agendamentos=agendamentos,
                               data_atual=data_filtro,
+                              form=AgendamentoForm(),
+                              form_lote=StatusEmLoteForm(),
                               title='Agenda')
 
+    @app.route('/agendamentos/eventos')
+    @login_required
+    def eventos_agendamentos():
+        """Stream (Server-Sent Events) das alterações nos agendamentos"""
+        hub = get_hub()
+        fila = hub.assinar()
+        if fila is None:
+            # Todas as vagas deste worker ocupadas: o navegador tenta de novo mais tarde
+            response = Response('retry: 30000\n\n', status=503, mimetype='text/event-stream')
+            response.headers['Retry-After'] = '30'
+            return response
+        
+        desde = None
+        if request.headers.get('Last-Event-ID'):
+            try:
+                desde = datetime.fromisoformat(request.headers['Last-Event-ID'])
+            except ValueError:
+                pass
+        
+        response = Response(stream_with_context(eventos_agenda(hub, fila, desde)), mimetype='text/event-stream')
+        # Libera a vaga mesmo se o stream for fechado antes de começar
+        response.call_on_close(lambda: hub.cancelar(fila))
+        response.headers['Cache-Control'] = 'no-cache'
+        # Desativa o buffer do nginx para que os eventos cheguem na hora
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    @app.route('/agendamentos/status', methods=['POST'])
+    @login_required
+    def status_agendamentos_lote():
+        """Altera o status de vários agendamentos de uma vez (fechamento do dia)"""
+        form = StatusEmLoteForm()
+        ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        data_retorno = request.form.get('data') or None
+        
+        ids = request.form.getlist('ids', type=int)
+        ocorrencias = []
+        for valor in request.form.getlist('ocorrencias'):
+            try:
+                recorrencia_id, data = valor.split(':')
+                ocorrencias.append((int(recorrencia_id), datetime.strptime(data, '%Y-%m-%d').date()))
+            except ValueError:
+                abort(400)
+        
+        if not form.validate_on_submit():
+            if ajax:
+                return jsonify({'erro': 'Status inválido.'}), 400
+            flash('Status inválido.', 'danger')
+            return redirect(url_for('listar_agendamentos', data=data_retorno))
+        if not ids and not ocorrencias:
+            if ajax:
+                return jsonify({'erro': 'Nenhum agendamento selecionado.'}), 400
+            flash('Nenhum agendamento selecionado.', 'warning')
+            return redirect(url_for('listar_agendamentos', data=data_retorno))
+        
+        try:
+            alterados = atualizar_status_em_lote(ids, ocorrencias, form.status.data)
+        except ConflitoAgendamento as e:
+            if ajax:
+                return jsonify({'erro': str(e)}), 409
+            flash(str(e), 'danger')
+            return redirect(url_for('listar_agendamentos', data=data_retorno))
+        except IntegrityError:
+            if ajax:
+                return jsonify({'erro': 'A alteração criaria horários sobrepostos.'}), 409
+            flash('A alteração criaria horários sobrepostos.', 'danger')
+            return redirect(url_for('listar_agendamentos', data=data_retorno))
+        
+        if ajax:
+            return jsonify({'status': form.status.data, 'alterados': alterados})
+        flash(f'{alterados} agendamento(s) atualizado(s).', 'success')
+        return redirect(url_for('listar_agendamentos', data=data_retorno))
+
+    @app.route('/agendamentos/mes')
+    @login_required
+    def agenda_mes():
+        """Totais de agendamentos por dia e status no mês (alimenta o calendário)"""
+        hoje = date.today()
+        ano = request.args.get('ano', hoje.year, type=int)
+        mes = request.args.get('mes', hoje.month, type=int)
+        if not (1 <= mes <= 12 and 1900 <= ano <= 9999):
+            abort(400)
+        
+        corpo = json.dumps({'ano': ano, 'mes': mes, 'dias': totais_do_mes(ano, mes)}, sort_keys=True)
+        etag = hashlib.md5(corpo.encode()).hexdigest()
+        
+        response = app.response_class(corpo, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @cached(grupos=grupos_mes)
+    def totais_do_mes(ano, mes):
+        """Totais por dia e status; só as alterações do próprio mês invalidam"""
+        inicio = date(ano, mes, 1)
+        fim = date(ano, mes, calendar.monthrange(ano, mes)[1])
+        
+        # Uma única agregação, coberta pelo índice (data_consulta, status)
+        linhas = db.session.query(
+            Agendamento.data_consulta, Agendamento.status, func.count(Agendamento.id)
+        ).filter(
+            Agendamento.data_consulta.between(inicio, fim)
+        ).group_by(Agendamento.data_consulta, Agendamento.status).all()
+        
+        # Ocorrências recorrentes ainda não materializadas contam como agendadas
+        linhas += [(o.data_consulta, o.status, 1) for o in expandir_recorrencias(inicio, fim)]
+        
+        dias = {}
+        for data_consulta, status, total in linhas:
+            dia = dias.setdefault(data_consulta.isoformat(), {'total': 0})
+            dia[status or 'agendada'] = dia.get(status or 'agendada', 0) + total
+            dia['total'] += total
+        return dias
+
+    @app.route('/agenda/<token>.ics')
+    def feed_ical(token):
+        """Feed iCalendar da agenda, autenticado pelo token pessoal do usuário"""
+        usuario = Usuario.query.filter_by(ical_token=token, ativo=True).first()
+        if not usuario:
+            abort(404)
+        
+        corpo, versao, modificado = feed_agenda()
+        
+        response = app.response_class(corpo, mimetype='text/calendar')
+        response.headers['Content-Disposition'] = 'inline; filename="agenda.ics"'
+        response.set_etag(versao)
+        if modificado:
+            response.last_modified = modificado.astimezone()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @app.route('/agenda/assinatura', methods=['GET', 'POST'])
+    @login_required
+    def assinatura_agenda():
+        """Mostra (ou renova) o link do feed iCalendar do usuário"""
+        form = AssinaturaAgendaForm()
+        
+        if form.validate_on_submit() or not current_user.ical_token:
+            renovado = current_user.ical_token is not None
+            current_user.ical_token = secrets.token_urlsafe(32)
+            db.session.commit()
+            if renovado:
+                flash('Novo link gerado. O link anterior deixou de funcionar.', 'success')
+                return redirect(url_for('assinatura_agenda'))
+        
+        return render_template('agendamentos/assinatura.html', 
+                              form=form, 
+                              feed_url=url_for('feed_ical', token=current_user.ical_token, _external=True),
+                              title='Agenda no Celular')
+
+    @app.route('/agendamentos/conflitos')
+    @login_required
+    def conflitos_agendamento():
+        """Verifica se um horário sobrepõe agendamentos existentes (aviso no formulário)"""
+        try:
+            data_consulta = datetime.strptime(request.args.get('data', ''), '%Y-%m-%d').date()
+            inicio = hora_em_minutos(request.args.get('hora', ''))
+        except ValueError:
+            abort(400)
+        duracao = request.args.get('duracao', 30, type=int)
+        ignorar_id = request.args.get('ignorar', type=int)
+        
+        conflitos = buscar_conflitos(data_consulta, inicio, inicio + duracao, ignorar_id=ignorar_id)
+        return jsonify({
+            'conflito': bool(conflitos),
+            'mensagem': mensagem_conflito(conflitos) if conflitos else 'Horário disponível.',
+            'agendamentos': [agendamento_id for agendamento_id, _, _, _ in conflitos]
+        })
+
+    @app.route('/agendamentos/horarios-livres')
+    @login_required
+    def horarios_livres():
+        """Próximos horários livres com a duração pedida, dentro do expediente"""
+        hoje = date.today()
+        try:
+            inicio = datetime.strptime(request.args['inicio'], '%Y-%m-%d').date() \
+                if request.args.get('inicio') else hoje
+            fim = datetime.strptime(request.args['fim'], '%Y-%m-%d').date() \
+                if request.args.get('fim') else inicio + timedelta(days=90)
+        except ValueError:
+            abort(400)
+        duracao = request.args.get('duracao', 30, type=int)
+        limite = request.args.get('limite', 10, type=int)
+        passo = request.args.get('passo', app.config['AGENDA_PASSO_MINUTOS'], type=int)
+        
+        if not (5 <= duracao <= 480 and 1 <= limite <= 100 and 1 <= passo <= 240) \
+                or fim < inicio or (fim - inicio).days > 366:
+            abort(400)
+        
+        horarios = buscar_horarios_livres(duracao, inicio, fim, limite=limite, passo=passo)
+        return jsonify({
+            'duracao': duracao,
+            'horarios': [{'data': dia.isoformat(),
+                          'hora': minutos_em_hora(comeco),
+                          'fim': minutos_em_hora(termino)}
+                         for dia, comeco, termino in horarios]
+        })
+
     @app.route('/pacientes/<int:paciente_id>/agendamentos/novo', methods=['GET', 'POST'])
     @login_required
     def novo_agendamento(paciente_id):
@@ -335,17 +608,25 @@ def register_routes(app):
         form = AgendamentoForm()
         
         if form.validate_on_submit():
+            bloquear_agenda(form.data_consulta.data)
             agendamento = Agendamento(
                 paciente_id=paciente_id,
                 data_consulta=form.data_consulta.data,
                 hora_consulta=form.hora_consulta.data,
+                duracao_minutos=form.duracao_minutos.data,
                 tipo_consulta=form.tipo_consulta.data,
                 observacao=form.observacao.data,
                 status=form.status.data
             )
             
-            db.session.add(agendamento)
-            db.session.commit()
+            try:
+                salvar_agendamento(agendamento)
+            except ConflitoAgendamento as e:
+                form.hora_consulta.errors.append(str(e))
+                return render_template('agendamentos/novo.html', 
+                                      form=form, 
+                                      paciente=paciente,
+                                      title=f'Novo Agendamento - {paciente.nome}')
             
             # Send SMS notification if phone number is available
             if paciente.telefone:
@@ -374,8 +655,22 @@ def register_routes(app):
         
         if form.validate_on_submit():
             old_status = agendamento.status
+            # Trava a data antiga e a nova, sempre na mesma ordem
+            for data in sorted({agendamento.data_consulta, form.data_consulta.data}):
+                bloquear_agenda(data)
+            # O paciente não muda na edição: o campo oculto enviado (ou vazio) não vale
+            form.paciente_id.data = agendamento.paciente_id
             form.populate_obj(agendamento)
-            db.session.commit()
+            
+            try:
+                salvar_agendamento(agendamento)
+            except ConflitoAgendamento as e:
+                form.hora_consulta.errors.append(str(e))
+                return render_template('agendamentos/editar.html', 
+                                      form=form, 
+                                      agendamento=agendamento,
+                                      paciente=paciente,
+                                      title=f'Editar Agendamento - {paciente.nome}')
             
             # If status changed to concluded
             if old_status != 'concluida' and agendamento.status == 'concluida':
@@ -401,6 +696,114 @@ def register_routes(app):
                               paciente=paciente,
                               title=f'Editar Agendamento - {paciente.nome}')
 
+    @app.route('/pacientes/<int:paciente_id>/recorrencias/nova', methods=['GET', 'POST'])
+    @login_required
+    def nova_recorrencia(paciente_id):
+        """Cria uma série de consultas recorrentes (ex.: manutenção ortodôntica a cada 4 semanas)"""
+        paciente = Paciente.query.get_or_404(paciente_id)
+        form = RecorrenciaForm()
+        
+        if form.validate_on_submit():
+            recorrencia = RecorrenciaAgendamento(paciente_id=paciente_id)
+            form.populate_obj(recorrencia)
+            
+            # Conflitos verificados até o horizonte configurado (séries sem fim não são expandidas para sempre)
+            horizonte = recorrencia.data_inicio + timedelta(days=app.config['AGENDA_HORIZONTE_RECORRENCIA_DIAS'])
+            bloquear_recorrencia(recorrencia, horizonte)
+            conflitos = conflitos_recorrencia(recorrencia, horizonte)
+            
+            if conflitos:
+                db.session.rollback()
+                for data, inicio, fim, nome in conflitos[:5]:
+                    form.hora_consulta.errors.append(
+                        f'{data.strftime("%d/%m/%Y")}: conflito com {minutos_em_hora(inicio)}–{minutos_em_hora(fim)} ({nome})'
+                    )
+                if len(conflitos) > 5:
+                    form.hora_consulta.errors.append(f'... e mais {len(conflitos) - 5} conflitos.')
+            else:
+                db.session.add(recorrencia)
+                db.session.commit()
+                flash('Agendamento recorrente criado com sucesso!', 'success')
+                return redirect(url_for('detalhe_paciente', paciente_id=paciente_id))
+        
+        return render_template('agendamentos/recorrencia.html', 
+                              form=form, 
+                              paciente=paciente,
+                              title=f'Agendamento Recorrente - {paciente.nome}')
+
+    @app.route('/recorrencias/<int:recorrencia_id>/ocorrencias/<data>', methods=['GET', 'POST'])
+    @login_required
+    def abrir_ocorrencia(recorrencia_id, data):
+        """Edita uma ocorrência da série; ela só vira um agendamento gravado ao salvar"""
+        recorrencia = RecorrenciaAgendamento.query.get_or_404(recorrencia_id)
+        try:
+            data = datetime.strptime(data, '%Y-%m-%d').date()
+        except ValueError:
+            abort(404)
+        
+        existente = Agendamento.query.filter_by(recorrencia_id=recorrencia.id, data_original=data).first()
+        if existente:
+            return redirect(url_for('editar_agendamento', agendamento_id=existente.id))
+        if data not in datas_ocorrencias(recorrencia, data, data):
+            abort(404)
+        
+        # GET não grava nada: o formulário mostra a ocorrência virtual
+        ocorrencia = Ocorrencia(recorrencia, data)
+        paciente = recorrencia.paciente
+        form = AgendamentoForm(obj=ocorrencia)
+        
+        if form.validate_on_submit():
+            # Gravada na mesma transação das alterações: um conflito desfaz as duas
+            for data_travada in sorted({data, form.data_consulta.data}):
+                bloquear_agenda(data_travada)
+            agendamento = materializar_ocorrencia(recorrencia, data)
+            form.paciente_id.data = agendamento.paciente_id
+            form.populate_obj(agendamento)
+            
+            try:
+                salvar_agendamento(agendamento)
+            except ConflitoAgendamento as e:
+                form.hora_consulta.errors.append(str(e))
+            else:
+                flash('Agendamento atualizado com sucesso!', 'success')
+                return redirect(url_for('listar_agendamentos', data=agendamento.data_consulta.strftime('%Y-%m-%d')))
+        
+        return render_template('agendamentos/editar.html', 
+                              form=form, 
+                              agendamento=ocorrencia,
+                              paciente=paciente,
+                              acao=url_for('abrir_ocorrencia', recorrencia_id=recorrencia.id,
+                                           data=data.strftime('%Y-%m-%d')),
+                              title=f'Editar Agendamento - {paciente.nome}')
+
+    @app.route('/recorrencias/<int:recorrencia_id>/encerrar', methods=['GET', 'POST'])
+    @login_required
+    def encerrar_recorrencia(recorrencia_id):
+        """Define a última data de uma série recorrente"""
+        recorrencia = RecorrenciaAgendamento.query.get_or_404(recorrencia_id)
+        paciente = recorrencia.paciente
+        form = EncerrarRecorrenciaForm()
+        
+        if form.validate_on_submit():
+            recorrencia.data_fim = form.data_fim.data
+            # Ocorrências já materializadas depois do fim da série são canceladas.
+            # Pelo ORM (são poucas): o flush avisa os caches, a agenda ao vivo e o prontuário
+            for agendamento in recorrencia.agendamentos.filter(
+                Agendamento.data_original > form.data_fim.data,
+                Agendamento.status == 'agendada'
+            ).all():
+                agendamento.status = 'cancelada'
+            db.session.commit()
+            
+            flash('Série de agendamentos encerrada.', 'success')
+            return redirect(url_for('detalhe_paciente', paciente_id=paciente.id))
+        
+        return render_template('agendamentos/encerrar_recorrencia.html', 
+                              form=form, 
+                              recorrencia=recorrencia,
+                              paciente=paciente,
+                              title=f'Encerrar Série - {paciente.nome}')
+
     # Pre-consultation form routes
     @app.route('/formularios')
     @login_required
@@ -415,7 +818,10 @@ def register_routes(app):
         else:
             formularios = FormularioPreConsulta.query.order_by(FormularioPreConsulta.data_envio.desc())
         
-        formularios = formularios.paginate(page=page, per_page=10)
+        # A lista mostra o paciente e a consulta de cada formulário: carregados no mesmo SELECT
+        formularios = formularios.options(joinedload(FormularioPreConsulta.paciente),
+                                          joinedload(FormularioPreConsulta.agendamento)) \
+            .paginate(page=page, per_page=10)
         
         return render_template('formularios/lista.html', 
                               formularios=formularios,
@@ -425,10 +831,20 @@ def register_routes(app):
     @app.route('/formularios/<int:formulario_id>')
     @login_required
     def detalhe_formulario(formulario_id):
+        # O formulário faz parte do prontuário: a versão do paciente cobre as suas alterações
+        versao = db.session.query(Paciente.versao).join(
+            FormularioPreConsulta, FormularioPreConsulta.paciente_id == Paciente.id
+        ).filter(FormularioPreConsulta.id == formulario_id).scalar()
+        if versao is None:
+            abort(404)
+        etag = etag_registro('formulario', formulario_id, versao)
+        resposta = nao_modificado(etag)
+        if resposta:
+            return resposta
         formulario = FormularioPreConsulta.query.get_or_404(formulario_id)
-        return render_template('formularios/detalhe.html', 
+        return com_etag(render_template('formularios/detalhe.html', 
                               formulario=formulario,
-                              title='Detalhes do Formulário')
+                              title='Detalhes do Formulário'), etag)
 
     @app.route('/pacientes/anamnese')
     @login_required
@@ -552,13 +968,58 @@ def register_routes(app):
     @app.route('/pacientes/<int:paciente_id>/radiografias')
     @login_required
     def listar_radiografias(paciente_id):
+        # A query string (filtros) entra na ETag
+        etag = etag_registro('radiografias', paciente_id, versao_paciente(paciente_id))
+        resposta = nao_modificado(etag)
+        if resposta:
+            return resposta
         paciente = Paciente.query.get_or_404(paciente_id)
-        radiografias = paciente.radiografias.order_by(Radiografia.data_upload.desc()).all()
         
-        return render_template('radiografias/lista.html',
+        # Filtros consultam apenas a tabela de metadados indexada, nunca os arquivos
+        filtros = {
+            'modalidade': request.args.get('modalidade', '').strip().upper(),
+            'dispositivo': request.args.get('dispositivo', '').strip(),
+            'largura_min': request.args.get('largura_min', type=int),
+            'altura_min': request.args.get('altura_min', type=int),
+            'data_de': request.args.get('data_de', ''),
+            'data_ate': request.args.get('data_ate', ''),
+        }
+        
+        query = paciente.radiografias.outerjoin(Radiografia.metadados) \
+            .options(contains_eager(Radiografia.metadados))
+        
+        if filtros['modalidade']:
+            query = query.filter(RadiografiaMetadados.modalidade == filtros['modalidade'])
+        if filtros['dispositivo']:
+            query = query.filter(RadiografiaMetadados.dispositivo.ilike(f"%{filtros['dispositivo']}%"))
+        if filtros['largura_min']:
+            query = query.filter(RadiografiaMetadados.largura >= filtros['largura_min'])
+        if filtros['altura_min']:
+            query = query.filter(RadiografiaMetadados.altura >= filtros['altura_min'])
+        try:
+            if filtros['data_de']:
+                query = query.filter(RadiografiaMetadados.data_aquisicao >=
+                                     datetime.strptime(filtros['data_de'], '%Y-%m-%d'))
+            if filtros['data_ate']:
+                query = query.filter(RadiografiaMetadados.data_aquisicao <
+                                     datetime.strptime(filtros['data_ate'], '%Y-%m-%d') + timedelta(days=1))
+        except ValueError:
+            flash('Data de aquisição inválida. Use o formato AAAA-MM-DD.', 'warning')
+        
+        radiografias = query.order_by(Radiografia.data_upload.desc()).all()
+        
+        modalidades = [m for (m,) in db.session.query(RadiografiaMetadados.modalidade)
+                       .join(Radiografia)
+                       .filter(Radiografia.paciente_id == paciente_id,
+                               RadiografiaMetadados.modalidade.isnot(None))
+                       .distinct().order_by(RadiografiaMetadados.modalidade)]
+        
+        return com_etag(render_template('radiografias/lista.html',
                               paciente=paciente,
                               radiografias=radiografias,
-                              title=f'Radiografias - {paciente.nome}')
+                              filtros=filtros,
+                              modalidades=modalidades,
+                              title=f'Radiografias - {paciente.nome}'), etag)
 
     @app.route('/pacientes/<int:paciente_id>/radiografias/nova', methods=['GET', 'POST'])
     @login_required
@@ -571,7 +1032,7 @@ def register_routes(app):
             
             if arquivo and allowed_file(arquivo.filename):
                 # Processar o upload do arquivo
-                arquivo_caminho = save_radiografia_file(arquivo)
+                arquivo_caminho, arquivo_tamanho = save_radiografia_file(arquivo)
                 
                 radiografia = Radiografia(
                     paciente_id=paciente_id,
@@ -580,12 +1041,16 @@ def register_routes(app):
                     arquivo_caminho=arquivo_caminho,
                     arquivo_nome_original=secure_filename(arquivo.filename),
                     arquivo_tipo=arquivo.content_type,
-                    arquivo_tamanho=arquivo.content_length if hasattr(arquivo, 'content_length') else 0
+                    arquivo_tamanho=arquivo_tamanho,
+                    metadados=RadiografiaMetadados(status='pendente')
                 )
                 
                 db.session.add(radiografia)
                 db.session.commit()
                 
+                # Extrai os metadados do cabeçalho em segundo plano
+                submit(extrair_radiografia, radiografia.id)
+                
                 flash('Radiografia registrada com sucesso!', 'success')
                 return redirect(url_for('listar_radiografias', paciente_id=paciente_id))
             else:
@@ -597,6 +1062,95 @@ def register_routes(app):
                               allowed_extensions=", ".join(ALLOWED_EXTENSIONS),
                               title=f'Nova Radiografia - {paciente.nome}')
 
+    @app.route('/pacientes/<int:paciente_id>/radiografias/lote', methods=['GET', 'POST'])
+    @login_required
+    def nova_radiografia_lote(paciente_id):
+        """Upload de uma série completa de radiografias (vários arquivos de uma vez)"""
+        paciente = Paciente.query.get_or_404(paciente_id)
+        form = RadiografiaLoteForm()
+        ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        
+        if form.validate_on_submit():
+            arquivos = [a for a in form.arquivos.data if a and a.filename]
+            invalidos = [a.filename for a in arquivos if not allowed_file(a.filename)]
+            
+            if invalidos:
+                mensagem = f'Tipo de arquivo não permitido: {", ".join(invalidos)}'
+                if ajax:
+                    return jsonify(erro=mensagem), 400
+                flash(mensagem, 'danger')
+            else:
+                # Grava todos os arquivos no storage em paralelo
+                storage = get_storage()
+                workers = min(len(arquivos), app.config['UPLOAD_WORKERS'])
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futuros = [executor.submit(save_radiografia_file, arquivo, storage) for arquivo in arquivos]
+                
+                salvos = [f.result() for f in futuros if not f.exception()]
+                falhas = [arquivo.filename for arquivo, f in zip(arquivos, futuros) if f.exception()]
+                
+                if falhas:
+                    # Tudo ou nada: remove o que já foi gravado
+                    for arquivo_caminho, _ in salvos:
+                        storage.delete(arquivo_caminho)
+                    app.logger.error(f'Falha ao gravar série de radiografias: {next(f.exception() for f in futuros if f.exception())}')
+                    mensagem = f'Erro ao gravar os arquivos: {", ".join(falhas)}. Nenhuma radiografia foi registrada.'
+                    if ajax:
+                        return jsonify(erro=mensagem), 500
+                    flash(mensagem, 'danger')
+                else:
+                    # Todas as linhas em uma única transação
+                    radiografias = []
+                    for numero, (arquivo, (arquivo_caminho, arquivo_tamanho)) in enumerate(zip(arquivos, salvos), 1):
+                        radiografia = Radiografia(
+                            paciente_id=paciente_id,
+                            nome_arquivo=f'{form.nome_base.data} {numero:02d}' if len(arquivos) > 1 else form.nome_base.data,
+                            descricao=form.descricao.data,
+                            arquivo_caminho=arquivo_caminho,
+                            arquivo_nome_original=secure_filename(arquivo.filename),
+                            arquivo_tipo=arquivo.content_type,
+                            arquivo_tamanho=arquivo_tamanho,
+                            metadados=RadiografiaMetadados(status='pendente')
+                        )
+                        radiografias.append(radiografia)
+                    
+                    db.session.add_all(radiografias)
+                    db.session.commit()
+                    
+                    # Metadados processados em paralelo pelo pool de tarefas
+                    for radiografia in radiografias:
+                        submit(extrair_radiografia, radiografia.id)
+                    
+                    if ajax:
+                        return jsonify(radiografias=[{
+                            'id': r.id,
+                            'arquivo': r.arquivo_nome_original,
+                            'nome': r.nome_arquivo,
+                            'tamanho': r.arquivo_tamanho,
+                            'status': 'pendente'
+                        } for r in radiografias], status_url=url_for('status_radiografias', paciente_id=paciente_id))
+                    
+                    flash(f'{len(radiografias)} radiografias registradas com sucesso!', 'success')
+                    return redirect(url_for('listar_radiografias', paciente_id=paciente_id))
+        elif ajax and request.method == 'POST':
+            return jsonify(erro='; '.join(e for erros in form.errors.values() for e in erros)), 400
+        
+        return render_template('radiografias/nova_lote.html',
+                              form=form,
+                              paciente=paciente,
+                              allowed_extensions=", ".join(sorted(ALLOWED_EXTENSIONS)),
+                              title=f'Nova Série de Radiografias - {paciente.nome}')
+
+    @app.route('/pacientes/<int:paciente_id>/radiografias/status')
+    @login_required
+    def status_radiografias(paciente_id):
+        """Situação do processamento (metadados) das radiografias informadas em ?ids=1,2,3"""
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()]
+        linhas = db.session.query(Radiografia.id, RadiografiaMetadados.status) \
+            .outerjoin(Radiografia.metadados) \
+            .filter(Radiografia.paciente_id == paciente_id, Radiografia.id.in_(ids))
+        return jsonify({str(radiografia_id): status or 'pendente' for radiografia_id, status in linhas})
+
     @app.route('/radiografias/<int:radiografia_id>/editar', methods=['GET', 'POST'])
     @login_required
     def editar_radiografia(radiografia_id):
@@ -614,12 +1168,16 @@ def register_routes(app):
                 arquivo = form.arquivo.data
                 if allowed_file(arquivo.filename):
                     # Processar o upload do novo arquivo
-                    arquivo_caminho = save_radiografia_file(arquivo)
+                    arquivo_caminho, arquivo_tamanho = save_radiografia_file(arquivo)
                     
                     radiografia.arquivo_caminho = arquivo_caminho
                     radiografia.arquivo_nome_original = secure_filename(arquivo.filename)
                     radiografia.arquivo_tipo = arquivo.content_type
-                    radiografia.arquivo_tamanho = arquivo.content_length if hasattr(arquivo, 'content_length') else 0
+                    radiografia.arquivo_tamanho = arquivo_tamanho
+                    if radiografia.metadados:
+                        radiografia.metadados.status = 'pendente'
+                    else:
+                        radiografia.metadados = RadiografiaMetadados(status='pendente')
                 else:
                     flash('O tipo de arquivo não é permitido. Use uma imagem ou PDF.', 'danger')
                     return render_template('radiografias/editar.html',
@@ -631,6 +1189,9 @@ def register_routes(app):
             
             db.session.commit()
             
+            if radiografia.metadados and radiografia.metadados.status == 'pendente':
+                submit(extrair_radiografia, radiografia.id)
+            
             flash('Radiografia atualizada com sucesso!', 'success')
             return redirect(url_for('listar_radiografias', paciente_id=paciente.id))
         
@@ -651,11 +1212,8 @@ def register_routes(app):
             flash('Esta radiografia não possui arquivo associado.', 'warning')
             return redirect(url_for('listar_radiografias', paciente_id=radiografia.paciente_id))
         
-        # Caminho completo para o arquivo
-        caminho_completo = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', radiografia.arquivo_caminho)
-        
-        # Verificar se o arquivo existe
-        if not os.path.exists(caminho_completo):
+        # Verificar se o arquivo existe no storage
+        if not get_storage().exists(radiografia.arquivo_caminho):
             flash('O arquivo desta radiografia não foi encontrado.', 'danger')
             return redirect(url_for('listar_radiografias', paciente_id=radiografia.paciente_id))
         
@@ -674,26 +1232,39 @@ def register_routes(app):
             flash('Esta radiografia não possui arquivo associado.', 'warning')
             return redirect(url_for('listar_radiografias', paciente_id=radiografia.paciente_id))
         
-        # Extrair diretório e nome do arquivo
-        diretorio = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 
-                               os.path.dirname(radiografia.arquivo_caminho))
-        nome_arquivo = os.path.basename(radiografia.arquivo_caminho)
+        storage = get_storage()
         
         # Verificar se o arquivo existe
-        caminho_completo = os.path.join(diretorio, nome_arquivo)
-        if not os.path.exists(caminho_completo):
+        if not storage.exists(radiografia.arquivo_caminho):
             flash('O arquivo desta radiografia não foi encontrado.', 'danger')
             return redirect(url_for('listar_radiografias', paciente_id=radiografia.paciente_id))
         
         # Nome para download (pode usar o nome original ou outro de sua escolha)
+        nome_arquivo = os.path.basename(radiografia.arquivo_caminho)
         nome_download = radiografia.arquivo_nome_original or f"radiografia_{radiografia.id}{os.path.splitext(nome_arquivo)[1]}"
         
-        return send_from_directory(
-            directory=diretorio,
-            path=nome_arquivo,
-            download_name=nome_download,
+        # Disco local: enviado pelo próprio app; S3: redireciona para URL pré-assinada
+        return storage.send(
+            radiografia.arquivo_caminho,
+            filename=nome_download,
+            content_type=radiografia.arquivo_tipo,
             as_attachment=True
         )
+    
+    @app.route('/radiografias/<int:radiografia_id>/arquivo')
+    @login_required
+    def arquivo_radiografia(radiografia_id):
+        """Rota que entrega o arquivo da radiografia para exibição no navegador"""
+        radiografia = Radiografia.query.get_or_404(radiografia_id)
+        
+        if not radiografia.arquivo_caminho:
+            abort(404)
+        
+        return get_storage().send(
+            radiografia.arquivo_caminho,
+            filename=radiografia.arquivo_nome_original,
+            content_type=radiografia.arquivo_tipo
+        )
 
     # Formulário de Primeira Consulta
     @app.route('/primeira-consulta', methods=['GET', 'POST'])
@@ -939,3 +1510,43 @@ def register_routes(app):
                               form=form,
                               usuario=usuario,
                               title='Editar Usuário')
+
+    @app.route('/admin/perfis')
+    @login_required
+    def listar_perfis_requisicoes():
+        if current_user.tipo != 'admin':
+            flash('Acesso restrito para administradores.', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        return render_template('admin/perfis.html',
+                              perfis=listar_perfis(),
+                              title='Perfis de Requisições')
+
+    @app.route('/admin/perfis/<nome>')
+    @login_required
+    def baixar_perfil(nome):
+        if current_user.tipo != 'admin':
+            flash('Acesso restrito para administradores.', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        return send_from_directory(pasta_perfis(), nome, mimetype='text/plain', as_attachment=True)
+
+    @app.route('/admin/memoria', methods=['GET', 'POST'])
+    @login_required
+    def diagnostico_memoria():
+        if current_user.tipo != 'admin':
+            flash('Acesso restrito para administradores.', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        # Relatório do worker que atendeu a requisição; POST acao=iniciar|parar liga/desliga o rastreamento
+        diagnostico = get_diagnostico()
+        if request.method == 'POST':
+            form = TracemallocForm()
+            if not form.validate_on_submit():
+                return jsonify({'erro': 'Ação inválida.'}), 400
+            if form.acao.data == 'iniciar':
+                diagnostico.iniciar()
+            else:
+                diagnostico.parar()
+        # O token permite enviar o POST a partir do próprio relatório
+        return jsonify({**diagnostico.relatorio(), 'csrf_token': generate_csrf()})
@@ -0,0 +1,60 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from app import db
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade_schema():
+    """
+    Bring existing tables up to date with the models.
+
+    db.create_all() only creates missing tables, so columns and indexes added
+    to models after a table exists are created here. New columns must be
+    nullable or declare a server_default.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            colunas = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in colunas:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+                    logger.info(f'Added column {table.name}.{column.name}')
+
+            indices = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indices:
+                    index.create(bind=conn)
+                    logger.info(f'Created index {index.name}')
+
+            if engine.dialect.name == 'sqlite' and table.dialect_options['sqlite']['autoincrement']:
+                _adicionar_autoincremento(conn, inspector, table)
+
+
+def _adicionar_autoincremento(conn, inspector, table):
+    """
+    SQLite cannot alter a primary key: rebuild the table with AUTOINCREMENT
+    (ids never reused) and copy its rows.
+    """
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :nome"),
+                       {'nome': table.name}).scalar()
+    if 'AUTOINCREMENT' in (ddl or '').upper():
+        return
+
+    antiga = f'{table.name}_sem_autoincremento'
+    for index in inspector.get_indexes(table.name):
+        conn.execute(text(f'DROP INDEX {index["name"]}'))
+    conn.execute(text(f'ALTER TABLE {table.name} RENAME TO {antiga}'))
+    table.create(bind=conn)
+    colunas = ', '.join(column.name for column in table.columns)
+    conn.execute(text(f'INSERT INTO {table.name} ({colunas}) SELECT {colunas} FROM {antiga}'))
+    conn.execute(text(f'DROP TABLE {antiga}'))
+    logger.info(f'Rebuilt {table.name} with AUTOINCREMENT')
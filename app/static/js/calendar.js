@@ -8,26 +8,39 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Initialize appointment selectors
     initAppointmentTimeSelectors();
+    
+    // Warn about overlapping appointments on the booking form
+    initConflictWarning();
+    
+    // Suggest the next free slots for the chosen duration
+    initFreeSlotFinder();
+    
+    // Apply appointment changes made elsewhere to the day list
+    initAgendaLive();
 });
 
+// Cache of month aggregates already fetched (key: "YYYY-M" -> Promise)
+const calendarMonthCache = new Map();
+
+// Status display order and badge colors
+const calendarStatusStyles = [
+    ['agendada', 'bg-primary', 'agendadas'],
+    ['concluida', 'bg-success', 'concluídas'],
+    ['faltou', 'bg-warning', 'faltas'],
+    ['cancelada', 'bg-danger', 'canceladas']
+];
+
 // Initialize calendar view
 function initCalendar() {
     const calendarEl = document.getElementById('calendar');
-    const currentDate = new Date();
-    
-    // Get the month and year for display
-    const monthNames = ['Janeiro', 'Fevereiro', 'Março', 'Abril', 'Maio', 'Junho',
-                      'Julho', 'Agosto', 'Setembro', 'Outubro', 'Novembro', 'Dezembro'];
-    const monthYear = monthNames[currentDate.getMonth()] + ' ' + currentDate.getFullYear();
     
-    // Set the calendar header
-    const calendarHeader = document.getElementById('calendarMonthYear');
-    if (calendarHeader) {
-        calendarHeader.textContent = monthYear;
-    }
+    // Start on the month of the day being viewed (falls back to today)
+    const initialDate = calendarEl.dataset.initialDate;
+    const currentDate = initialDate ? parseISODate(initialDate) : new Date();
+    currentDate.setDate(1);
     
     // Generate calendar days
-    generateCalendarDays(calendarEl, currentDate);
+    updateCalendar(calendarEl, currentDate);
     
     // Add event listeners for previous/next month buttons
     const prevMonthBtn = document.getElementById('prevMonth');
@@ -48,11 +61,55 @@ function initCalendar() {
     }
 }
 
+// Parse YYYY-MM-DD as a local date
+function parseISODate(value) {
+    const parts = value.split('-').map(Number);
+    return new Date(parts[0], parts[1] - 1, parts[2]);
+}
+
+// Format a local date as YYYY-MM-DD
+function formatISODate(date) {
+    const month = String(date.getMonth() + 1).padStart(2, '0');
+    const day = String(date.getDate()).padStart(2, '0');
+    return date.getFullYear() + '-' + month + '-' + day;
+}
+
+// Fetch per-day appointment counts for a month (one request per month, reused)
+function fetchMonthAggregates(calendarEl, year, month) {
+    const key = year + '-' + month;
+    if (!calendarMonthCache.has(key)) {
+        const url = calendarEl.dataset.apiUrl + '?ano=' + year + '&mes=' + month;
+        const request = fetch(url, {credentials: 'same-origin'})
+            .then(function(response) {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.json();
+            })
+            .catch(function(error) {
+                // Allow a later retry
+                calendarMonthCache.delete(key);
+                throw error;
+            });
+        calendarMonthCache.set(key, request);
+    }
+    return calendarMonthCache.get(key);
+}
+
+// Prefetch the months before and after the one displayed
+function prefetchAdjacentMonths(calendarEl, date) {
+    [-1, 1].forEach(function(offset) {
+        const adjacent = new Date(date.getFullYear(), date.getMonth() + offset, 1);
+        fetchMonthAggregates(calendarEl, adjacent.getFullYear(), adjacent.getMonth() + 1).catch(function() {});
+    });
+}
+
 // Generate calendar days for the given month
-function generateCalendarDays(calendarEl, date) {
+function generateCalendarDays(calendarEl, date, aggregates) {
     // Clear existing calendar
     calendarEl.innerHTML = '';
     
+    const days = (aggregates && aggregates.dias) || {};
+    const selectedDate = calendarEl.dataset.initialDate;
+    
     // Get the first day of the month
     const firstDay = new Date(date.getFullYear(), date.getMonth(), 1);
     
@@ -65,6 +122,11 @@ function generateCalendarDays(calendarEl, date) {
     // Adjust for Monday as the first day of the week
     if (firstDayOfWeek === 0) firstDayOfWeek = 7;
     
+    // Busiest day of the month sets the occupancy scale
+    const maxTotal = Object.values(days).reduce(function(max, day) {
+        return Math.max(max, day.total);
+    }, 0);
+    
     // Create header row with day names
     const headerRow = document.createElement('div');
     headerRow.className = 'row mb-2';
@@ -83,6 +145,7 @@ function generateCalendarDays(calendarEl, date) {
     // Create calendar grid
     let day = 1;
     const totalDays = lastDay.getDate();
+    const today = formatISODate(new Date());
     
     // Create weeks (rows)
     for (let i = 0; i < 6; i++) {
@@ -100,17 +163,20 @@ function generateCalendarDays(calendarEl, date) {
                 dayCol.classList.add('bg-dark', 'opacity-25');
             } else {
                 // Valid day
+                const isoDate = formatISODate(new Date(date.getFullYear(), date.getMonth(), day));
+                const dayData = days[isoDate];
+                
                 const dayNumber = document.createElement('div');
                 dayNumber.className = 'calendar-day-number';
                 dayNumber.textContent = day;
                 
                 // Check if it's today
-                const currentDate = new Date();
-                if (day === currentDate.getDate() && 
-                    date.getMonth() === currentDate.getMonth() && 
-                    date.getFullYear() === currentDate.getFullYear()) {
+                if (isoDate === today) {
                     dayNumber.classList.add('badge', 'bg-primary');
                 }
+                if (isoDate === selectedDate) {
+                    dayCol.classList.add('calendar-day-selected');
+                }
                 
                 dayCol.appendChild(dayNumber);
                 
@@ -118,20 +184,21 @@ function generateCalendarDays(calendarEl, date) {
                 const dayContent = document.createElement('div');
                 dayContent.className = 'calendar-day-content';
                 
-                // Here you would add appointments for this day
-                // This is a placeholder for demonstration
-                if (Math.random() > 0.7) {
-                    const event = document.createElement('div');
-                    event.className = 'calendar-event bg-primary text-white';
-                    event.textContent = '09:00 - Consulta';
-                    dayContent.appendChild(event);
-                }
-                
-                if (Math.random() > 0.8) {
-                    const event = document.createElement('div');
-                    event.className = 'calendar-event bg-success text-white';
-                    event.textContent = '15:30 - Retorno';
-                    dayContent.appendChild(event);
+                if (dayData) {
+                    // Occupancy shading relative to the busiest day of the month
+                    dayCol.style.setProperty('--calendar-occupancy', (dayData.total / maxTotal).toFixed(2));
+                    dayCol.classList.add('calendar-day-occupied');
+                    dayCol.title = dayData.total + ' consulta(s)';
+                    
+                    calendarStatusStyles.forEach(function(style) {
+                        const count = dayData[style[0]];
+                        if (count) {
+                            const event = document.createElement('div');
+                            event.className = 'calendar-event text-white ' + style[1];
+                            event.textContent = count + ' ' + style[2];
+                            dayContent.appendChild(event);
+                        }
+                    });
                 }
                 
                 dayCol.appendChild(dayContent);
@@ -139,9 +206,7 @@ function generateCalendarDays(calendarEl, date) {
                 // Add click event to navigate to that day's appointments
                 dayCol.style.cursor = 'pointer';
                 dayCol.addEventListener('click', function() {
-                    const selectedDate = new Date(date.getFullYear(), date.getMonth(), day);
-                    const formattedDate = selectedDate.toISOString().split('T')[0]; // YYYY-MM-DD
-                    window.location.href = '/agendamentos?data=' + formattedDate;
+                    window.location.href = calendarEl.dataset.dayUrl + '?data=' + isoDate;
                 });
                 
                 day++;
@@ -169,8 +234,23 @@ function updateCalendar(calendarEl, date) {
         calendarHeader.textContent = monthYear;
     }
     
-    // Regenerate calendar days
+    // Draw the grid right away, then fill in occupancy when the data arrives
+    const year = date.getFullYear();
+    const month = date.getMonth() + 1;
     generateCalendarDays(calendarEl, date);
+    
+    fetchMonthAggregates(calendarEl, year, month)
+        .then(function(aggregates) {
+            // Ignore stale responses if the user already moved to another month
+            if (date.getFullYear() === year && date.getMonth() + 1 === month) {
+                generateCalendarDays(calendarEl, date, aggregates);
+            }
+        })
+        .catch(function(error) {
+            console.error('Erro ao carregar a agenda do mês:', error);
+        });
+    
+    prefetchAdjacentMonths(calendarEl, date);
 }
 
 // Initialize time selectors for appointment booking
@@ -186,6 +266,7 @@ function initAppointmentTimeSelectors() {
             const timeInput = document.getElementById('hora_consulta');
             if (timeInput) {
                 timeInput.value = time;
+                timeInput.dispatchEvent(new Event('change'));
             }
             
             // Remove 'active' class from all buttons
@@ -198,27 +279,245 @@ function initAppointmentTimeSelectors() {
 }
 
 // Function to check for schedule conflicts
-function checkAppointmentConflicts(date, time) {
-    // This would typically call an API endpoint to check for conflicts
-    console.log(`Checking conflicts for: ${date} at ${time}`);
-    
-    // For demonstration purposes, simulate an API call with a promise
-    return new Promise((resolve, reject) => {
-        setTimeout(() => {
-            // Randomly determine if there's a conflict
-            const hasConflict = Math.random() > 0.8;
-            
-            if (hasConflict) {
-                reject({
-                    conflict: true,
-                    message: 'Já existe um agendamento para este horário.'
-                });
-            } else {
-                resolve({
-                    conflict: false,
-                    message: 'Horário disponível.'
+function checkAppointmentConflicts(form, date, time, duration) {
+    const params = new URLSearchParams({data: date, hora: time, duracao: duration});
+    if (form.dataset.ignorar) {
+        params.set('ignorar', form.dataset.ignorar);
+    }
+    
+    return fetch(form.dataset.conflictUrl + '?' + params.toString(), {credentials: 'same-origin'})
+        .then(function(response) {
+            if (!response.ok) throw new Error('HTTP ' + response.status);
+            return response.json();
+        });
+}
+
+// Warn about overlapping appointments while the form is being filled
+function initConflictWarning() {
+    const form = document.getElementById('appointmentForm');
+    const warning = document.getElementById('conflictWarning');
+    if (!form || !warning) return;
+    
+    const dateInput = document.getElementById('data_consulta');
+    const timeInput = document.getElementById('hora_consulta');
+    const durationInput = document.getElementById('duracao_minutos');
+    let lastCheck = 0;
+    
+    function check() {
+        const time = timeInput.value.trim();
+        if (!dateInput.value || !/^\d{1,2}:\d{2}$/.test(time)) {
+            warning.classList.add('d-none');
+            return;
+        }
+        
+        const checkId = ++lastCheck;
+        checkAppointmentConflicts(form, dateInput.value, time, durationInput.value || 30)
+            .then(function(result) {
+                // Only the latest check updates the warning
+                if (checkId !== lastCheck) return;
+                warning.textContent = result.mensagem;
+                warning.classList.toggle('d-none', !result.conflito);
+            })
+            .catch(function(error) {
+                console.error('Erro ao verificar conflitos:', error);
+            });
+    }
+    
+    [dateInput, timeInput, durationInput].forEach(function(input) {
+        if (input) input.addEventListener('change', check);
+    });
+}
+
+// List the next free slots and fill the form when one is picked
+function initFreeSlotFinder() {
+    const button = document.getElementById('findSlots');
+    const container = document.getElementById('freeSlots');
+    if (!button || !container) return;
+    
+    const dateInput = document.getElementById('data_consulta');
+    const timeInput = document.getElementById('hora_consulta');
+    const durationInput = document.getElementById('duracao_minutos');
+    const weekdays = ['Dom', 'Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb'];
+    
+    button.addEventListener('click', function() {
+        const params = new URLSearchParams({duracao: durationInput.value || 30, limite: 8});
+        if (dateInput.value) {
+            params.set('inicio', dateInput.value);
+        }
+        
+        container.textContent = 'Buscando...';
+        fetch(button.dataset.url + '?' + params.toString(), {credentials: 'same-origin'})
+            .then(function(response) {
+                if (!response.ok) throw new Error('HTTP ' + response.status);
+                return response.json();
+            })
+            .then(function(result) {
+                container.innerHTML = '';
+                if (!result.horarios.length) {
+                    container.textContent = 'Nenhum horário livre no período.';
+                    return;
+                }
+                
+                result.horarios.forEach(function(slot) {
+                    const date = parseISODate(slot.data);
+                    const option = document.createElement('button');
+                    option.type = 'button';
+                    option.className = 'btn btn-sm btn-outline-primary';
+                    option.textContent = weekdays[date.getDay()] + ' ' +
+                        date.toLocaleDateString('pt-BR') + ' ' + slot.hora;
+                    option.addEventListener('click', function() {
+                        dateInput.value = slot.data;
+                        timeInput.value = slot.hora;
+                        timeInput.dispatchEvent(new Event('change'));
+                        container.querySelectorAll('.btn').forEach(btn => btn.classList.remove('active'));
+                        option.classList.add('active');
+                    });
+                    container.appendChild(option);
                 });
-            }
-        }, 500);
+            })
+            .catch(function(error) {
+                container.textContent = 'Não foi possível buscar horários livres.';
+                console.error('Erro ao buscar horários livres:', error);
+            });
+    });
+}
+
+// Status badges, as rendered by the agenda templates
+const agendaStatusBadges = {
+    agendada: ['bg-primary', 'Agendada'],
+    concluida: ['bg-success', 'Concluída'],
+    cancelada: ['bg-danger', 'Cancelada'],
+    faltou: ['bg-warning', 'Faltou']
+};
+
+// Keep the day list in sync through Server-Sent Events
+function initAgendaLive() {
+    const card = document.getElementById('agendaDia');
+    if (!card || !window.EventSource) return;
+    
+    const source = new EventSource(card.dataset.eventosUrl);
+    source.addEventListener('agendamento', function(message) {
+        applyAgendaEvent(card, JSON.parse(message.data));
+    });
+    source.addEventListener('error', function() {
+        // The browser gives up on error statuses (503 when the server is full): retry later
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(initAgendaLive, 30000);
+        }
+    });
+}
+
+function findAgendaRow(card, event) {
+    let row = card.querySelector('tr[data-agendamento-id="' + event.id + '"]');
+    if (!row && event.recorrencia) {
+        // Occurrence of a recurring series that has just been stored
+        row = card.querySelector('tr[data-recorrencia="' + event.recorrencia + '"]');
+    }
+    return row;
+}
+
+function applyAgendaEvent(card, event) {
+    const tbody = document.getElementById('agendaLinhas');
+    let row = findAgendaRow(card, event);
+    
+    if (event.data !== card.dataset.data) {
+        // Moved to another day
+        if (row) {
+            row.remove();
+            updateAgendaTotal(tbody);
+        }
+        return;
+    }
+    
+    if (!tbody) {
+        // The day was empty: the table does not exist yet
+        window.location.reload();
+        return;
+    }
+    
+    if (!row) {
+        row = buildAgendaRow(card, event);
+        tbody.appendChild(row);
+    }
+    
+    row.dataset.agendamentoId = event.id;
+    row.querySelector('.agenda-hora').textContent = event.hora;
+    row.querySelector('.agenda-tipo').textContent = event.tipo;
+    const observacao = event.observacao;
+    row.querySelector('.agenda-observacao').textContent =
+        observacao ? (observacao.length > 50 ? observacao.slice(0, 50) + '...' : observacao) : '-';
+    
+    const badge = agendaStatusBadges[event.status] || ['bg-secondary', event.status];
+    const statusCell = row.querySelector('.agenda-status');
+    statusCell.innerHTML = '';
+    const span = document.createElement('span');
+    span.className = 'badge ' + badge[0];
+    span.textContent = badge[1];
+    statusCell.appendChild(span);
+    
+    const edit = row.querySelector('.agenda-editar');
+    if (edit) {
+        edit.href = card.dataset.editarUrl.replace('/0/', '/' + event.id + '/');
+    }
+    const checkbox = row.querySelector('.selecao-lote');
+    if (checkbox) {
+        checkbox.name = 'ids';
+        checkbox.value = event.id;
+    }
+    
+    // Keep the list ordered by time
+    const rows = Array.from(tbody.querySelectorAll('tr'));
+    rows.sort((a, b) => a.querySelector('.agenda-hora').textContent.localeCompare(
+        b.querySelector('.agenda-hora').textContent));
+    rows.forEach(r => tbody.appendChild(r));
+    updateAgendaTotal(tbody);
+    
+    row.classList.add('table-warning');
+    setTimeout(() => row.classList.remove('table-warning'), 2000);
+}
+
+// Minimal row for an appointment created after the page was rendered
+function buildAgendaRow(card, event) {
+    const row = document.createElement('tr');
+    
+    const checkCell = document.createElement('td');
+    const checkbox = document.createElement('input');
+    checkbox.type = 'checkbox';
+    checkbox.className = 'form-check-input selecao-lote';
+    checkbox.setAttribute('form', 'statusLoteForm');
+    checkCell.appendChild(checkbox);
+    row.appendChild(checkCell);
+    
+    const horaCell = document.createElement('td');
+    horaCell.className = 'fw-bold';
+    horaCell.innerHTML = '<span class="agenda-hora"></span>';
+    row.appendChild(horaCell);
+    
+    const pacienteCell = document.createElement('td');
+    const link = document.createElement('a');
+    link.className = 'text-decoration-none';
+    link.href = card.dataset.pacienteUrl.replace('/0', '/' + event.paciente_id);
+    link.textContent = event.paciente;
+    pacienteCell.appendChild(link);
+    row.appendChild(pacienteCell);
+    
+    ['agenda-tipo', 'agenda-observacao', 'agenda-status'].forEach(function(className) {
+        const cell = document.createElement('td');
+        cell.className = className;
+        row.appendChild(cell);
     });
+    
+    const actions = document.createElement('td');
+    actions.className = 'text-center';
+    actions.innerHTML = '<a class="btn btn-sm btn-outline-secondary agenda-editar" title="Editar agendamento">' +
+        '<i class="bi bi-pencil"></i></a>';
+    row.appendChild(actions);
+    return row;
+}
+
+function updateAgendaTotal(tbody) {
+    const total = document.getElementById('agendaTotal');
+    if (total && tbody) {
+        total.textContent = tbody.querySelectorAll('tr').length;
+    }
 }
@@ -0,0 +1,314 @@
+import os
+import logging
+import tempfile
+from abc import ABC, abstractmethod
+from datetime import datetime
+from flask import current_app, send_file, redirect, Response
+from werkzeug.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage(ABC):
+    """
+    Base interface for radiograph file storage.
+
+    Keys are relative, slash-separated paths such as
+    ``uploads/radiografias/<uuid>.jpeg`` - the same value stored in
+    ``Radiografia.arquivo_caminho`` - so rows stay valid whatever the backend.
+    """
+
+    @abstractmethod
+    def save(self, key, stream, content_type=None):
+        """Write a file-like object under ``key`` and return the bytes written"""
+
+    @abstractmethod
+    def open(self, key, chunk_size=CHUNK_SIZE):
+        """Yield the content of ``key`` in chunks"""
+
+    @abstractmethod
+    def read(self, key, offset, length):
+        """Read ``length`` bytes starting at ``offset`` (ranged read, no full download)"""
+
+    @abstractmethod
+    def exists(self, key):
+        """Whether an object is stored under ``key``"""
+
+    @abstractmethod
+    def size(self, key):
+        """Size of ``key`` in bytes"""
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove ``key``; a missing key is not an error"""
+
+    @abstractmethod
+    def iter_objects(self, prefix=''):
+        """
+        Yield ``(key, size, modified)`` for every object below ``prefix``.
+
+        Implementations list lazily so the scan works on millions of files
+        without building the full listing in memory.
+        """
+
+    def download_url(self, key, filename=None, content_type=None, as_attachment=False, expires=300):
+        """
+        Return a URL the browser can fetch directly, bypassing the app node,
+        or None when the backend can only be served through the app.
+        """
+        return None
+
+    def send(self, key, filename=None, content_type=None, as_attachment=False):
+        """Build the Flask response for ``key``"""
+        url = self.download_url(key, filename=filename, content_type=content_type,
+                                as_attachment=as_attachment)
+        if url:
+            return redirect(url)
+
+        response = Response(self.open(key), mimetype=content_type or 'application/octet-stream')
+        disposition = 'attachment' if as_attachment else 'inline'
+        if filename:
+            response.headers['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+        return response
+
+
+class LocalStorage(Storage):
+    """Stores files below a directory on the local filesystem"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise StorageError(f'Invalid storage key: {key}')
+        return path
+
+    def save(self, key, stream, content_type=None):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Escreve em um arquivo temporário e renomeia, para que leitores
+        # nunca vejam um arquivo parcialmente gravado
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        written = 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    tmp.write(chunk)
+                    written += len(chunk)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return written
+
+    def open(self, key, chunk_size=CHUNK_SIZE):
+        with open(self.path(key), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read(self, key, offset, length):
+        with open(self.path(key), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def iter_objects(self, prefix=''):
+        stack = [self.path(prefix) if prefix else self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                entries = os.scandir(directory)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat()
+                        key = os.path.relpath(entry.path, self.root).replace(os.sep, '/')
+                        yield key, stat.st_size, datetime.fromtimestamp(stat.st_mtime)
+
+    def send(self, key, filename=None, content_type=None, as_attachment=False):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            raise NotFound()
+
+        # send_file uses wsgi.file_wrapper and supports conditional/range requests
+        return send_file(path,
+                         mimetype=content_type,
+                         download_name=filename,
+                         as_attachment=as_attachment,
+                         conditional=True)
+
+
+class S3Storage(Storage):
+    """
+    Stores files in an S3-compatible bucket (AWS S3, MinIO, Ceph...).
+
+    Downloads are offloaded to the object store through presigned URLs, so
+    app nodes only handle the upload stream.
+    """
+
+    def __init__(self, bucket, endpoint_url=None, region=None, prefix='',
+                 access_key=None, secret_key=None, presigned_downloads=True):
+        # boto3 is only needed when this backend is configured
+        import boto3
+        from botocore.config import Config
+
+        config = Config(
+            signature_version='s3v4',
+            s3={'addressing_style': 'path' if endpoint_url else 'auto'}
+        )
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=config
+        )
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.presigned_downloads = presigned_downloads
+
+    def object_key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def save(self, key, stream, content_type=None):
+        counter = _CountingReader(stream)
+        extra_args = {'ContentType': content_type} if content_type else None
+        # upload_fileobj streams the body, switching to multipart for large files
+        self.client.upload_fileobj(counter, self.bucket, self.object_key(key), ExtraArgs=extra_args)
+        return counter.count
+
+    def open(self, key, chunk_size=CHUNK_SIZE):
+        obj = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        body = obj['Body']
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def read(self, key, offset, length):
+        from botocore.exceptions import ClientError
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key),
+                                         Range=f'bytes={offset}-{offset + length - 1}')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return b''
+            raise
+        with obj['Body'] as body:
+            return body.read()
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def iter_objects(self, prefix=''):
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.object_key(prefix)):
+            for obj in page.get('Contents', []):
+                # LastModified is timezone-aware (UTC); compare as naive local time like the rest of the app
+                modified = obj['LastModified'].astimezone().replace(tzinfo=None)
+                yield obj['Key'][strip:], obj['Size'], modified
+
+    def download_url(self, key, filename=None, content_type=None, as_attachment=False, expires=300):
+        if not self.presigned_downloads:
+            return None
+
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if filename:
+            disposition = 'attachment' if as_attachment else 'inline'
+            params['ResponseContentDisposition'] = f'{disposition}; filename="{filename}"'
+        if content_type:
+            params['ResponseContentType'] = content_type
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+
+class _CountingReader:
+    """Wraps a file-like object and counts the bytes read from it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+def init_storage(app):
+    """Create the storage backend configured for ``app``"""
+    backend = app.config.get('STORAGE_BACKEND', 'local')
+
+    if backend == 's3':
+        storage = S3Storage(
+            bucket=app.config['S3_BUCKET'],
+            endpoint_url=app.config.get('S3_ENDPOINT_URL'),
+            region=app.config.get('S3_REGION'),
+            prefix=app.config.get('S3_PREFIX', ''),
+            access_key=app.config.get('S3_ACCESS_KEY'),
+            secret_key=app.config.get('S3_SECRET_KEY'),
+            presigned_downloads=app.config.get('S3_PRESIGNED_DOWNLOADS', True)
+        )
+    elif backend == 'local':
+        storage = LocalStorage(app.config['UPLOAD_ROOT'])
+    else:
+        raise StorageError(f'Unknown storage backend: {backend}')
+
+    app.extensions['storage'] = storage
+    app.logger.info(f'Using {backend} storage backend')
+    return storage
+
+
+def get_storage():
+    return current_app.extensions['storage']
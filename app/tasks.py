@@ -0,0 +1,40 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app import db
+from app.tracing import rastrear, span_atual
+
+logger = logging.getLogger(__name__)
+
+
+def init_tasks(app):
+    """Create the per-process worker pool used for background jobs"""
+    executor = ThreadPoolExecutor(max_workers=app.config['TASK_WORKERS'],
+                                  thread_name_prefix='tarefa')
+    app.extensions['tasks'] = executor
+    return executor
+
+
+def _executar(app, fn, args, kwargs, pai):
+    # O job continua o trace da requisição que o criou
+    with app.app_context(), rastrear(f'tarefa {fn.__name__}', pai=pai):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"Background task {fn.__name__} failed")
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run ``fn`` on the worker pool inside an application context.
+
+    Returns a Future. Jobs are fire-and-forget from the request's point of
+    view: they must persist their own results and tolerate being lost if
+    the process restarts (the CLI backfill commands pick them up again).
+    """
+    app = current_app._get_current_object()
+    return app.extensions['tasks'].submit(_executar, app, fn, args, kwargs, span_atual())
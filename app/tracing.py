@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Tipos de span do OTLP
+INTERNO, SERVIDOR, CLIENTE = 1, 2, 3
+# Status do OTLP
+STATUS_ERRO = 2
+
+# Spans enviados por lote e espera máxima para completar um lote (segundos)
+TAMANHO_LOTE = 512
+INTERVALO_EXPORTACAO = 5
+# Spans aguardando exportação além disso são descartados
+MAX_PENDENTES = 10000
+# Tamanho máximo do SQL guardado no span
+MAX_SQL = 1000
+
+# Span em andamento neste thread (ou contexto); None quando a requisição não foi amostrada
+_span_atual = ContextVar('span_atual', default=None)
+
+
+class Span:
+    """One timed operation of a trace, in the shape OTLP expects"""
+
+    def __init__(self, nome, trace_id, pai_id=None, tipo=INTERNO, atributos=None):
+        self.nome = nome
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.pai_id = pai_id
+        self.tipo = tipo
+        self.atributos = dict(atributos or {})
+        self.inicio = time.time_ns()
+        self.fim = None
+        self.erro = None
+
+    def filho(self, nome, tipo=INTERNO, **atributos):
+        return Span(nome, self.trace_id, self.span_id, tipo, atributos)
+
+    def falhou(self, excecao):
+        self.erro = f'{type(excecao).__name__}: {excecao}'
+
+    def encerrar(self):
+        self.fim = time.time_ns()
+        exportador = _exportador
+        if exportador is not None:
+            exportador.adicionar(self)
+
+    def para_otlp(self):
+        dados = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.nome,
+            'kind': self.tipo,
+            'startTimeUnixNano': str(self.inicio),
+            'endTimeUnixNano': str(self.fim),
+            'attributes': _atributos_otlp(self.atributos),
+        }
+        if self.pai_id:
+            dados['parentSpanId'] = self.pai_id
+        if self.erro:
+            dados['status'] = {'code': STATUS_ERRO, 'message': self.erro}
+        return dados
+
+
+def _valor_otlp(valor):
+    if isinstance(valor, bool):
+        return {'boolValue': valor}
+    if isinstance(valor, int):
+        return {'intValue': str(valor)}
+    if isinstance(valor, float):
+        return {'doubleValue': valor}
+    return {'stringValue': str(valor)}
+
+
+def _atributos_otlp(atributos):
+    return [{'key': chave, 'value': _valor_otlp(valor)} for chave, valor in atributos.items() if valor is not None]
+
+
+class ExportadorOTLP:
+    """
+    Sends finished spans in batches, as OTLP/JSON, from a background thread.
+
+    ``destino`` is either an OTLP/HTTP collector URL (``.../v1/traces``) or a
+    file, which gets one ExportTraceServiceRequest per line. Spans that
+    cannot be queued or sent are dropped: tracing never slows requests down.
+    """
+
+    def __init__(self, destino, servico):
+        self.destino = destino
+        self.recurso = {'attributes': _atributos_otlp({'service.name': servico})}
+        self.fila = queue.Queue(maxsize=MAX_PENDENTES)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def adicionar(self, span):
+        self._iniciar()
+        try:
+            self.fila.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _iniciar(self):
+        # Uma thread por processo: depois do fork do gunicorn a do master não existe
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._exportar_continuamente, name='tracing', daemon=True)
+            self.thread.start()
+
+    def _proximo_lote(self, espera):
+        spans = []
+        try:
+            spans.append(self.fila.get(timeout=espera))
+            while len(spans) < TAMANHO_LOTE:
+                spans.append(self.fila.get_nowait())
+        except queue.Empty:
+            pass
+        return spans
+
+    def _exportar_continuamente(self):
+        while True:
+            spans = self._proximo_lote(INTERVALO_EXPORTACAO)
+            if spans:
+                self.enviar(spans)
+
+    def descarregar(self):
+        """Send whatever is queued (process exit, CLI commands)"""
+        while True:
+            spans = self._proximo_lote(0)
+            if not spans:
+                return
+            self.enviar(spans)
+
+    def enviar(self, spans):
+        corpo = json.dumps({'resourceSpans': [{
+            'resource': self.recurso,
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': [s.para_otlp() for s in spans]}],
+        }]})
+        try:
+            if self.destino.startswith(('http://', 'https://')):
+                import requests
+                resposta = requests.post(self.destino, data=corpo, timeout=5,
+                                         headers={'Content-Type': 'application/json'})
+                resposta.raise_for_status()
+            else:
+                # Uma única escrita em O_APPEND: linhas de workers diferentes não se misturam
+                fd = os.open(self.destino, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, (corpo + '\n').encode())
+                finally:
+                    os.close(fd)
+        except Exception as e:
+            logger.warning(f'Dropping {len(spans)} spans, export to {self.destino} failed: {e}')
+
+
+_exportador = None
+
+
+# --- API ---------------------------------------------------------------------
+
+def span_atual():
+    return _span_atual.get()
+
+
+@contextmanager
+def rastrear(nome, tipo=INTERNO, pai=None, **atributos):
+    """
+    Time the enclosed block as a child of the current span (or of ``pai``).
+    Does nothing when the current request is not being traced.
+    """
+    pai = pai or _span_atual.get()
+    if pai is None:
+        yield None
+        return
+    span = pai.filho(nome, tipo, **atributos)
+    token = _span_atual.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.falhou(e)
+        raise
+    finally:
+        _span_atual.reset(token)
+        span.encerrar()
+
+
+def rastreada(nome, servico):
+    """Decorator form of ``rastrear`` for calls to an outside provider (``servico``)"""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def envolvida(*args, **kwargs):
+            with rastrear(nome, CLIENTE, **{'peer.service': servico}):
+                return funcao(*args, **kwargs)
+        return envolvida
+    return decorador
+
+
+# --- Requisições -------------------------------------------------------------
+
+def _contexto_remoto():
+    """(trace_id, parent span id, sampled) from a W3C traceparent header"""
+    partes = request.headers.get('traceparent', '').split('-')
+    if len(partes) != 4 or len(partes[1]) != 32 or len(partes[2]) != 16:
+        return None
+    try:
+        amostrado = int(partes[3], 16) & 1
+    except ValueError:
+        return None
+    return partes[1], partes[2], bool(amostrado)
+
+
+def _iniciar_requisicao(taxa):
+    remoto = _contexto_remoto()
+    if remoto:
+        trace_id, pai_id, amostrado = remoto
+    else:
+        trace_id, pai_id, amostrado = None, None, random.random() < taxa
+    if not amostrado:
+        return
+    span = Span(f'{request.method} {request.url_rule.rule if request.url_rule else request.path}',
+                trace_id or os.urandom(16).hex(), pai_id, SERVIDOR, {
+                    'http.method': request.method,
+                    'http.target': request.full_path.rstrip('?'),
+                    'http.route': request.url_rule.rule if request.url_rule else None,
+                })
+    g.span_requisicao = (span, _span_atual.set(span))
+
+
+def _anotar_resposta(response):
+    if 'span_requisicao' in g:
+        span = g.span_requisicao[0]
+        span.atributos['http.status_code'] = response.status_code
+        if response.status_code >= 500:
+            span.erro = f'HTTP {response.status_code}'
+        # W3C traceresponse: permite achar o trace a partir da aba Rede do navegador
+        response.headers['traceresponse'] = f'00-{span.trace_id}-{span.span_id}-01'
+    return response
+
+
+def _encerrar_requisicao(exc):
+    dados = g.pop('span_requisicao', None)
+    if dados is None:
+        return
+    span, token = dados
+    if exc is not None:
+        span.falhou(exc)
+    _span_atual.reset(token)
+    span.encerrar()
+
+
+# --- SQL, commits e templates ------------------------------------------------
+
+def _antes_de_executar(conn, cursor, statement, parameters, context, executemany):
+    pai = _span_atual.get()
+    if pai is not None and context is not None:
+        context.span_sql = pai.filho(statement.split(None, 1)[0].upper() if statement else 'SQL', CLIENTE, **{
+            'db.system': conn.dialect.name,
+            'db.statement': statement[:MAX_SQL],
+        })
+
+
+def _depois_de_executar(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, 'span_sql', None)
+    if span is not None:
+        span.atributos['db.rows_affected'] = cursor.rowcount if cursor.rowcount >= 0 else None
+        span.encerrar()
+
+
+def _erro_sql(contexto_excecao):
+    span = getattr(contexto_excecao.execution_context, 'span_sql', None)
+    if span is not None:
+        span.falhou(contexto_excecao.original_exception)
+        span.encerrar()
+
+
+def _antes_do_commit(session):
+    pai = _span_atual.get()
+    if pai is not None and 'span_commit' not in session.info:
+        span = pai.filho('db.commit')
+        # O flush do commit roda dentro deste span
+        session.info['span_commit'] = (span, _span_atual.set(span))
+
+
+def _fim_do_commit(session, erro=None):
+    dados = session.info.pop('span_commit', None)
+    if dados is None:
+        return
+    span, token = dados
+    if erro:
+        span.erro = erro
+    _span_atual.reset(token)
+    span.encerrar()
+
+
+def _antes_de_renderizar(sender, template, context, **extra):
+    pai = _span_atual.get()
+    if pai is not None:
+        span = pai.filho(f'render {template.name}', **{'template.name': template.name})
+        span.token = _span_atual.set(span)
+
+
+def _renderizado(sender, template, context, **extra):
+    span = _span_atual.get()
+    if span is not None and span.nome == f'render {template.name}':
+        _span_atual.reset(span.token)
+        span.encerrar()
+
+
+def init_tracing(app):
+    """
+    Trace a sample (TRACING_AMOSTRAGEM) of requests, or those whose W3C
+    traceparent header says so: one span for the request with children for
+    every SQL statement, commit, template render, notification provider call
+    and background job it starts, exported as OTLP/JSON to TRACING_DESTINO.
+    """
+    global _exportador
+    destino = app.config['TRACING_DESTINO']
+    if not destino:
+        return
+    _exportador = ExportadorOTLP(destino, app.config['TRACING_SERVICO'])
+    atexit.register(_exportador.descarregar)
+
+    with app.app_context():
+        from app import db
+        event.listen(db.engine, 'before_cursor_execute', _antes_de_executar)
+        event.listen(db.engine, 'after_cursor_execute', _depois_de_executar)
+        event.listen(db.engine, 'handle_error', _erro_sql)
+    event.listen(Session, 'before_commit', _antes_do_commit)
+    event.listen(Session, 'after_commit', _fim_do_commit)
+    event.listen(Session, 'after_rollback', lambda session: _fim_do_commit(session, 'rollback'))
+    before_render_template.connect(_antes_de_renderizar, app)
+    template_rendered.connect(_renderizado, app)
+
+    taxa = app.config['TRACING_AMOSTRAGEM']
+    app.before_request(lambda: _iniciar_requisicao(taxa))
+    app.after_request(_anotar_resposta)
+    app.teardown_request(_encerrar_requisicao)
@@ -0,0 +1,208 @@
+import logging
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, object_session
+from app import db
+from app.models import Radiografia, UsoArmazenamento
+
+logger = logging.getLogger(__name__)
+
+# Quantidade de chaves verificadas no banco por consulta durante a varredura
+GC_BATCH_SIZE = 1000
+
+
+# --- Contabilização de uso ---------------------------------------------------
+
+def _ajustar_uso(connection, paciente_id, delta_bytes, delta_arquivos):
+    """Apply a delta to the patient's storage totals inside the current flush"""
+    if not paciente_id or (not delta_bytes and not delta_arquivos):
+        return
+
+    tabela = UsoArmazenamento.__table__
+    dialect = connection.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert_fn = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert_fn(tabela).values(
+            paciente_id=paciente_id,
+            total_bytes=delta_bytes,
+            total_arquivos=delta_arquivos
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tabela.c.paciente_id],
+            set_={
+                'total_bytes': tabela.c.total_bytes + stmt.excluded.total_bytes,
+                'total_arquivos': tabela.c.total_arquivos + stmt.excluded.total_arquivos
+            }
+        )
+        connection.execute(stmt)
+        return
+
+    result = connection.execute(
+        update(tabela)
+        .where(tabela.c.paciente_id == paciente_id)
+        .values(total_bytes=tabela.c.total_bytes + delta_bytes,
+                total_arquivos=tabela.c.total_arquivos + delta_arquivos)
+    )
+    if result.rowcount == 0:
+        connection.execute(insert(tabela).values(paciente_id=paciente_id,
+                                                 total_bytes=delta_bytes,
+                                                 total_arquivos=delta_arquivos))
+
+
+def _valor_anterior(target, atributo):
+    history = inspect(target).attrs[atributo].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, atributo)
+
+
+def _agendar_remocao(target, chave):
+    """Remember a storage key to delete once the transaction commits"""
+    session = object_session(target)
+    if chave and session is not None:
+        session.info.setdefault('arquivos_removidos', set()).add(chave)
+
+
+@event.listens_for(Radiografia, 'after_insert')
+def _radiografia_inserida(mapper, connection, target):
+    if target.arquivo_caminho:
+        _ajustar_uso(connection, target.paciente_id, target.arquivo_tamanho or 0, 1)
+
+
+@event.listens_for(Radiografia, 'after_update')
+def _radiografia_atualizada(mapper, connection, target):
+    estado = inspect(target)
+    if not any(estado.attrs[a].history.has_changes()
+               for a in ('paciente_id', 'arquivo_caminho', 'arquivo_tamanho')):
+        return
+
+    paciente_anterior = _valor_anterior(target, 'paciente_id')
+    caminho_anterior = _valor_anterior(target, 'arquivo_caminho')
+    tamanho_anterior = _valor_anterior(target, 'arquivo_tamanho') or 0
+
+    if caminho_anterior:
+        _ajustar_uso(connection, paciente_anterior, -tamanho_anterior, -1)
+    if target.arquivo_caminho:
+        _ajustar_uso(connection, target.paciente_id, target.arquivo_tamanho or 0, 1)
+
+    # Arquivo substituído: o antigo deixa de ser referenciado
+    if caminho_anterior and caminho_anterior != target.arquivo_caminho:
+        _agendar_remocao(target, caminho_anterior)
+
+
+@event.listens_for(Radiografia, 'after_delete')
+def _radiografia_removida(mapper, connection, target):
+    caminho = _valor_anterior(target, 'arquivo_caminho')
+    if caminho:
+        _ajustar_uso(connection, _valor_anterior(target, 'paciente_id'),
+                     -(_valor_anterior(target, 'arquivo_tamanho') or 0), -1)
+        _agendar_remocao(target, caminho)
+
+
+@event.listens_for(Session, 'after_commit')
+def _remover_arquivos_apos_commit(session):
+    chaves = session.info.pop('arquivos_removidos', None)
+    if not chaves or not has_app_context():
+        return
+
+    storage = current_app.extensions['storage']
+    for chave in chaves:
+        try:
+            storage.delete(chave)
+        except Exception as e:
+            # O coletor de órfãos remove o arquivo na próxima execução
+            logger.warning(f"Could not delete {chave}: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_remocoes(session):
+    session.info.pop('arquivos_removidos', None)
+
+
+def uso_paciente(paciente_id):
+    """Return (bytes, files) stored for a patient without touching the storage"""
+    uso = db.session.get(UsoArmazenamento, paciente_id)
+    if not uso:
+        return 0, 0
+    return uso.total_bytes, uso.total_arquivos
+
+
+def uso_total():
+    total_bytes, total_arquivos = db.session.query(
+        func.coalesce(func.sum(UsoArmazenamento.total_bytes), 0),
+        func.coalesce(func.sum(UsoArmazenamento.total_arquivos), 0)
+    ).one()
+    return int(total_bytes), int(total_arquivos)
+
+
+def recalcular_uso():
+    """Rebuild the storage totals from the radiograph rows (no filesystem scan)"""
+    totais = db.session.query(
+        Radiografia.paciente_id,
+        func.coalesce(func.sum(Radiografia.arquivo_tamanho), 0),
+        func.count(Radiografia.id)
+    ).filter(Radiografia.arquivo_caminho.isnot(None)).group_by(Radiografia.paciente_id).all()
+
+    db.session.query(UsoArmazenamento).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(UsoArmazenamento, [
+        {'paciente_id': paciente_id, 'total_bytes': total_bytes, 'total_arquivos': total_arquivos}
+        for paciente_id, total_bytes, total_arquivos in totais
+    ])
+    db.session.commit()
+    return len(totais)
+
+
+# --- Coletor de arquivos órfãos ----------------------------------------------
+
+def _chaves_referenciadas(chaves):
+    rows = db.session.query(Radiografia.arquivo_caminho).filter(
+        Radiografia.arquivo_caminho.in_(chaves)
+    )
+    return {caminho for (caminho,) in rows}
+
+
+def coletar_orfaos(prefixo='uploads/', carencia=timedelta(hours=24), simular=False):
+    """
+    Delete stored files that no database row references.
+
+    The storage listing is consumed lazily and checked against the database
+    in batches, so memory stays flat regardless of the number of files.
+    Files younger than ``carencia`` are kept: they may belong to an upload
+    whose row has not been committed yet.
+    """
+    storage = current_app.extensions['storage']
+    limite = datetime.now() - carencia
+    stats = {'verificados': 0, 'orfaos': 0, 'bytes_liberados': 0, 'bytes_total': 0}
+
+    def processar(lote):
+        referenciadas = _chaves_referenciadas([chave for chave, _, _ in lote])
+        for chave, tamanho, modificado in lote:
+            if chave in referenciadas or modificado > limite:
+                continue
+            stats['orfaos'] += 1
+            stats['bytes_liberados'] += tamanho
+            if simular:
+                logger.info(f"Orphaned file (dry run): {chave}")
+                continue
+            try:
+                storage.delete(chave)
+            except Exception as e:
+                logger.warning(f"Could not delete {chave}: {e}")
+        # Libera o identity map e a transação entre os lotes
+        db.session.rollback()
+
+    lote = []
+    for objeto in storage.iter_objects(prefixo):
+        stats['verificados'] += 1
+        stats['bytes_total'] += objeto[1]
+        lote.append(objeto)
+        if len(lote) >= GC_BATCH_SIZE:
+            processar(lote)
+            lote = []
+    if lote:
+        processar(lote)
+
+    return stats
@@ -0,0 +1,111 @@
+import hashlib
+from datetime import date, datetime
+from flask import request, session, make_response, abort
+from flask_login import current_user
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session
+from app import db
+from app.models import (Paciente, Evolucao, Radiografia, RadiografiaMetadados, Agendamento,
+                        RecorrenciaAgendamento, FormularioPreConsulta)
+from app.assets import versao_estaticos
+
+# Registros exibidos nas páginas do paciente: gravar qualquer um deles muda a versão do paciente
+FILHOS = (Evolucao, Radiografia, Agendamento, RecorrenciaAgendamento, FormularioPreConsulta)
+
+
+# --- Versão do prontuário ----------------------------------------------------
+
+@event.listens_for(Paciente, 'before_update')
+def _paciente_alterado(mapper, connection, target):
+    # Expressão SQL: soma sobre o valor do banco, que os filhos podem ter incrementado no mesmo flush
+    target.versao = Paciente.versao + 1
+    target.atualizado_em = datetime.now()
+
+
+def marcar_pacientes(connection, ids):
+    """
+    Bump the record version of the patients in ``ids`` (a collection or a
+    SELECT of patient ids) within the current transaction.
+    """
+    if isinstance(ids, (set, list, tuple)):
+        ids = [i for i in ids if i]
+        if not ids:
+            return
+    tabela = Paciente.__table__
+    connection.execute(update(tabela).where(tabela.c.id.in_(ids))
+                       .values(versao=tabela.c.versao + 1, atualizado_em=datetime.now()))
+
+
+def _pacientes_do_objeto(objeto):
+    ids = {objeto.paciente_id}
+    historico = inspect(objeto).attrs.paciente_id.history
+    # Registro transferido de paciente: os dois prontuários mudam
+    ids.update(historico.deleted or ())
+    return ids
+
+
+@event.listens_for(Session, 'after_flush')
+def _marcar_prontuarios(session, flush_context):
+    pacientes, radiografias = set(), set()
+    for objeto in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(objeto, FILHOS):
+            if objeto in session.dirty and not session.is_modified(objeto, include_collections=False):
+                continue
+            pacientes |= _pacientes_do_objeto(objeto)
+        elif isinstance(objeto, RadiografiaMetadados):
+            radiografias.add(objeto.radiografia_id)
+
+    # Pacientes removidos não precisam de versão
+    pacientes -= {p.id for p in session.deleted if isinstance(p, Paciente)}
+    if pacientes:
+        marcar_pacientes(session.connection(), pacientes)
+    if radiografias:
+        marcar_pacientes(session.connection(),
+                         select(Radiografia.paciente_id).where(Radiografia.id.in_(radiografias)))
+
+
+# --- GET condicional ---------------------------------------------------------
+
+def versao_paciente(paciente_id):
+    """Record version of a patient from the primary key alone; 404 when missing"""
+    versao = db.session.execute(select(Paciente.versao).where(Paciente.id == paciente_id)).scalar()
+    if versao is None:
+        abort(404)
+    return versao
+
+
+def etag_registro(*partes):
+    """
+    ETag of a record page. Besides the record version it covers what the
+    page shows around the record: the logged-in user (navbar), today's date
+    (ages, upcoming appointments), the query string (filters) and the
+    static asset build.
+    """
+    contexto = (current_user.get_id(), current_user.nome, current_user.tipo, date.today(),
+                request.query_string.decode(), versao_estaticos())
+    chave = ':'.join(str(p) for p in partes + contexto)
+    return hashlib.md5(chave.encode()).hexdigest()
+
+
+def nao_modificado(etag):
+    """
+    304 response when the browser already has this version of the page,
+    None otherwise. Pages with pending flash messages are always rendered.
+    """
+    # A ETag chega fraca quando a resposta foi comprimida (CompressionMiddleware)
+    if session.get('_flashes') or not request.if_none_match.contains_weak(etag):
+        return None
+    response = make_response('', 304)
+    return _com_cabecalhos(response, etag)
+
+
+def com_etag(html, etag):
+    """Response for a rendered record page, revalidated on every visit"""
+    return _com_cabecalhos(make_response(html), etag)
+
+
+def _com_cabecalhos(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
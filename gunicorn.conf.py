@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+# Métricas do Prometheus somadas entre os workers (ver app/metrics.py): cada
+# processo grava seus valores em arquivos neste diretório. Definido aqui, no
+# master, para valer em todos os workers antes de importarem a aplicação.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'clinica-metricas'))
+
+
+def on_starting(server):
+    # Arquivos de uma execução anterior somariam valores antigos
+    diretorio = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(diretorio, ignore_errors=True)
+    os.makedirs(diretorio, exist_ok=True)
+
+
+def post_worker_init(worker):
+    # Relatório de memória por SIGUSR2 (ver app/memory.py): instalado em cada
+    # worker depois que o gunicorn redefiniu os sinais, inclusive com --preload
+    from app.memory import instalar_sinal
+    instalar_sinal(worker.wsgi)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    # Remove os gauges do worker encerrado da soma
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# A aplicação é criada na importação do pacote: banco e uploads descartáveis
+# precisam estar no ambiente antes do primeiro "import app"
+_PASTA = tempfile.mkdtemp(prefix='clinica-testes-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_PASTA, 'testes.db')}"
+os.environ['UPLOAD_ROOT'] = os.path.join(_PASTA, 'uploads')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_PASTA, ignore_errors=True)
+
+
+@pytest.fixture
+def banco():
+    """Application context over the test database, emptied after each test"""
+    from app import app, db
+    from app.models import Agendamento, RecorrenciaAgendamento, Paciente
+
+    with app.app_context():
+        yield db
+        db.session.rollback()
+        for modelo in (Agendamento, RecorrenciaAgendamento, Paciente):
+            db.session.query(modelo).delete()
+        db.session.commit()
+
+
+@pytest.fixture
+def paciente(banco):
+    from app.models import Paciente
+
+    paciente = Paciente(nome='Maria Silva')
+    banco.session.add(paciente)
+    banco.session.commit()
+    return paciente
@@ -0,0 +1,200 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app.agenda import (buscar_conflitos, buscar_horarios_livres, carregar_expediente, datas_ocorrencias,
+                        hora_em_minutos, materializar_ocorrencia)
+from app.models import Agendamento, RecorrenciaAgendamento
+
+# Segunda-feira
+DIA = date(2030, 1, 7)
+
+
+def _agendar(banco, paciente, hora, duracao=30, dia=DIA, status='agendada'):
+    agendamento = Agendamento(paciente_id=paciente.id, data_consulta=dia, hora_consulta=hora,
+                              duracao_minutos=duracao, tipo_consulta='Consulta', status=status)
+    banco.session.add(agendamento)
+    banco.session.commit()
+    return agendamento
+
+
+def _conflitos(hora, duracao=30, dia=DIA, ignorar_id=None):
+    inicio = hora_em_minutos(hora)
+    return [c[0] for c in buscar_conflitos(dia, inicio, inicio + duracao, ignorar_id=ignorar_id)]
+
+
+@pytest.mark.parametrize('hora, duracao', [
+    ('09:15', 30),   # começa no meio
+    ('08:45', 30),   # termina no meio
+    ('09:10', 10),   # dentro
+    ('08:00', 180),  # contém
+    ('09:00', 30),   # mesmo horário
+])
+def test_sobreposicoes_sao_conflito(banco, paciente, hora, duracao):
+    existente = _agendar(banco, paciente, '09:00')
+    assert _conflitos(hora, duracao) == [existente.id]
+
+
+@pytest.mark.parametrize('hora', ['08:30', '09:30'])
+def test_horarios_encostados_nao_sao_conflito(banco, paciente, hora):
+    _agendar(banco, paciente, '09:00')
+    assert _conflitos(hora) == []
+
+
+def test_consulta_longa_que_comeca_bem_antes(banco, paciente):
+    # A busca limita o início a DURACAO_MAXIMA antes: uma consulta de 4 horas ainda aparece
+    longa = _agendar(banco, paciente, '08:00', duracao=240)
+    assert _conflitos('11:30') == [longa.id]
+    assert _conflitos('12:00') == []
+
+
+@pytest.mark.parametrize('status', ['cancelada', 'faltou'])
+def test_status_que_liberam_o_horario(banco, paciente, status):
+    _agendar(banco, paciente, '09:00', status=status)
+    assert _conflitos('09:00') == []
+
+
+def test_concluida_continua_ocupando(banco, paciente):
+    concluida = _agendar(banco, paciente, '09:00', status='concluida')
+    assert _conflitos('09:00') == [concluida.id]
+
+
+def test_ignora_o_proprio_agendamento_e_outros_dias(banco, paciente):
+    existente = _agendar(banco, paciente, '09:00')
+    _agendar(banco, paciente, '09:00', dia=date(2030, 1, 8))
+    assert _conflitos('09:00', ignorar_id=existente.id) == []
+
+
+def test_conflitos_em_ordem_de_inicio(banco, paciente):
+    segundo = _agendar(banco, paciente, '10:00')
+    primeiro = _agendar(banco, paciente, '09:00')
+    assert _conflitos('09:00', duracao=90) == [primeiro.id, segundo.id]
+
+
+EXPEDIENTE = carregar_expediente('seg-sex=08:00-12:00,13:00-18:00;sab=08:00-12:00')
+# Bem antes de DIA: nenhum horário é descartado por já ter passado
+ANTES = datetime(2029, 12, 1, 8, 0)
+
+
+def _livres(duracao=30, inicio=DIA, fim=DIA, limite=50, agora=ANTES, **kwargs):
+    return [(dia, f'{comeco // 60:02d}:{comeco % 60:02d}')
+            for dia, comeco, _ in buscar_horarios_livres(duracao, inicio, fim, limite=limite,
+                                                         expediente=EXPEDIENTE, agora=agora, **kwargs)]
+
+
+def test_carregar_expediente():
+    assert EXPEDIENTE[0] == ((480, 720), (780, 1080))
+    assert EXPEDIENTE[4] == EXPEDIENTE[0]
+    assert EXPEDIENTE[5] == ((480, 720),)
+    assert 6 not in EXPEDIENTE
+    with pytest.raises(ValueError):
+        carregar_expediente('seg-xyz=08:00-12:00')
+    with pytest.raises(ValueError):
+        carregar_expediente('seg=0800')
+
+
+def test_dia_vazio_respeita_as_janelas(banco):
+    horarios = [hora for _, hora in _livres(duracao=60)]
+    assert horarios == ['08:00', '09:00', '10:00', '11:00', '13:00', '14:00', '15:00', '16:00', '17:00']
+
+
+def test_pula_os_ocupados_e_arredonda_ao_passo(banco, paciente):
+    # Termina 08:25: o próximo horário começa no passo seguinte, 08:30
+    _agendar(banco, paciente, '08:00', duracao=25)
+    # Sobrepostos: tratados como um único intervalo 09:00-10:10
+    _agendar(banco, paciente, '09:00', duracao=60)
+    _agendar(banco, paciente, '09:30', duracao=40)
+    horarios = [hora for _, hora in _livres(limite=4)]
+    assert horarios == ['08:30', '10:15', '10:45', '11:15']
+
+
+def test_ignora_status_que_liberam_o_horario(banco, paciente):
+    _agendar(banco, paciente, '08:00', status='cancelada')
+    assert _livres(limite=1) == [(DIA, '08:00')]
+
+
+def test_duracao_que_nao_cabe_na_janela(banco):
+    # A janela mais longa (13:00-18:00) tem exatamente 5 horas
+    assert _livres(duracao=300, limite=1) == [(DIA, '13:00')]
+    assert _livres(duracao=301, fim=date(2030, 1, 13)) == []
+
+
+def test_fim_de_semana_e_limite(banco):
+    sabado, domingo, segunda = date(2030, 1, 12), date(2030, 1, 13), date(2030, 1, 14)
+    livres = _livres(duracao=240, inicio=sabado, fim=segunda, limite=3)
+    assert livres == [(sabado, '08:00'), (segunda, '08:00'), (segunda, '13:00')]
+    assert domingo not in [dia for dia, _ in livres]
+
+
+def test_nao_oferece_horarios_passados(banco):
+    livres = _livres(inicio=date(2030, 1, 1), agora=datetime(2030, 1, 7, 15, 7), limite=2)
+    assert livres == [(DIA, '15:15'), (DIA, '15:45')]
+
+
+def _serie(data_inicio, frequencia='semanal', intervalo=1, data_fim=None, total_ocorrencias=None, **kwargs):
+    return RecorrenciaAgendamento(data_inicio=data_inicio, frequencia=frequencia, intervalo=intervalo,
+                                  data_fim=data_fim, total_ocorrencias=total_ocorrencias,
+                                  hora_consulta='09:00', duracao_minutos=30, tipo_consulta='Retorno', **kwargs)
+
+
+def _datas(serie, inicio, fim):
+    return [d.isoformat() for d in datas_ocorrencias(serie, inicio, fim)]
+
+
+def test_serie_semanal_e_quinzenal():
+    assert _datas(_serie(DIA), date(2030, 1, 1), date(2030, 1, 31)) == \
+        ['2030-01-07', '2030-01-14', '2030-01-21', '2030-01-28']
+    assert _datas(_serie(DIA, intervalo=2), date(2030, 1, 1), date(2030, 1, 31)) == \
+        ['2030-01-07', '2030-01-21']
+
+
+def test_serie_diaria_dentro_da_janela():
+    assert _datas(_serie(DIA, frequencia='diaria', intervalo=3), date(2030, 1, 9), date(2030, 1, 16)) == \
+        ['2030-01-10', '2030-01-13', '2030-01-16']
+
+
+def test_janela_anos_depois_do_inicio():
+    # O índice da primeira ocorrência é calculado: mantém o dia da semana e o passo
+    inicio = date(2010, 1, 4)
+    todas = [inicio + timedelta(days=14 * i) for i in range(600)]
+    esperadas = [d.isoformat() for d in todas if date(2030, 1, 1) <= d <= date(2030, 2, 28)]
+    assert _datas(_serie(inicio, intervalo=2), date(2030, 1, 1), date(2030, 2, 28)) == esperadas
+    assert len(esperadas) == 4
+
+
+def test_serie_mensal_no_fim_do_mes():
+    serie = _serie(date(2030, 1, 31), frequencia='mensal')
+    # Fevereiro limita ao dia 28, mas março volta ao 31: cada data parte do início da série
+    assert _datas(serie, date(2030, 1, 1), date(2030, 4, 30)) == \
+        ['2030-01-31', '2030-02-28', '2030-03-31', '2030-04-30']
+    assert _datas(_serie(date(2031, 12, 31), frequencia='mensal'), date(2032, 2, 1), date(2032, 2, 29)) == \
+        ['2032-02-29']
+
+
+def test_limites_da_serie():
+    # Total contado desde o início, mesmo com a janela começando depois
+    assert _datas(_serie(DIA, total_ocorrencias=3), date(2030, 1, 10), date(2030, 3, 1)) == \
+        ['2030-01-14', '2030-01-21']
+    # data_fim é inclusiva
+    assert _datas(_serie(DIA, data_fim=date(2030, 1, 21)), date(2030, 1, 1), date(2030, 3, 1)) == \
+        ['2030-01-07', '2030-01-14', '2030-01-21']
+    assert _datas(_serie(DIA), date(2029, 1, 1), date(2030, 1, 6)) == []
+    assert _datas(_serie(DIA), date(2030, 1, 20), date(2030, 1, 10)) == []
+    # Intervalo inválido vale como 1
+    assert _datas(_serie(DIA, intervalo=0), date(2030, 1, 7), date(2030, 1, 14)) == ['2030-01-07', '2030-01-14']
+
+
+def test_ocorrencias_virtuais_ocupam_o_horario(banco, paciente):
+    serie = _serie(DIA, paciente_id=paciente.id)
+    banco.session.add(serie)
+    banco.session.commit()
+    assert _conflitos('09:15', dia=date(2030, 1, 14)) == [None]
+    assert _livres(limite=1, inicio=date(2030, 1, 14), fim=date(2030, 1, 14)) == [(date(2030, 1, 14), '08:00')]
+    assert (date(2030, 1, 14), '09:00') not in _livres(inicio=date(2030, 1, 14), fim=date(2030, 1, 14))
+
+    # Gravada e movida: o horário original fica livre e a ocorrência não aparece duas vezes
+    agendamento = materializar_ocorrencia(serie, date(2030, 1, 14))
+    agendamento.hora_consulta = '11:00'
+    banco.session.commit()
+    assert _conflitos('09:00', dia=date(2030, 1, 14)) == []
+    assert _conflitos('11:00', dia=date(2030, 1, 14)) == [agendamento.id]
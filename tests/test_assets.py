@@ -0,0 +1,84 @@
+import glob
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from app.assets import minificar_js
+
+PASTA_JS = os.path.join(os.path.dirname(__file__), os.pardir, 'app', 'static', 'js')
+ARQUIVOS_JS = sorted(glob.glob(os.path.join(PASTA_JS, '*.js')))
+NODE = shutil.which('node')
+
+
+@pytest.mark.parametrize('codigo, esperado', [
+    ('a = b / c / d;', 'a=b/c/d;'),
+    ('var total = soma(x) / 2', 'var total=soma(x)/2'),
+    ('i++ / 2 / j-- / 3', 'i++/2/j--/3'),
+    # Sinais seguidos não podem virar ++ ou --
+    ('a + +b; c - -d; e++ + f; g + ++h', 'a+ +b;c- -d;e++ +f;g+ ++h'),
+    ('typeof x === "string"', 'typeof x==="string"'),
+    # Comentários somem; dentro de strings ficam
+    ('a = 1; // fim\nb = 2 /* meio */ + 3', 'a=1;\nb=2+3'),
+    ('s = \'a//b\' + "/*c*/" + "\\"//"', 's=\'a//b\'+"/*c*/"+"\\"//"'),
+    # Regex com barras, classes e flags copiada intacta
+    ('x = /a\\/b[/]*  c/gi.test(s) // comentário', 'x=/a\\/b[/]*  c/gi.test(s)'),
+    ('return /^\\d+$/.test(valor)', 'return/^\\d+$/.test(valor)'),
+    ('lista.split(/, */)', 'lista.split(/, */)'),
+    # Quebras de linha preservadas para a inserção automática de ponto e vírgula
+    ('a = 1\n\n\nb = 2', 'a=1\nb=2'),
+    ('return\nvalor', 'return\nvalor'),
+    ('a = 1/*\n*/b = 2', 'a=1\nb=2'),
+    ('var t = `x\n  ${y}  // z`', 'var t=`x\n  ${y}  // z`'),
+])
+def test_minificar_js(codigo, esperado):
+    assert minificar_js(codigo) == esperado + '\n'
+
+
+def test_comentario_e_string_sem_fim():
+    assert minificar_js('a = 1 /* aberto') == 'a=1\n'
+    assert minificar_js('a = "aberta') == 'a="aberta\n'
+
+
+@pytest.mark.parametrize('caminho', ARQUIVOS_JS, ids=os.path.basename)
+def test_minificar_e_idempotente(caminho):
+    with open(caminho, encoding='utf-8') as f:
+        minificado = minificar_js(f.read())
+    assert minificar_js(minificado) == minificado
+
+
+@pytest.mark.skipif(NODE is None, reason='node not installed')
+@pytest.mark.parametrize('caminho', ARQUIVOS_JS, ids=os.path.basename)
+def test_js_minificado_continua_valido(caminho, tmp_path):
+    with open(caminho, encoding='utf-8') as f:
+        original = f.read()
+    destino = tmp_path / os.path.basename(caminho)
+    destino.write_text(minificar_js(original), encoding='utf-8')
+    resultado = subprocess.run([NODE, '--check', str(destino)], capture_output=True, text=True)
+    assert resultado.returncode == 0, resultado.stderr
+    assert len(destino.read_text(encoding='utf-8')) < len(original)
+
+
+@pytest.mark.skipif(NODE is None, reason='node not installed')
+def test_js_minificado_tem_o_mesmo_resultado():
+    programa = '''
+    // Divisões, regex e inserção automática de ponto e vírgula lado a lado
+    var i = 10, j = 4, texto = "a/b // c"
+    var r = /[/]\\d+ \\/x/g
+    var divisao = i++ / 2 / j-- / 1
+    var soma = i + +j - -1
+    function f() {
+        return /^a\\/b/.test(texto)
+    }
+    var ultimo = [1, 2, 3]
+    /* bloco
+       de comentário */
+    var modelo = `linha 1
+      ${texto} // não é comentário`
+    console.log(JSON.stringify([divisao, soma, f(), r.source, modelo, texto.split(/\\//), ultimo]))
+    '''
+    saidas = [subprocess.run([NODE, '-e', codigo], capture_output=True, text=True, check=True).stdout
+              for codigo in (programa, minificar_js(programa))]
+    assert saidas[0] == saidas[1]
+    assert saidas[0]
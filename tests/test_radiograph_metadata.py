@@ -0,0 +1,255 @@
+import io
+import struct
+from datetime import datetime
+
+import pytest
+
+from app.radiograph_metadata import RangedFile, extrair_metadados
+
+ASCII, SHORT, LONG = 2, 3, 4
+
+
+def _ifd(ordem, entradas, offset):
+    """IFD written at ``offset`` followed by the values that do not fit in an entry"""
+    dados_offset = offset + 2 + len(entradas) * 12 + 4
+    corpo, extra = b'', b''
+    for tag, tipo, valor in entradas:
+        if tipo == ASCII:
+            bruto = valor.encode('latin-1') + b'\0'
+        else:
+            bruto = struct.pack(ordem + ('H' if tipo == SHORT else 'I'), valor)
+        if len(bruto) <= 4:
+            campo = bruto.ljust(4, b'\0')
+        else:
+            campo = struct.pack(ordem + 'I', dados_offset + len(extra))
+            extra += bruto + b'\0' * (len(bruto) % 2)
+        quantidade = len(bruto) if tipo == ASCII else 1
+        corpo += struct.pack(ordem + 'HHI', tag, tipo, quantidade) + campo
+    return struct.pack(ordem + 'H', len(entradas)) + corpo + struct.pack(ordem + 'I', 0) + extra
+
+
+def _tiff(ordem='<', largura=640, altura=480, fabricante='Carestream', modelo='CS 8100',
+          data='2024:03:05 10:20:30', data_original=None):
+    entradas = [
+        (256, SHORT, largura),
+        (257, LONG, altura),
+        (271, ASCII, fabricante),
+        (272, ASCII, modelo),
+        (306, ASCII, data),
+    ]
+    if data_original:
+        # O ponteiro ocupa a própria entrada: o tamanho do IFD0 não depende dele
+        tamanho = len(_ifd(ordem, entradas + [(34665, LONG, 0)], 8))
+        entradas.append((34665, LONG, 8 + tamanho))
+    cabecalho = (b'II' if ordem == '<' else b'MM') + struct.pack(ordem + 'HI', 42, 8)
+    arquivo = cabecalho + _ifd(ordem, entradas, 8)
+    if data_original:
+        arquivo += _ifd(ordem, [(36867, ASCII, data_original)], len(arquivo))
+    return arquivo
+
+
+def _segmento(marcador, conteudo):
+    return bytes([0xFF, marcador]) + struct.pack('>H', len(conteudo) + 2) + conteudo
+
+
+def _jpeg(largura=1024, altura=768, exif=None):
+    partes = [b'\xff\xd8', _segmento(0xE0, b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0')]
+    if exif is not None:
+        partes.append(_segmento(0xE1, b'Exif\0\0' + exif))
+    partes.append(_segmento(0xDB, bytes(65)))
+    partes.append(_segmento(0xC0, struct.pack('>BHHB', 8, altura, largura, 1) + b'\x01\x11\x00'))
+    partes.append(_segmento(0xDA, b'\x01\x01\x00\x00\x3f\x00'))
+    partes.append(b'\x12\x34\xff\xd9')
+    return b''.join(partes)
+
+
+def _png(largura=800, altura=600):
+    ihdr = struct.pack('>II', largura, altura) + b'\x08\x02\0\0\0'
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr + b'\0\0\0\0'
+
+
+def _elemento(grupo, numero, vr, valor, explicito=True):
+    if isinstance(valor, str):
+        valor = valor.encode('latin-1')
+    if len(valor) % 2:
+        valor += b'\0' if vr == b'UI' else b' '
+    tag = struct.pack('<HH', grupo, numero)
+    if not explicito:
+        return tag + struct.pack('<I', len(valor)) + valor
+    if vr in (b'OB', b'OW', b'SQ', b'UN'):
+        return tag + vr + b'\0\0' + struct.pack('<I', len(valor)) + valor
+    return tag + vr + struct.pack('<H', len(valor)) + valor
+
+
+def _dicom(sintaxe='1.2.840.10008.1.2.1', sequencia=b''):
+    explicito = sintaxe != '1.2.840.10008.1.2'
+    corpo = [
+        _elemento(0x0008, 0x0020, b'DA', '20230115', explicito),
+        _elemento(0x0008, 0x0030, b'TM', '093000', explicito),
+        _elemento(0x0008, 0x0022, b'DA', '20230116', explicito),
+        _elemento(0x0008, 0x0032, b'TM', '101530.123', explicito),
+        _elemento(0x0008, 0x0060, b'CS', 'DX', explicito),
+        _elemento(0x0008, 0x0070, b'LO', 'Vatech', explicito),
+        sequencia,
+        _elemento(0x0008, 0x1090, b'LO', 'PaX-i3D', explicito),
+        _elemento(0x0028, 0x0010, b'US', struct.pack('<H', 1500), explicito),
+        _elemento(0x0028, 0x0011, b'US', struct.pack('<H', 2000), explicito),
+        _elemento(0x7FE0, 0x0010, b'OW', bytes(64), explicito),
+    ]
+    meta = _elemento(0x0002, 0x0010, b'UI', sintaxe)
+    return bytes(128) + b'DICM' + meta + b''.join(corpo)
+
+
+def _sequencia_indefinida(niveis):
+    """A sequence nested ``niveis`` deep, every level with undefined length"""
+    abrir = struct.pack('<HH', 0x0008, 0x1140) + b'SQ\0\0' + b'\xff\xff\xff\xff' + \
+        struct.pack('<HHI', 0xFFFE, 0xE000, 0xFFFFFFFF)
+    fechar = struct.pack('<HHI', 0xFFFE, 0xE00D, 0) + struct.pack('<HHI', 0xFFFE, 0xE0DD, 0)
+    return abrir * niveis + fechar * niveis
+
+
+def _ler(dados):
+    return extrair_metadados(io.BytesIO(dados))
+
+
+@pytest.mark.parametrize('ordem', ['<', '>'])
+def test_tiff_nas_duas_ordens_de_bytes(ordem):
+    dados = _ler(_tiff(ordem))
+    assert dados == {
+        'formato': 'tiff',
+        'largura': 640,
+        'altura': 480,
+        'fabricante': 'Carestream',
+        'dispositivo': 'CS 8100',
+        'data_aquisicao': datetime(2024, 3, 5, 10, 20, 30),
+    }
+
+
+@pytest.mark.parametrize('ordem', ['<', '>'])
+def test_tiff_prefere_a_data_original_do_exif(ordem):
+    dados = _ler(_tiff(ordem, data_original='2021:12:31 23:59:58'))
+    assert dados['data_aquisicao'] == datetime(2021, 12, 31, 23, 59, 58)
+
+
+def test_jpeg_usa_o_sof_e_o_exif():
+    dados = _ler(_jpeg(exif=_tiff('>', largura=1, altura=1, fabricante='Planmeca')))
+    assert dados['formato'] == 'jpeg'
+    # As dimensões do quadro valem mais que as do EXIF
+    assert (dados['largura'], dados['altura']) == (1024, 768)
+    assert dados['fabricante'] == 'Planmeca'
+    assert dados['data_aquisicao'] == datetime(2024, 3, 5, 10, 20, 30)
+
+
+def test_jpeg_sem_exif():
+    assert _ler(_jpeg()) == {'formato': 'jpeg', 'largura': 1024, 'altura': 768}
+
+
+def test_formatos_simples():
+    assert _ler(_png()) == {'formato': 'png', 'largura': 800, 'altura': 600}
+    assert _ler(b'GIF89a' + struct.pack('<HH', 320, 200) + bytes(20)) == \
+        {'formato': 'gif', 'largura': 320, 'altura': 200}
+    # Altura negativa: BMP gravado de cima para baixo
+    bmp = b'BM' + bytes(16) + struct.pack('<ii', 1200, -900) + bytes(30)
+    assert _ler(bmp) == {'formato': 'bmp', 'largura': 1200, 'altura': 900}
+    assert _ler(b'%PDF-1.7\n') == {'formato': 'pdf'}
+    assert _ler(b'texto qualquer') == {}
+    assert _ler(b'') == {}
+
+
+@pytest.mark.parametrize('sintaxe', ['1.2.840.10008.1.2.1', '1.2.840.10008.1.2'])
+def test_dicom_explicito_e_implicito(sintaxe):
+    dados = _ler(_dicom(sintaxe))
+    assert dados == {
+        'formato': 'dicom',
+        'modalidade': 'DX',
+        'largura': 2000,
+        'altura': 1500,
+        'fabricante': 'Vatech',
+        'dispositivo': 'PaX-i3D',
+        # Aquisição antes do estudo; a fração de segundo é ignorada
+        'data_aquisicao': datetime(2023, 1, 16, 10, 15, 30),
+    }
+
+
+def test_dicom_pula_sequencias_de_tamanho_indefinido():
+    dados = _ler(_dicom(sequencia=_sequencia_indefinida(3)))
+    assert dados['dispositivo'] == 'PaX-i3D'
+    assert (dados['largura'], dados['altura']) == (2000, 1500)
+
+
+def test_dicom_com_aninhamento_excessivo():
+    with pytest.raises(ValueError):
+        _ler(_dicom(sequencia=_sequencia_indefinida(5000)))
+
+
+AMOSTRAS = {
+    'tiff_le': _tiff('<', data_original='2021:12:31 23:59:58'),
+    'tiff_be': _tiff('>', data_original='2021:12:31 23:59:58'),
+    'jpeg': _jpeg(exif=_tiff('<', data_original='2021:12:31 23:59:58')),
+    'png': _png(),
+    'dicom': _dicom(sequencia=_sequencia_indefinida(2)),
+    'dicom_implicito': _dicom('1.2.840.10008.1.2'),
+}
+
+
+@pytest.mark.parametrize('nome', sorted(AMOSTRAS))
+def test_arquivo_truncado_nunca_quebra_o_parser(nome):
+    """Every cut either yields what was read so far or a ValueError"""
+    arquivo = AMOSTRAS[nome]
+    for corte in range(len(arquivo)):
+        try:
+            dados = _ler(arquivo[:corte])
+        except ValueError:
+            continue
+        assert isinstance(dados, dict)
+
+
+def test_tiff_com_ifd_gigante():
+    arquivo = b'II' + struct.pack('<HI', 42, 8) + struct.pack('<H', 60000) + bytes(64)
+    with pytest.raises(ValueError):
+        _ler(arquivo)
+
+
+@pytest.mark.parametrize('ordem', ['<', '>'])
+def test_tiff_com_offsets_fora_do_arquivo(ordem):
+    cabecalho = (b'II' if ordem == '<' else b'MM') + struct.pack(ordem + 'HI', 42, 8)
+    # Fabricante apontando além do fim e ponteiro EXIF do tipo errado
+    entradas = struct.pack(ordem + 'HHII', 271, ASCII, 40, 0x7FFFFFF0) + \
+        struct.pack(ordem + 'HHI', 34665, ASCII, 3) + b'ab\0\0'
+    arquivo = cabecalho + struct.pack(ordem + 'H', 2) + entradas + struct.pack(ordem + 'I', 0)
+    try:
+        dados = _ler(arquivo)
+    except ValueError:
+        return
+    assert dados['fabricante'] is None
+
+
+def test_jpeg_com_segmento_de_tamanho_invalido():
+    arquivo = b'\xff\xd8' + b'\xff\xe0\x00\x01' + bytes(32)
+    with pytest.raises(ValueError):
+        _ler(arquivo)
+
+
+class _StorageEmMemoria:
+    def __init__(self, dados):
+        self.dados = dados
+        self.leituras = 0
+
+    def read(self, key, offset, length):
+        self.leituras += 1
+        return self.dados[offset:offset + length]
+
+
+@pytest.mark.parametrize('nome', sorted(AMOSTRAS))
+def test_ranged_file_le_o_mesmo_que_o_arquivo(nome):
+    storage = _StorageEmMemoria(AMOSTRAS[nome])
+    # Blocos minúsculos: toda estrutura atravessa a fronteira entre blocos
+    arquivo = RangedFile(storage, 'chave', block_size=7)
+    assert extrair_metadados(arquivo) == _ler(AMOSTRAS[nome])
+
+
+def test_ranged_file_nao_le_os_pixels():
+    dicom = _dicom()[:-64] + _elemento(0x7FE0, 0x0010, b'OW', bytes(1024 * 1024))
+    storage = _StorageEmMemoria(dicom)
+    extrair_metadados(RangedFile(storage, 'chave', block_size=4096))
+    assert storage.leituras == 1